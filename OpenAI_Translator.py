@@ -3,23 +3,53 @@ MIT License
 
 Copyright (c) 2023 Kristian S. Stangeland
 """
-import streamlit as st
 import argparse
+import contextlib
 import os
-import openai
-import pysrt
 import logging
+import random
+import sys
 
 from time import sleep
-from clients.gpt_client import GptClient, GptThread, Message, MemoryGptThreadOptions
+from typing import Callable, Optional
+from alignment import TranslationStreamMonitor, align_translation
+from checkpoint import TranslationJournal, file_hash, journal_key, journal_path
+from clients.gpt_client import GptClient, GptThread, Message, MemoryGptMessageOptions, MemoryGptThreadOptions
 from clients.manual_client import ManualGptClient
 from clients.openai_client import ApiGptClient
-from subtitles import IndexedSubtitle, indexed_subtitles_to_text, parse_indexed_subtitles
-from utils import get_batches, resize_chunk
+from clients.openai_factory import load_environment, openai_error, prewarm
+from clients.rate_limiter import configure_scheduler
+from dedup import LineDeduplicator
+from metrics import get_metrics, record_file, record_retry, start_metrics_server, timed
+from subtitles import Cue, IndexedSubtitle, chunk_cues, indexed_subtitles_to_text, read_cues, write_srt
+from tokens import get_tokenizer
+from translation_cache import TranslationCache
+from utils import language_path, ordered_imap
+
+# Bump whenever the prompt changes, so cached translations from the old prompt are not reused
+PROMPT_TEMPLATE_VERSION = "1"
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+class UntranslatedSubtitle(IndexedSubtitle):
+    """
+    A line that could not be translated, carrying its source text. Never cached or journaled, so it is requested
+    again by the next run.
+    """
+    __slots__ = ()
+
+def build_prompt(chunk: list[IndexedSubtitle], source_lang: str, target_lang: str) -> str:
+    """
+    Build the request to translate a chunk of subtitles.
+    """
+    prompt = f"아래 자막을 {source_lang}에서 {target_lang}(으)로 번역해주세요. 각 자막 사이에 있는 번호가 동기화를 위해 필요하므로 그대로 유지해주세요:\n\n"
+    # prompt = f"Please translate the following subtitles from {source_lang} to {target_lang}. Keep the numbered lines in between each subtitle as they are needed for synchronization:\n\n"
+    return prompt + indexed_subtitles_to_text(chunk)
+
 
 def translate_chunk(chunk: list[IndexedSubtitle],
                     client: GptClient, thread: GptThread,
-                    source_lang: str, target_lang: str, dry_run=False, retries: int = 3):
+                    source_lang: str, target_lang: str, dry_run=False, retries: int = 3,
+                    cache: TranslationCache = None, on_line: Callable[[IndexedSubtitle], None] = None):
     """
     Translate a chunk of subtitles from Japanese to English.
 
@@ -30,10 +60,18 @@ def translate_chunk(chunk: list[IndexedSubtitle],
         target_lang: The target language of the subtitles.
         dry_run: Whether to run the script without calling OpenAI to simulate output.
         retries: The number of times to retry the translation if it fails.
+        cache: If given, cached lines are not sent, and the new translations are added to the cache.
+        on_line: Called with each translated line as soon as it has been generated. Lines may be translated
+                 again later if the response turns out to be misaligned.
+
+    Returns:
+        The translated lines, in chunk order. Lines still untranslated after every attempt are returned as an
+        UntranslatedSubtitle with their source text.
     """
-    prompt = f"아래 자막을 {source_lang}에서 {target_lang}(으)로 번역해주세요. 각 자막 사이에 있는 번호가 동기화를 위해 필요하므로 그대로 유지해주세요:\n\n"
-    # prompt = f"Please translate the following subtitles from {source_lang} to {target_lang}. Keep the numbered lines in between each subtitle as they are needed for synchronization:\n\n"
-    prompt += indexed_subtitles_to_text(chunk)
+    if cache is not None and not dry_run:
+        return _translate_chunk_cached(chunk, client, thread, source_lang, target_lang, retries, cache, on_line)
+
+    prompt = build_prompt(chunk, source_lang, target_lang)
 
     attempt = 1
     retry_delay = 1  # seconds
@@ -42,116 +80,414 @@ def translate_chunk(chunk: list[IndexedSubtitle],
 
     if dry_run:  # In dry-run mode, don't call OpenAI
         print("Dry-run mode - skipping OpenAI API call.")
-        return chunk
+        return [UntranslatedSubtitle(*line) for line in chunk]
 
     # The messages to send to the API
     prompt_message = Message(role="user", content=prompt)
     thread.add_message(prompt_message)
 
-    responses = None
-    success = False
+    translations = {}
+    pending = chunk
 
     while attempt <= retries:
+        responses = None
+        keep_responses = False
+
         try:
-            responses = client.execute_completion(thread)
+            # Parse the lines as they are generated, and stop generating once the response goes off the rails
+            monitor = TranslationStreamMonitor(pending, on_line)
+            with client.stream_completion(thread) as stream:
+                for delta in stream:
+                    if not monitor.feed(delta):
+                        logging.warning(f"Aborting the generation: {monitor.abort_reason}.")
+                        break
+            responses = [stream.message] if stream.message else []
 
-            response = responses[0]
-            translated_chunk = list(parse_indexed_subtitles(response.content))
+            alignment = align_translation(pending, monitor.finish())
+            translations.update(alignment.aligned)
 
-            # If translation does not have the expected line count, adjust accordingly
-            if len(translated_chunk) != len(chunk):
-                if attempt == retries:
-                    logging.warning(
-                        f"Attempt {attempt}: Received {len(translated_chunk)} translated lines, expected {len(chunk)}. Truncating or padding the translation to match the expected line count.")
+            # Keep the response in the history if any part of it was usable
+            keep_responses = len(alignment.aligned) > 0
 
-                    offset = chunk[0].index if len(chunk) > 0 else 0
-                    translated_chunk = resize_chunk(translated_chunk, len(chunk),
-                                                    lambda index: IndexedSubtitle(index + offset, ""))
+            to_request = set(alignment.to_request)
+            pending = [line for line in pending if line.index in to_request]
 
-                else:
-                    logging.warning(
-                        f"Attempt {attempt}: Received {len(translated_chunk)} translated lines, expected {len(chunk)}. Retrying.")
+            if not pending:
+                logging.info(f"Received {len(chunk)} translated lines.")
+                break
 
-                    # Retry
-                    attempt += 1
-                    continue
-            else:
-                logging.info(f"Received {len(translated_chunk)} translated lines.")
+            logging.warning(f"Attempt {attempt}: {alignment.describe()}. Requesting {len(pending)} lines again.")
+            attempt += 1
 
-            success = True
-            return translated_chunk
+            if attempt <= retries:
+                record_retry("misaligned_lines")
+                # Only ask for the lines that are still missing
+                repair_prompt = f"다음 자막의 번역이 누락되었거나 잘못되었습니다. 아래 자막만 {target_lang}(으)로 번역해주세요. 번호는 그대로 유지해주세요:\n\n"
+                repair_prompt += indexed_subtitles_to_text(pending)
+                thread.add_message(Message(role="user", content=repair_prompt))
 
-        except openai.OpenAIError as e:
+        except openai_error() as e:
             logging.error(f"An OpenAI error occurred: {e}")
             attempt += 1
 
             if attempt > retries:
-                sleep(retry_delay)
-                retry_delay *= 2
-            else:
                 # If we've reached the max retries, throw the error
                 raise e
 
+            record_retry(type(e).__name__)
+            # Back off before retrying, with jitter so concurrent chunks do not retry in lockstep
+            sleep(retry_delay * random.uniform(0.5, 1.5))
+            retry_delay *= 2
+
         except Exception as e:
             logging.error(f"An unexpected error occurred: {e}")
             raise e
 
         finally:
             # Remove completion if the attempt failed
-            if not success:
-                for response in responses:
+            if not keep_responses:
+                for response in responses or []:
                     thread.remove_message(response)
 
+    if pending:
+        # Keep the source text rather than moving translations onto the wrong timestamps
+        logging.warning(f"No translation received for indices {[line.index for line in pending]} "
+                        f"after {retries} attempts, keeping the source text.")
+
+    return [IndexedSubtitle(line.index, translations[line.index]) if line.index in translations
+            else UntranslatedSubtitle(*line) for line in chunk]
+
+
+def _translate_chunk_cached(chunk: list[IndexedSubtitle], client: GptClient, thread: GptThread,
+                            source_lang: str, target_lang: str, retries: int, cache: TranslationCache,
+                            on_line: Callable[[IndexedSubtitle], None] = None):
+    model = getattr(client, "model", type(client).__name__)
+    cached = cache.get_many((line.text for line in chunk), source_lang, target_lang, model, PROMPT_TEMPLATE_VERSION)
+
+    misses = [line for line in chunk if line.text not in cached]
+    logging.info(f"Translation cache: {len(chunk) - len(misses)} hits, {len(misses)} misses.")
+
+    translated_misses = {}
+    if misses:
+        translated_misses = {line.index: line for line in translate_chunk(
+            misses, client, thread, source_lang=source_lang, target_lang=target_lang, retries=retries,
+            on_line=on_line)}
+
+        # Translations identical to their source, such as names or numbers, are cached like any other
+        cache.put_many({source.text: translated_misses[source.index].text for source in misses
+                        if not isinstance(translated_misses[source.index], UntranslatedSubtitle)},
+                       source_lang, target_lang, model, PROMPT_TEMPLATE_VERSION)
+
+    return [translated_misses[line.index] if line.index in translated_misses
+            else IndexedSubtitle(line.index, cached[line.text]) for line in chunk]
+
+
+def create_chunk_thread(client: GptClient, base_thread: GptThread,
+                        previous_chunk: Optional[list[IndexedSubtitle]]) -> GptThread:
+    """
+    Create an independent thread for translating a single chunk concurrently.
+
+    The thread contains the system messages of the base thread, followed by the source text of the previous
+    chunk (if any) so the model keeps some context across chunk boundaries.
+
+    Args:
+        client: The client used to create the thread.
+        base_thread: The thread holding the shared system prompt.
+        previous_chunk: The chunk preceding the one to be translated, or None for the first chunk.
+    """
+    thread = client.create_thread()
+    preserved = MemoryGptMessageOptions(preserve_message=True)
+
+    for message in base_thread:
+        if message.role == "system":
+            thread.add_message(Message(role=message.role, content=message.content), preserved)
+
+    if previous_chunk:
+        context = "참고용으로 이전 자막을 제공합니다. 이 부분은 번역하지 마세요:\n\n"
+        context += indexed_subtitles_to_text(previous_chunk)
+        thread.add_message(Message(role="user", content=context), preserved)
+
+    return thread
+
 
 # Main function to process the SRT file and translate it
 def process_srt(file_path, output_file_path, client: GptClient, thread: GptThread, source_lang: str, target_lang: str,
-                dry_run=False):
+                dry_run=False, workers: int = 1, cache: TranslationCache = None,
+                chunk_tokens: int = 1000, chunk_lines: int = 60, resume: bool = True,
+                on_line: Callable[[IndexedSubtitle], None] = None, dedup: bool = True):
+    """
+    Translate an SRT or VTT file chunk by chunk, streaming it from the input file to the output SRT file.
+
+    Args:
+        file_path: The SRT file to translate.
+        output_file_path: Where to save the translated SRT file.
+        client: The client to use.
+        thread: The thread to use. In concurrent mode, only its system messages are used.
+        source_lang: The source language of the subtitles.
+        target_lang: The target language of the subtitles.
+        dry_run: Whether to run the script without calling OpenAI to simulate output.
+        workers: The number of chunks to translate concurrently. Clients that do not support
+                 concurrency always run sequentially.
+        cache: An optional translation cache shared by all chunks.
+        chunk_tokens: The target number of subtitle tokens per chunk.
+        chunk_lines: The maximum number of subtitles per chunk.
+        resume: Whether to journal completed chunks next to the output, and skip the chunks already journaled by
+                an interrupted run with the same input and settings. The journal is removed once done.
+        on_line: Called with each translated line as soon as it has been generated, e.g. to show progress.
+                 Called from the worker threads when translating concurrently.
+        dedup: Whether to translate repeated lines once, sharing the translation with every copy.
+    """
+    process_srt_languages(file_path, {target_lang: output_file_path}, client, {target_lang: thread},
+                          source_lang=source_lang, dry_run=dry_run, workers=workers, cache=cache,
+                          chunk_tokens=chunk_tokens, chunk_lines=chunk_lines, resume=resume,
+                          on_line=(lambda language, line: on_line(line)) if on_line else None, dedup=dedup)
 
-    subs = pysrt.open(file_path, encoding='utf-8')
 
-    indexed_subs = [IndexedSubtitle(sub.index, sub.text) for sub in subs]
-    chunks = list(get_batches(indexed_subs, 40))
+def process_srt_languages(file_path, output_file_paths: dict[str, str], client: GptClient,
+                          threads: dict[str, GptThread], source_lang: str, dry_run=False, workers: int = 1,
+                          cache: TranslationCache = None, chunk_tokens: int = 1000, chunk_lines: int = 60,
+                          resume: bool = True, on_line: Callable[[str, IndexedSubtitle], None] = None,
+                          dedup: bool = True):
+    """
+    Translate an SRT or VTT file into several languages in one pass, reading and chunking it once.
+
+    Each chunk is translated into every language at once, with one request per language, so the wall time
+    grows much slower than the number of languages. See process_srt for the other arguments.
+
+    Args:
+        output_file_paths: The target languages, each mapped to where to save its translated SRT file.
+        threads: The thread of each target language. In concurrent mode, only their system messages are used.
+        on_line: Called with the target language and each translated line as soon as it has been generated.
+    """
+    languages = list(output_file_paths)
+    model = getattr(client, "model", type(client).__name__)
 
-    for chunk in chunks:
-        translated_chunk = translate_chunk(chunk, client, thread,
-                                           source_lang=source_lang, target_lang=target_lang, dry_run=dry_run)
+    deduplicators = {language: LineDeduplicator() if dedup else None for language in languages}
+    journals = {}
+    if resume and not dry_run:
+        input_hash = file_hash(file_path)
+        for language in languages:
+            journals[language] = TranslationJournal(journal_path(output_file_paths[language]),
+                                                    journal_key(input_hash, source_lang, language, model,
+                                                                PROMPT_TEMPLATE_VERSION))
 
-        # Assume translated_chunk is a single string, here's how to parse and apply the translations using your parse_chunk function
-        for line in translated_chunk:
-            # -1 because pysrt works with 0-based index, but SRT files are 1-based.
-            subs[line.index - 1].text = line.text
+    tokenizer = get_tokenizer(getattr(client, "model", None))
+    chunks = chunk_cues(read_cues(file_path), max_tokens=chunk_tokens, max_lines=chunk_lines, tokenizer=tokenizer)
+
+    def with_source_lines(chunks):
+        # Snapshot the source text of each chunk, shared by every language. A chunk is held until the next one has
+        # been cut, so the line following it is known.
+        previous_lines = None
+        held = None
+        for chunk in chunks:
+            lines = [IndexedSubtitle(cue.index, cue.text) for cue in chunk]
+            if held is not None:
+                yield held[0], held[1], previous_lines, lines[0].text
+                previous_lines = held[1]
+            held = (chunk, lines)
+
+        if held is not None:
+            yield held[0], held[1], previous_lines, None
+
+    concurrent = workers > 1 and client.supports_concurrency
+
+    def translate_language(language: str, lines: list[IndexedSubtitle], previous_lines: Optional[list[IndexedSubtitle]],
+                           next_text: Optional[str]) -> list[IndexedSubtitle]:
+        journal = journals.get(language)
+        if journal is not None and all(line.index in journal for line in lines):
+            return [IndexedSubtitle(line.index, journal.get(line.index)) for line in lines]
+
+        deduplicator = deduplicators[language]
+        deduplication = None
+        to_translate = lines
+        if deduplicator is not None:
+            deduplication = deduplicator.deduplicate(lines, before=previous_lines[-1].text if previous_lines else None,
+                                                     after=next_text)
+            to_translate = deduplication.unique
+
+        translated = []
+        if to_translate:
+            thread = threads[language]
+            chunk_thread = create_chunk_thread(client, thread, previous_lines) if concurrent else thread
+            translated = translate_chunk(to_translate, client, chunk_thread, source_lang=source_lang,
+                                         target_lang=language, dry_run=dry_run, cache=cache,
+                                         on_line=(lambda line: on_line(language, line)) if on_line else None)
+
+        if deduplication is not None:
+            translations = deduplicator.expand(deduplication, {line.index: line.text for line in translated
+                                                               if not isinstance(line, UntranslatedSubtitle)})
+            translated = [IndexedSubtitle(line.index, translations[line.index]) if line.index in translations
+                          else UntranslatedSubtitle(*line) for line in lines]
+
+        if journal is not None:
+            # Untranslated lines are left out, so a resumed run requests their chunk again
+            journal.record({line.index: line.text for line in translated
+                            if not isinstance(line, UntranslatedSubtitle)})
+        return translated
+
+    def translate(item) -> tuple[list[Cue], dict[str, list[IndexedSubtitle]]]:
+        chunk, lines, previous_lines, next_text = item
+        if len(languages) > 1 and client.supports_concurrency:
+            # The languages of a chunk are requested at once. Each language still sees its chunks in order.
+            results = ordered_imap(lambda language: translate_language(language, lines, previous_lines, next_text),
+                                   languages, len(languages))
+        else:
+            results = (translate_language(language, lines, previous_lines, next_text) for language in languages)
+        return chunk, dict(zip(languages, results))
+
+    if concurrent:
+        # Only a few chunks are read ahead, and the results are yielded in chunk order
+        translated_chunks = ordered_imap(translate, with_source_lines(chunks), workers)
+    else:
+        translated_chunks = map(translate, with_source_lines(chunks))
+
+    # Write to temporary files as we go, so the outputs are never left half written
+    temporary_paths = {language: f"{path}.tmp" for language, path in output_file_paths.items()}
+    try:
+        with contextlib.ExitStack() as stack:
+            outputs = {language: stack.enter_context(open(path, "w", encoding="utf-8"))
+                       for language, path in temporary_paths.items()}
+
+            for chunk, translated_chunk in translated_chunks:
+                for language, translated_lines in translated_chunk.items():
+                    # Map by index rather than position, so sparse or renumbered files are handled
+                    translations = {line.index: line.text.strip() for line in translated_lines}
+
+                    with timed("output"):
+                        write_srt([Cue(cue.index, cue.start, cue.end, translations.get(cue.index, cue.text))
+                                   for cue in chunk], outputs[language])
+    except BaseException:
+        # The journals keep the progress, so the partial outputs are of no use
+        for path in temporary_paths.values():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        raise
+    finally:
+        if concurrent:
+            # Let the chunks in flight finish, so their translations are journaled even if writing failed
+            translated_chunks.close()
+        for journal in journals.values():
+            journal.close()
+
+    for language, path in output_file_paths.items():
+        os.replace(temporary_paths[language], path)
+        record_file("output", path)
+        if language in journals:
+            journals[language].remove()
+        if deduplicators[language] is not None:
+            logging.info(f"Deduplication ({language}): {deduplicators[language].describe()}.")
 
-    # Save the modified subs back into an SRT file.
-    subs.save(output_file_path, encoding='utf-8')
 
 if __name__ == "__main__":
+    load_environment()
+
     parser = argparse.ArgumentParser(description="Translate an SRT file from Japanese to English.")
     parser.add_argument("input_srt", help="The input SRT file to be translated.")
     parser.add_argument("output_srt", help="The output SRT file to save the translation.")
     parser.add_argument("--source-lang", help="The source language of the SRT file.", default="Japanese")
-    parser.add_argument("--target-lang", help="The target language for the translation.", default="English")
+    parser.add_argument("--target-lang", nargs="+", default=["English"],
+                        help="The target language for the translation. With several languages, each is saved next "
+                             "to the output SRT file, e.g. out.English.srt.")
     parser.add_argument("--dry-run", action="store_true",
-                        help="Run the script without calling OpenAI to simulate output.")
+                        help="Only estimate the requests, tokens, cost and time of the translation, without "
+                             "calling OpenAI. The input may be a directory of SRT files.")
     parser.add_argument("--api-key",
                         help="The OpenAI API key to use. If not specified, the OPENAI_API_KEY environment variable will be used.",
                         default=os.environ.get("OPENAI_API_KEY"))
     parser.add_argument("--client-type", help="The type of client to use. If not specified, defaults to 'api'.",
                         choices=["api", "manual"], default="api")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="The number of chunks to translate concurrently (API client, or manual client with "
+                             "--manual-batch-chars). Defaults to 1, or 10 with --manual-batch-chars.")
+    parser.add_argument("--manual-batch-chars", type=int, default=None,
+                        help="Pack the prompts of several chunks into one clipboard payload of up to this many "
+                             "characters (manual client only).")
+    parser.add_argument("--model", help="The model to use with the API client.", default="gpt-4")
+    parser.add_argument("--rpm", type=float, default=None, help="The requests per minute limit of the account.")
+    parser.add_argument("--tpm", type=float, default=None, help="The tokens per minute limit of the account.")
+    parser.add_argument("--max-in-flight", type=int, default=8,
+                        help="The maximum number of requests running at once.")
+    parser.add_argument("--context-tokens", type=int, default=4000,
+                        help="The maximum number of tokens of earlier chunks kept in the conversation history.")
+    parser.add_argument("--chunk-tokens", type=int, default=1000,
+                        help="The target number of subtitle tokens sent per request.")
+    parser.add_argument("--chunk-lines", type=int, default=60,
+                        help="The maximum number of subtitles sent per request.")
+    parser.add_argument("--cache", help="A SQLite file used to cache translations across runs.", default=None)
+    parser.add_argument("--cache-max-entries", type=int, default=None,
+                        help="Evict the least recently used translations beyond this number of entries.")
+    parser.add_argument("--cache-max-mb", type=float, default=None,
+                        help="Evict the least recently used translations beyond this total size in megabytes.")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="Translate every copy of a repeated line separately.")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Start over instead of resuming from the journal of an interrupted run.")
+    parser.add_argument("--metrics-report", default=None,
+                        help="Save timings, token usage and the estimated cost to this JSON file.")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve the metrics in the Prometheus format on this port while running.")
     args = parser.parse_args()
 
+    if args.workers is None:
+        # Manual chunks are only packed together when they are prepared concurrently
+        args.workers = 10 if args.client_type.lower() == "manual" and args.manual_batch_chars else 1
+
+    if args.dry_run:
+        from planner import format_plan, plan_file, plan_report
+        from bulk_translate import find_subtitle_files
+
+        planned = []
+        for path in find_subtitle_files([args.input_srt]):
+            planned += plan_file(path, args.target_lang, source_lang=args.source_lang, model=args.model,
+                                 workers=args.workers, chunk_tokens=args.chunk_tokens, chunk_lines=args.chunk_lines,
+                                 context_tokens=args.context_tokens, dedup=not args.no_dedup)
+        print(format_plan(plan_report(planned, [args.model], workers=args.workers, requests_per_minute=args.rpm,
+                                      tokens_per_minute=args.tpm, max_in_flight=args.max_in_flight), per_chunk=True))
+        sys.exit(0)
+
+    if args.client_type.lower() == "api":
+        # The client library loads while the cache is opened and the input is read
+        prewarm()
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    cache = None
+    if args.cache:
+        cache = TranslationCache(args.cache, max_entries=args.cache_max_entries,
+                                 max_bytes=int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb else None)
+
     # Set up client
     if args.client_type.lower() == "api":
         if not args.api_key:
             raise ValueError("OPENAI_API_KEY environment variable must be set or --api-key must be provided")
-        client = ApiGptClient(args.api_key)
-        thread = client.create_thread(thread_options=MemoryGptThreadOptions(max_message_window=5))
-        thread.add_message(Message(role="system", content="You are a helpful assistant."))
+        configure_scheduler(args.model, requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                            max_in_flight=args.max_in_flight)
+        client = ApiGptClient(args.api_key, model=args.model)
+
+        def create_thread() -> GptThread:
+            thread = client.create_thread(
+                thread_options=MemoryGptThreadOptions(max_window_tokens=args.context_tokens))
+            thread.add_message(Message(role="system", content=SYSTEM_PROMPT),
+                               MemoryGptMessageOptions(preserve_message=True))
+            return thread
     elif args.client_type.lower() == "manual":
-        client = ManualGptClient()
-        thread = client.create_thread()
+        client = ManualGptClient(batch_chars=args.manual_batch_chars)
+        create_thread = client.create_thread
     else:
         raise ValueError(f"Invalid client type: {args.client_type}")
 
-    # Process the SRT file
-    process_srt(args.input_srt, args.output_srt, client, thread, source_lang=args.source_lang,
-                target_lang=args.target_lang, dry_run=args.dry_run)
\ No newline at end of file
+    # Process the SRT file, into each language at once. Every language keeps its own conversation history.
+    if len(args.target_lang) == 1:
+        output_paths = {args.target_lang[0]: args.output_srt}
+    else:
+        output_paths = {language: language_path(args.output_srt, language) for language in args.target_lang}
+
+    process_srt_languages(args.input_srt, output_paths, client,
+                          {language: create_thread() for language in output_paths},
+                          source_lang=args.source_lang, dry_run=args.dry_run, workers=args.workers, cache=cache,
+                          chunk_tokens=args.chunk_tokens, chunk_lines=args.chunk_lines,
+                          resume=not args.no_resume, dedup=not args.no_dedup)
+
+    if args.metrics_report:
+        get_metrics().save_report(args.metrics_report)
\ No newline at end of file
@@ -0,0 +1,154 @@
+from typing import Callable, Iterable, NamedTuple, Optional
+
+from subtitles import IndexedSubtitle, IndexedSubtitleParser, indexed_subtitles_to_text
+
+# A streamed translation this many times longer than its source (in characters) is considered runaway output
+MAX_LENGTH_RATIO = 4
+
+class AlignmentResult(NamedTuple):
+    # The translations that can be trusted, by index
+    aligned: dict[int, str]
+    # Expected indices that are absent or empty
+    missing: list[int]
+    # Expected indices that were received several times with different texts
+    duplicated: list[int]
+    # Indices whose text seems to also contain a neighbouring missing line
+    merged: list[int]
+    # Received indices that were not expected
+    out_of_range: list[int]
+
+    @property
+    def to_request(self) -> list[int]:
+        """
+        The indices that need to be translated again.
+        """
+        return sorted(set(self.missing) | set(self.duplicated) | set(self.merged))
+
+    def describe(self) -> str:
+        parts = [f"{len(self.aligned)} aligned"]
+        for name in ("missing", "duplicated", "merged", "out_of_range"):
+            indices = getattr(self, name)
+            if indices:
+                parts.append(f"{name.replace('_', ' ')} {indices}")
+        return ", ".join(parts)
+
+def _line_count(text: str) -> int:
+    return text.strip().count('\n') + 1
+
+def align_translation(source: list[IndexedSubtitle], translated: Iterable[IndexedSubtitle]) -> AlignmentResult:
+    """
+    Match translated subtitles to their source by index, keeping every line that can be trusted.
+
+    Args:
+        source: The subtitles that were sent for translation.
+        translated: The subtitles parsed from the response, e.g. with parse_indexed_subtitles.
+    """
+    expected = {line.index: line for line in source}
+
+    received: dict[int, list[str]] = {}
+    out_of_range = []
+    for line in translated:
+        if line.index in expected:
+            received.setdefault(line.index, []).append(line.text.strip())
+        elif line.index not in out_of_range:
+            out_of_range.append(line.index)
+
+    aligned = {}
+    missing = []
+    duplicated = []
+    for index, line in expected.items():
+        texts = received.get(index)
+
+        if not texts or (not texts[0] and line.text.strip()):
+            missing.append(index)
+        elif len(set(texts)) > 1:
+            duplicated.append(index)
+        else:
+            aligned[index] = texts[0]
+
+    # A line next to a missing one, with more lines than its source, most likely absorbed the missing line
+    merged = []
+    order = [line.index for line in source]
+    for position, index in enumerate(order):
+        if index not in missing:
+            continue
+
+        for neighbour in order[max(0, position - 1):position] + order[position + 1:position + 2]:
+            if neighbour in aligned and _line_count(aligned[neighbour]) > _line_count(expected[neighbour].text):
+                merged.append(neighbour)
+                del aligned[neighbour]
+
+    return AlignmentResult(aligned, missing, duplicated, sorted(merged), sorted(out_of_range))
+
+class TranslationStreamMonitor:
+    """
+    Parse a streamed translation as it arrives, and decide whether its generation should be aborted.
+
+    Generation should stop as soon as the response starts a subtitle that was not asked for, or grows far longer
+    than the subtitles sent, as the rest of it would most likely be wasted tokens.
+    """
+
+    def __init__(self, source: list[IndexedSubtitle], on_line: Callable[[IndexedSubtitle], None] = None,
+                 max_length_ratio: float = MAX_LENGTH_RATIO):
+        """
+        Args:
+            source: The subtitles that were sent for translation.
+            on_line: Called with each translated subtitle as soon as it is complete.
+            max_length_ratio: The maximum length of the response relative to the source.
+        """
+        self.expected = {line.index for line in source}
+        self.on_line = on_line
+        # Measured on the subtitles as sent, as the response repeats their numbers and blank lines too
+        self.max_length = max_length_ratio * len(indexed_subtitles_to_text(source)) + 200
+
+        self.received: list[IndexedSubtitle] = []
+        # Why the generation should be aborted, if it should
+        self.abort_reason: Optional[str] = None
+        self._parser = IndexedSubtitleParser()
+        self._length = 0
+
+    def _add(self, subtitles: list[IndexedSubtitle]):
+        for subtitle in subtitles:
+            if subtitle.index in self.expected:
+                self.received.append(subtitle)
+                if self.on_line:
+                    self.on_line(subtitle)
+
+    def feed(self, text: str) -> bool:
+        """
+        Add received text.
+
+        Returns:
+            Whether the generation should continue.
+        """
+        self._length += len(text)
+        self._add(self._parser.feed(text))
+
+        index = self._parser.current_index
+        if index is not None and index not in self.expected:
+            self.abort_reason = f"unexpected index {index}"
+        elif self._length > self.max_length:
+            self.abort_reason = f"runaway output of {self._length} characters"
+        return self.abort_reason is None
+
+    def finish(self) -> list[IndexedSubtitle]:
+        """
+        Mark the end of the response.
+
+        Returns:
+            The translated subtitles received. The subtitle being received when the generation was aborted is
+            left out, as it may be cut short.
+        """
+        if self.abort_reason is None:
+            self._add(self._parser.close())
+        return self.received
+
+if __name__ == '__main__':
+    source = [IndexedSubtitle(1, "こんにちは"), IndexedSubtitle(2, "元気?"), IndexedSubtitle(3, "はい"),
+              IndexedSubtitle(4, "では")]
+    translated = [IndexedSubtitle(1, "Hello"), IndexedSubtitle(2, "How are you?\nYes"), IndexedSubtitle(4, "Well"),
+                  IndexedSubtitle(4, "Then"), IndexedSubtitle(7, "???")]
+
+    result = align_translation(source, translated)
+    print(result.describe())
+    print(result.aligned, result.to_request)
@@ -1,10 +1,89 @@
-import streamlit as st
 import os
-import pandas as pd
 import time
 
-from youtube_downloader import download_and_convert_to_mp3
-from whisper_extractor import youtube_to_transcript
+import streamlit as st
+
+from jobs import JobManager, PipelineJob
+from metrics import RunMetrics
+
+# 화면을 다시 그려 진행 상황을 확인하는 간격 (초)
+POLL_INTERVAL = 1.0
+
+STATUS_MESSAGES = {
+    'queued': '대기 중... 다른 작업이 끝나면 시작합니다.',
+    'downloading': '비디오 다운로드하는 중...',
+    'processing': '비디오 다운로드가 완료되었습니다! 텍스트 추출 및 번역하는 중...',
+}
+
+
+@st.cache_resource
+def get_job_manager() -> JobManager:
+    # 모든 세션이 공유하므로, 같은 URL과 언어의 작업은 한 번만 실행됨
+    return JobManager(workers=int(os.environ.get("APP_MAX_JOBS", 2)))
+
+
+def show_metrics(metrics: RunMetrics):
+    import pandas as pd
+
+    report = metrics.report()
+
+    with st.expander("실행 통계", expanded=False):
+        tokens = sum(usage["prompt_tokens"] + usage["completion_tokens"] for usage in report["models"].values())
+        columns = st.columns(5)
+        columns[0].metric("소요 시간", f"{report['elapsed_seconds']:.1f}초")
+        columns[1].metric("예상 비용", f"${report['cost']:.4f}")
+        columns[2].metric("토큰", f"{tokens:,}")
+        columns[3].metric("재시도", sum(report["retries"].values()))
+        columns[4].metric("중복 제거", f"{report['dedup']['ratio']:.0%}")
+
+        st.dataframe(pd.DataFrame([{"단계": stage, "횟수": entry["count"], "시간(초)": round(entry["seconds"], 2),
+                                    "최대(초)": round(entry["max_seconds"], 2), "바이트": entry["bytes"]}
+                                   for stage, entry in report["stages"].items()]))
+        st.dataframe(pd.DataFrame([{"모델": model, **usage} for model, usage in report["models"].items()]))
+
+
+def show_downloads(job: PipelineJob):
+    downloads = [("원본 자막 (SRT)", job.result_path("원본_텍스트.srt"), "text/plain")]
+    downloads += [(f"번역 결과 - {language} (JSON)", job.translation_path(language), "application/json")
+                  for language in job.target_languages]
+
+    for label, path, mime in downloads:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                st.download_button(label, f.read(), file_name=os.path.basename(path), mime=mime)
+
+
+def show_job(job: PipelineJob):
+    # pandas는 표를 그릴 때 처음 불러와서 앱 시작을 빠르게 함
+    import pandas as pd
+
+    snapshot = job.snapshot()
+
+    if snapshot.status == 'done':
+        st.success('텍스트 추출 및 번역이 완료되었습니다!')
+    elif snapshot.status == 'failed':
+        st.error(f'작업이 실패했습니다: {snapshot.error}')
+    else:
+        st.info(STATUS_MESSAGES[snapshot.status])
+
+    # 추출과 번역이 진행되는 동안 결과를 한 줄씩 채워 나감
+    with st.expander("원 언어 내용 전사", expanded=True):
+        st.dataframe(pd.DataFrame(snapshot.original_rows))
+
+    for language, rows in snapshot.translated_rows.items():
+        with st.expander(f"번역된 내용 전사 ({language})", expanded=True):
+            st.dataframe(pd.DataFrame(rows))
+
+            # 번역 중인 줄은 생성되는 대로 보여주고, 확정되면 위 표로 옮겨짐
+            if snapshot.streaming_rows[language]:
+                st.caption("번역 중...")
+                st.dataframe(pd.DataFrame(snapshot.streaming_rows[language]))
+
+    if snapshot.status == 'done':
+        show_downloads(job)
+        show_metrics(job.metrics)
+
+    return snapshot
 
 
 def main():
@@ -13,46 +92,30 @@ def main():
     # Get YouTube URL from user
     url = st.text_input('유튜브 URL : ')
 
-    # Get language from user
-    lang = st.text_input('번역하고 싶은 언어 (ex. 영어) : ')
+    # Get languages from user. 여러 언어는 쉼표로 구분하며, 다운로드와 음성 인식은 한 번만 실행됨
+    lang = st.text_input('번역하고 싶은 언어 (ex. 영어, 또는 영어, 일본어) : ')
+    languages = [language.strip() for language in lang.split(',') if language.strip()]
+
+    manager = get_job_manager()
 
     if st.button('추출하기'):
         if url == '':
             st.error('YouTube URL을 입력하세요.')
+        elif not languages:
+            st.error('번역할 언어를 입력하세요.')
         else:
-            output_dir = "/video/"
-            os.makedirs(output_dir, exist_ok=True)
-
-            ext = "mp3"
-            path = os.path.join(output_dir, "converted_video_to_sound")
-            file_full_path = os.path.join(output_dir, f"converted_video_to_sound.{ext}")
-
-            placeholder = st.empty()
-
-            placeholder.info('비디오 다운로드하는 중...')
-            download_and_convert_to_mp3(path, file_full_path, url)
-            placeholder.empty()
-
-            placeholder.info('비디오 다운로드가 완료되었습니다!')
-            time.sleep(2)
-            placeholder.empty()
-
-            placeholder.info('텍스트 추출하는 중...')
-            original_full_text, translated_full_text = youtube_to_transcript(file_full_path, language=lang)
-            placeholder.empty()
-
-            placeholder.info('텍스트 추출이 완료되었습니다!')
-            time.sleep(2)
-            placeholder.empty()
+            # 작업은 백그라운드에서 실행되고, 이 세션은 작업의 키만 기억함
+            st.session_state['job_key'], _ = manager.submit(url, languages)
 
-            result_toggle = {
-                "원 언어 내용 전사" : pd.DataFrame(original_full_text),
-                "번역된 내용 전사" : pd.DataFrame(translated_full_text)
-            }
+    job = manager.get(st.session_state['job_key']) if 'job_key' in st.session_state else None
+    if job is None:
+        return
 
-            for section_name, df in result_toggle.items():
-                with st.expander(section_name):
-                    st.dataframe(df)
+    snapshot = show_job(job)
+    if snapshot.status not in ('done', 'failed'):
+        # 진행 중이면 잠시 후 화면을 다시 그려 새 결과를 가져옴
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,197 @@
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from typing import Optional
+
+class AudioStore:
+    """
+    A content-addressed store of converted audio files on disk.
+
+    Files are keyed by video ID and conversion settings. Once the total size exceeds max_bytes, the least
+    recently used files are deleted.
+    """
+
+    def __init__(self, directory: str = "./audio_cache", max_bytes: Optional[int] = 2 * 1024 ** 3):
+        """
+        Args:
+            directory: The directory holding the stored files.
+            max_bytes: The disk budget of the store, or None for no limit.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._jobs_directory = os.path.join(directory, ".jobs")
+        os.makedirs(self._jobs_directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._key_locks: dict[str, threading.Lock] = {}
+        # The number of jobs using each key, whose files are never evicted
+        self._pins: dict[str, int] = {}
+
+    @staticmethod
+    def key(video_id: str, settings: dict) -> str:
+        """
+        Compute the key of a video converted with the given settings.
+        """
+        digest = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        return f"{video_id}-{digest}"
+
+    def path(self, key: str, ext: str) -> str:
+        return os.path.join(self.directory, f"{key}.{ext}")
+
+    def lock(self, key: str) -> threading.Lock:
+        """
+        Get a lock serializing the production of a single key, so the same video is not downloaded twice at once.
+        """
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    @contextlib.contextmanager
+    def pin(self, key: str):
+        """
+        Protect the files of a key from eviction while the context is active.
+        """
+        with self._lock:
+            self._pins[key] = self._pins.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if not self._pins[key]:
+                    del self._pins[key]
+
+    def _key_paths(self, key: str) -> list[str]:
+        return glob.glob(os.path.join(glob.escape(self.directory), f"{glob.escape(key)}.*"))
+
+    def lookup(self, key: str, ext: str = None) -> Optional[str]:
+        """
+        Get the path of a stored file, marking it as recently used.
+
+        Args:
+            key: The key of the file.
+            ext: The extension of the file, or None if it is not known in advance.
+
+        Returns:
+            The path of the file, or None if it is not in the store.
+        """
+        if ext is None:
+            # Sidecar files have a compound extension
+            paths = [path for path in self._key_paths(key) if os.path.basename(path).count('.') == 1]
+            if not paths:
+                return None
+            path = paths[0]
+        else:
+            path = self.path(key, ext)
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def checkout(self, key: str, directory: str) -> str:
+        """
+        Give a job its own copy of a stored file and its sidecars, which later evictions cannot delete.
+
+        The files are hard-linked into the directory when possible, and copied otherwise.
+
+        Args:
+            key: The key of the file.
+            directory: The directory of the job.
+
+        Returns:
+            The path of the copy of the file.
+
+        Raises:
+            FileNotFoundError: If the file is not in the store.
+        """
+        path = None
+        with self._lock:
+            paths = self._key_paths(key)
+            if not paths:
+                raise FileNotFoundError(f"{key} is not in the audio store")
+
+            for stored_path in paths:
+                copy_path = os.path.join(directory, os.path.basename(stored_path))
+                try:
+                    os.link(stored_path, copy_path)
+                except OSError:
+                    # Another file system, or one without hard links
+                    shutil.copy2(stored_path, copy_path)
+                if os.path.basename(stored_path).count('.') == 1:
+                    path = copy_path
+        return path
+
+    def create_job_directory(self) -> str:
+        """
+        Create a unique scratch directory for a single job.
+        """
+        return tempfile.mkdtemp(dir=self._jobs_directory)
+
+    def commit(self, key: str, ext: str, produced_path: str, sidecars: dict[str, str] = None) -> str:
+        """
+        Move a produced file into the store and enforce the disk budget.
+
+        Args:
+            key: The key of the file.
+            ext: The extension of the file.
+            produced_path: The file to move. Its job directory is deleted afterwards.
+            sidecars: Additional files stored and evicted along with the file, by extension.
+
+        Returns:
+            The path of the stored file.
+        """
+        # Sidecars go first, so they are in place as soon as the file can be found
+        for sidecar_ext, sidecar_path in (sidecars or {}).items():
+            os.replace(sidecar_path, self.path(key, sidecar_ext))
+
+        path = self.path(key, ext)
+        # Atomic, so readers never see a partially written file
+        os.replace(produced_path, path)
+        shutil.rmtree(os.path.dirname(produced_path), ignore_errors=True)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: str = None):
+        """
+        Delete the least recently used files until the store fits its disk budget.
+
+        Args:
+            keep: A path that must not be deleted. Files of pinned keys are not deleted either.
+        """
+        if self.max_bytes is None:
+            return
+
+        keep_key = os.path.basename(keep).split('.')[0] if keep else None
+
+        with self._lock:
+            # A file and its sidecars share the key before the first dot, and are evicted together
+            groups: dict[str, list] = {}
+            for entry in os.scandir(self.directory):
+                if entry.is_file():
+                    stat = entry.stat()
+                    group = groups.setdefault(entry.name.split('.')[0], [0.0, 0, []])
+                    group[0] = max(group[0], stat.st_mtime)
+                    group[1] += stat.st_size
+                    group[2].append(entry.path)
+
+            total = sum(size for _, size, _ in groups.values())
+            for key, (_, size, paths) in sorted(groups.items(), key=lambda item: item[1][0]):
+                if total <= self.max_bytes:
+                    break
+                if key == keep_key or key in self._pins:
+                    continue
+
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                total -= size
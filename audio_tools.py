@@ -0,0 +1,281 @@
+import json
+import os
+import re
+import subprocess
+from typing import Generator, NamedTuple, Optional
+
+from metrics import record_file, timed
+
+_SILENCE_START = re.compile(r'silence_start: (-?[\d.]+)')
+_SILENCE_END = re.compile(r'silence_end: (-?[\d.]+)')
+
+# Shorter segments are not worth a request of their own when splitting for parallel transcription
+MIN_PARALLEL_SEGMENT_SECONDS = 30
+
+class Silence(NamedTuple):
+    start: float
+    end: float
+
+class AudioStream(NamedTuple):
+    codec: str
+    sample_rate: int
+    channels: int
+    # Bits per second, if known
+    bit_rate: Optional[int]
+
+class AudioSegment(NamedTuple):
+    path: str
+    # Offset of the segment in the original file, in seconds
+    start: float
+    end: float
+
+def probe_duration(path: str) -> float:
+    """
+    Get the duration of a media file in seconds using ffprobe.
+    """
+    output = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'json', path],
+        capture_output=True, check=True, text=True).stdout
+    return float(json.loads(output)['format']['duration'])
+
+def probe_audio_stream(path: str) -> AudioStream:
+    """
+    Get the codec parameters of the first audio stream of a media file using ffprobe.
+    """
+    output = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries',
+         'stream=codec_name,sample_rate,channels,bit_rate:format=bit_rate', '-of', 'json', path],
+        capture_output=True, check=True, text=True).stdout
+    info = json.loads(output)
+    stream = info['streams'][0]
+
+    # Containers such as WebM only report the bitrate of the whole file
+    bit_rate = stream.get('bit_rate') or info.get('format', {}).get('bit_rate')
+    return AudioStream(stream['codec_name'], int(stream['sample_rate']), int(stream['channels']),
+                       int(bit_rate) if bit_rate else None)
+
+def detect_silences(path: str, noise_db: float = -35, min_duration: float = 0.5) -> list[Silence]:
+    """
+    Find the silences in an audio file using ffmpeg's silencedetect filter.
+
+    Args:
+        path: The audio file.
+        noise_db: The volume below which audio is considered silent.
+        min_duration: The minimum length of a silence in seconds.
+    """
+    with timed('ffmpeg.silencedetect'):
+        stderr = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-nostats', '-i', path,
+             '-af', f'silencedetect=noise={noise_db}dB:d={min_duration}', '-f', 'null', '-'],
+            capture_output=True, check=True, text=True).stderr
+
+    silences = []
+    start = None
+    for line in stderr.splitlines():
+        if match := _SILENCE_START.search(line):
+            start = max(0.0, float(match.group(1)))
+        elif (match := _SILENCE_END.search(line)) and start is not None:
+            silences.append(Silence(start, float(match.group(1))))
+            start = None
+
+    return silences
+
+def plan_segments(duration: float, silences: list[Silence], max_duration: float) -> list[tuple[float, float]]:
+    """
+    Choose where to cut an audio file so that no segment exceeds max_duration.
+
+    Cuts are placed in the middle of the latest silence in the second half of each segment, or at
+    max_duration if there is no such silence.
+
+    Returns:
+        The (start, end) times of the segments in seconds.
+    """
+    midpoints = [(silence.start + silence.end) / 2 for silence in silences]
+    segments = []
+    start = 0.0
+
+    while duration - start > max_duration:
+        candidates = [point for point in midpoints if start + max_duration / 2 < point <= start + max_duration]
+        end = candidates[-1] if candidates else start + max_duration
+
+        segments.append((start, end))
+        start = end
+
+    segments.append((start, duration))
+    return segments
+
+def cut_segment(path: str, start: float, end: float, output_path: str):
+    """
+    Copy a time range of an audio file to a new file without re-encoding.
+    """
+    with timed('ffmpeg.cut'):
+        subprocess.run(
+            ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-ss', f'{start:.3f}', '-to', f'{end:.3f}',
+             '-i', path, '-c', 'copy', output_path],
+            check=True)
+    record_file('ffmpeg.cut', output_path)
+
+def removable_silences(silences: list[Silence], duration: float, keep: float = 0.25) -> list[Silence]:
+    """
+    Shrink silences by a margin on each side, so trimming them does not clip the surrounding speech.
+
+    Leading and trailing silences are removed entirely.
+    """
+    removed = []
+    for silence in silences:
+        start = silence.start if silence.start <= 0 else silence.start + keep
+        end = silence.end if silence.end >= duration else silence.end - keep
+        if end > start:
+            removed.append(Silence(start, min(end, duration)))
+    return removed
+
+def map_to_source_time(time: float, removed: list[Silence]) -> float:
+    """
+    Map a time in trimmed audio back to the time in the original audio.
+
+    Args:
+        time: The time in the trimmed audio in seconds.
+        removed: The silences removed from the original audio, in order.
+    """
+    for silence in removed:
+        # A time at the start of a removed silence is speech that followed it, e.g. the first cue after the lead-in
+        if silence.start > time:
+            break
+        time += silence.end - silence.start
+    return time
+
+def silence_map_path(audio_path: str) -> str:
+    """
+    Get the path of the sidecar file listing the silences removed from an audio file.
+    """
+    return os.path.splitext(audio_path)[0] + '.silences.json'
+
+def save_silence_map(path: str, removed: list[Silence]):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'removed': [[silence.start, silence.end] for silence in removed]}, f)
+
+def load_silence_map(path: str) -> list[Silence]:
+    """
+    Load the silences removed from an audio file, or an empty list if nothing was removed.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [Silence(start, end) for start, end in json.load(f)['removed']]
+
+# The extension of a file containing a stream copy of each codec
+_COPY_EXTENSIONS = {'opus': 'ogg', 'vorbis': 'ogg', 'aac': 'm4a', 'mp3': 'mp3'}
+
+def convert_for_speech(path: str, output_path_without_ext: str, sample_rate: int = 16000, channels: int = 1,
+                       bit_rate: str = '24k', trim_silence: bool = True, noise_db: float = -40,
+                       min_silence: float = 1.0, keep_silence: float = 0.25,
+                       max_copy_bit_rate: int = 96000) -> tuple[str, list[Silence]]:
+    """
+    Convert audio to a small file suitable for speech recognition.
+
+    The audio is re-encoded as low-bitrate mono Opus, optionally removing long silences. If nothing needs to be
+    removed and the source already uses a compact codec, the stream is copied without re-encoding.
+
+    Args:
+        path: The source audio or video file.
+        output_path_without_ext: The output path. The extension depends on the chosen codec.
+        sample_rate: The sample rate when re-encoding.
+        channels: The number of channels when re-encoding.
+        bit_rate: The bitrate when re-encoding.
+        trim_silence: Whether to remove leading, trailing and long internal silences.
+        noise_db: The volume below which audio is considered silent.
+        min_silence: The minimum duration in seconds of a silence to remove.
+        keep_silence: The silence in seconds kept on each side of the speech.
+        max_copy_bit_rate: The maximum bitrate of a source that may be copied as is.
+
+    Returns:
+        The output path and the silences removed from the source, in source time.
+    """
+    removed = []
+    if trim_silence:
+        removed = removable_silences(detect_silences(path, noise_db, min_silence), probe_duration(path),
+                                     keep_silence)
+
+    stream = probe_audio_stream(path)
+    if not removed and stream.codec in _COPY_EXTENSIONS and \
+            stream.bit_rate is not None and stream.bit_rate <= max_copy_bit_rate:
+        output_path = f'{output_path_without_ext}.{_COPY_EXTENSIONS[stream.codec]}'
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', path,
+                        '-vn', '-c:a', 'copy', output_path], check=True)
+        return output_path, removed
+
+    filters = []
+    if removed:
+        ranges = '+'.join(f'between(t,{silence.start:.3f},{silence.end:.3f})' for silence in removed)
+        filters.append(f"aselect='not({ranges})',asetpts=N/SR/TB")
+
+    output_path = f'{output_path_without_ext}.ogg'
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', path, '-vn',
+                    *(['-af', ','.join(filters)] if filters else []),
+                    '-ar', str(sample_rate), '-ac', str(channels),
+                    '-c:a', 'libopus', '-b:a', bit_rate, '-application', 'voip', output_path], check=True)
+    return output_path, removed
+
+def parallel_segment_duration(duration: float, workers: int, max_duration: float) -> float:
+    """
+    Choose the maximum segment duration so that an audio file is split into about one segment per worker.
+
+    Args:
+        duration: The duration of the audio file in seconds.
+        workers: The number of segments transcribed concurrently.
+        max_duration: The maximum segment duration regardless of the workers.
+    """
+    if workers <= 1:
+        return max_duration
+    # Cuts fall at silences short of the limit, so leave some room to avoid a short extra segment at the end
+    return min(max_duration, max(MIN_PARALLEL_SEGMENT_SECONDS, duration / workers * 1.15))
+
+def iter_split_on_silence(path: str, output_directory: str, max_duration: float = 600,
+                          max_bytes: Optional[int] = None, workers: int = 1) -> Generator[AudioSegment, None, None]:
+    """
+    Split an audio file at silences into segments bounded in duration and size, yielding each segment as soon
+    as it has been written.
+
+    Args:
+        path: The audio file to split.
+        output_directory: Where to write the segments.
+        max_duration: The maximum duration of a segment in seconds.
+        max_bytes: The maximum size of a segment in bytes, estimated from the average bitrate of the file.
+        workers: The number of segments transcribed concurrently. Files shorter than max_duration are still split
+                 into about one segment per worker, so every worker has something to transcribe.
+    """
+    duration = probe_duration(path)
+    max_duration = parallel_segment_duration(duration, workers, max_duration)
+
+    if max_bytes is not None and duration > 0:
+        bytes_per_second = os.path.getsize(path) / duration
+        # Leave some headroom, as the bitrate is not constant
+        max_duration = min(max_duration, 0.9 * max_bytes / bytes_per_second)
+
+    if duration <= max_duration:
+        yield AudioSegment(path, 0.0, duration)
+        return
+
+    os.makedirs(output_directory, exist_ok=True)
+    _, ext = os.path.splitext(path)
+
+    for i, (start, end) in enumerate(plan_segments(duration, detect_silences(path), max_duration)):
+        segment_path = os.path.join(output_directory, f'segment_{i:04d}{ext}')
+        cut_segment(path, start, end, segment_path)
+        yield AudioSegment(segment_path, start, end)
+
+def split_on_silence(path: str, output_directory: str, max_duration: float = 600,
+                     max_bytes: Optional[int] = None, workers: int = 1) -> list[AudioSegment]:
+    """
+    Split an audio file at silences into segments bounded in duration and size.
+
+    See iter_split_on_silence.
+    """
+    return list(iter_split_on_silence(path, output_directory, max_duration, max_bytes, workers))
+
+if __name__ == '__main__':
+    silences = [Silence(290, 292), Silence(540, 541), Silence(800, 803)]
+    print(plan_segments(1000, silences, max_duration=600))
+
+    removed = removable_silences(silences, duration=1000)
+    print(removed, map_to_source_time(300, removed))
@@ -0,0 +1,154 @@
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+
+from audio_store import AudioStore
+from metrics import RunMetrics, start_metrics_server
+from pipeline import StageLimits, stream_pipeline
+from youtube_downloader import extract_video_id
+
+def expand_urls(urls: list[str]) -> list[str]:
+    """
+    Expand playlist and channel URLs into the URLs of their videos.
+
+    Args:
+        urls: Video, playlist or channel URLs.
+    """
+    import yt_dlp
+
+    expanded = []
+
+    with yt_dlp.YoutubeDL({'extract_flat': 'in_playlist', 'quiet': True}) as ydl:
+        for url in urls:
+            if 'list=' not in url and '/@' not in url and '/channel/' not in url and '/playlist' not in url:
+                expanded.append(url)
+                continue
+
+            info = ydl.extract_info(url, download=False)
+            for entry in info.get('entries') or []:
+                expanded.append(entry.get('url') or f"https://www.youtube.com/watch?v={entry['id']}")
+
+    # Keep the first occurrence of each video
+    unique = {}
+    for url in expanded:
+        unique.setdefault(extract_video_id(url), url)
+    return list(unique.values())
+
+def run_job(url: str, target_language: Union[str, list[str]], output_directory: str, store: AudioStore,
+            limits: StageLimits, trim_silence: bool = True) -> dict:
+    """
+    Run the whole pipeline for one video, saving the results to its own directory.
+
+    Returns:
+        A summary of the job.
+    """
+    video_id = extract_video_id(url)
+    job_directory = os.path.join(output_directory, video_id)
+    started = time.monotonic()
+
+    summary = {"url": url, "video_id": video_id, "output_directory": job_directory}
+    metrics = RunMetrics()
+
+    try:
+        lines = 0
+        for event in stream_pipeline(url, target_language, store=store, result_directory=job_directory,
+                                     limits=limits, metrics=metrics, trim_silence=trim_silence):
+            if event.kind == 'translated':
+                lines += len(event.rows)
+
+        summary.update(status="done", lines=lines)
+    except Exception as e:
+        logging.error(f"Job for {url} failed: {e}")
+        summary.update(status="failed", error=str(e))
+
+    summary["seconds"] = round(time.monotonic() - started, 1)
+    report = metrics.report()
+    summary.update(cost=report["cost"], metrics=report)
+    return summary
+
+def run_batch(urls: list[str], target_language: Union[str, list[str]], output_directory: str, jobs: int = 4,
+              limits: StageLimits = None, store: AudioStore = None, trim_silence: bool = True) -> list[dict]:
+    """
+    Run the pipeline for many videos over a bounded pool of jobs, and save a summary report.
+
+    Args:
+        urls: The video URLs.
+        target_language: The language to translate to, or several languages, each saved to its own file.
+        output_directory: The directory holding one subdirectory per video and the report.
+        jobs: The maximum number of videos processed at once.
+        limits: The concurrency limits of each stage, shared by all jobs.
+        store: The audio store shared by all jobs.
+        trim_silence: Whether to remove long silences from the audio before transcribing it.
+
+    Returns:
+        The summary of each job, in the order of the URLs.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    limits = limits or StageLimits()
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        summaries = list(executor.map(
+            lambda url: run_job(url, target_language, output_directory, store, limits, trim_silence), urls))
+
+    report = {
+        "target_language": target_language,
+        "videos": len(summaries),
+        "succeeded": sum(1 for summary in summaries if summary["status"] == "done"),
+        "failed": sum(1 for summary in summaries if summary["status"] == "failed"),
+        "lines": sum(summary.get("lines", 0) for summary in summaries),
+        "cost": round(sum(summary["cost"] for summary in summaries), 6),
+        "seconds": round(time.monotonic() - started, 1),
+        "jobs": summaries,
+    }
+
+    with open(os.path.join(output_directory, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+
+    return summaries
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download, transcribe and translate many YouTube videos.")
+    parser.add_argument("urls", nargs="*", help="Video, playlist or channel URLs.")
+    parser.add_argument("--url-file", help="A file with one URL per line.")
+    parser.add_argument("--target-lang", nargs="+", default=["English"],
+                        help="The target language for the translation, or several languages.")
+    parser.add_argument("--output-dir", help="Where to save the results.", default="./batch_result")
+    parser.add_argument("--jobs", type=int, default=4, help="The number of videos processed at once.")
+    parser.add_argument("--download-concurrency", type=int, default=2,
+                        help="The maximum number of downloads at once.")
+    parser.add_argument("--transcribe-concurrency", type=int, default=4,
+                        help="The maximum number of transcription requests at once.")
+    parser.add_argument("--translate-concurrency", type=int, default=4,
+                        help="The maximum number of segment translations at once.")
+    parser.add_argument("--audio-budget-gb", type=float, default=2,
+                        help="The disk budget of the downloaded audio.")
+    parser.add_argument("--no-trim-silence", action="store_true",
+                        help="Transcribe the audio with its silences, for sources where trimming them hurts.")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve the metrics in the Prometheus format on this port while running.")
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    urls = list(args.urls)
+    if args.url_file:
+        with open(args.url_file, encoding="utf-8") as f:
+            urls += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    if not urls:
+        parser.error("No URLs given")
+
+    summaries = run_batch(expand_urls(urls), args.target_lang, args.output_dir, jobs=args.jobs,
+                          limits=StageLimits(args.download_concurrency, args.transcribe_concurrency,
+                                             args.translate_concurrency),
+                          store=AudioStore(max_bytes=int(args.audio_budget_gb * 1024 ** 3)),
+                          trim_silence=not args.no_trim_silence)
+
+    for summary in summaries:
+        print(f"{summary['status']:7s} {summary['seconds']:8.1f}s {summary.get('lines', 0):6d} lines "
+              f"${summary['cost']:.4f}  {summary['url']}")
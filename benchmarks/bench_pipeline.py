@@ -0,0 +1,212 @@
+"""
+Measure the throughput of the translation and transcription paths against a local mock of the OpenAI API.
+
+Every scenario reports the requests and tokens seen by the server, the wall time and the peak Python memory.
+The results are saved to benchmarks/results/, and compared with the previous run. The transcription split
+across several workers needs ffmpeg to generate, split and cut real audio, and is skipped without it.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pipeline --sizes 100 1000 5000 --latency 0.1
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from mock_openai_server import MockConfig, start_mock_server
+from subtitles import format_timestamp
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(__file__), "results")
+
+# Compared with the previous run
+METRICS = ("seconds", "requests", "tokens", "peak_mib")
+
+# The bitrate of the generated audio, so the mock transcribes about one cue per second of it by default
+AUDIO_BIT_RATE = 64000
+
+def generate_srt(path: str, cues: int):
+    with open(path, "w", encoding="utf-8") as f:
+        for index in range(1, cues + 1):
+            # A longer pause every 20 cues, so the chunker has conversation boundaries to cut at
+            start = index * 2500 + (index // 20) * 3000
+            f.write(f"{index}\n{format_timestamp(start)} --> {format_timestamp(start + 2000)}\n"
+                    f"これは字幕の{index}行目です。\n\n")
+
+def generate_audio(path: str, seconds: float):
+    # A tone with a two-second pause every ten seconds, so the audio has silences to split at
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-f', 'lavfi', '-i',
+                    f'aevalsrc=if(lt(mod(t\\,10)\\,8)\\,sin(440*2*PI*t)\\,0):s=16000:d={seconds:.0f}',
+                    '-ac', '1', '-b:a', str(AUDIO_BIT_RATE), path],
+                   check=True)
+
+def generate_segments(cues: int) -> list[dict]:
+    return [{"Start": format_timestamp(index * 2500), "End": format_timestamp(index * 2500 + 2000),
+             "Text": f"これは字幕の{index}行目です。"} for index in range(1, cues + 1)]
+
+def measure(server, function, memory: bool) -> dict:
+    server.reset_stats()
+    started = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - started
+    stats = server.stats
+
+    result = {
+        "seconds": round(seconds, 3),
+        "requests": sum(stats.requests.values()),
+        "tokens": stats.prompt_tokens + stats.completion_tokens,
+        "prompt_tokens": stats.prompt_tokens,
+        "completion_tokens": stats.completion_tokens,
+        "rate_limited": stats.rate_limited,
+        "wrong_line_counts": stats.wrong_line_counts,
+    }
+
+    if memory:
+        # Measured separately, as tracing allocations slows everything down
+        tracemalloc.start()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_mib"] = round(peak / 1024 / 1024, 2)
+
+    return result
+
+def run_scenarios(server, sizes: list[int], workers: int, memory: bool) -> dict:
+    from openai import OpenAI
+
+    from OpenAI_Translator import process_srt
+    from clients.gpt_client import Message, MemoryGptMessageOptions, MemoryGptThreadOptions
+    from clients.openai_client import ApiGptClient
+    from translator import translate_openai
+    from whisper_extractor import youtube_to_transcript
+
+    client = ApiGptClient("mock", model="gpt-4")
+    results = {}
+
+    def new_thread():
+        thread = client.create_thread(thread_options=MemoryGptThreadOptions(max_window_tokens=4000))
+        thread.add_message(Message(role="system", content="You are a helpful assistant."),
+                           MemoryGptMessageOptions(preserve_message=True))
+        return thread
+
+    for size in sizes:
+        input_path = os.path.abspath(f"input_{size}.srt")
+        generate_srt(input_path, size)
+
+        for scenario_workers in sorted({1, workers}):
+            name = f"process_srt[{size} cues, {scenario_workers} workers]"
+            results[name] = measure(server, lambda: process_srt(
+                input_path, f"output_{size}.srt", client, new_thread(), "Japanese", "English",
+                workers=scenario_workers), memory)
+            print(f"{name:48s} {results[name]}")
+
+        segments = generate_segments(size)
+        name = f"translate_openai[{size} segments, {workers} concurrency]"
+        results[name] = measure(server, lambda: translate_openai(segments, "English", concurrency=workers), memory)
+        print(f"{name:48s} {results[name]}")
+
+        # The mock transcribes one cue per audio_bytes_per_cue bytes, so the transcript has about `size` cues
+        audio_path = os.path.abspath(f"audio_{size}.mp3")
+        with open(audio_path, "wb") as f:
+            f.write(os.urandom(size * server.config.audio_bytes_per_cue))
+
+        transcription_client = OpenAI(api_key="mock", base_url=server.base_url, max_retries=0)
+        name = f"transcription[{size} cues]"
+        results[name] = measure(server, lambda: youtube_to_transcript(
+            audio_path, transcription_client=transcription_client), memory)
+        print(f"{name:48s} {results[name]}")
+
+        # Real audio, so splitting at silences, cutting the segments and stitching their transcripts are measured
+        if workers > 1 and shutil.which("ffmpeg"):
+            split_path = os.path.abspath(f"audio_{size}_split.mp3")
+            generate_audio(split_path, size * server.config.audio_bytes_per_cue * 8 / AUDIO_BIT_RATE)
+            name = f"transcription[{size} cues, {workers} workers]"
+            results[name] = measure(server, lambda: youtube_to_transcript(
+                split_path, workers=workers, transcription_client=transcription_client), memory)
+            print(f"{name:48s} {results[name]}")
+        elif workers > 1:
+            print(f"Skipping the split transcription of {size} cues, as ffmpeg is not installed")
+
+    return results
+
+def previous_results(before: str):
+    paths = sorted(path for path in glob.glob(os.path.join(RESULTS_DIRECTORY, "bench_pipeline-*.json"))
+                   if os.path.basename(path) < before)
+    if not paths:
+        return None, None
+    with open(paths[-1], encoding="utf-8") as f:
+        return paths[-1], json.load(f)
+
+def compare(current: dict, previous: dict):
+    for name, result in current["results"].items():
+        old = previous["results"].get(name)
+        if not old:
+            continue
+
+        changes = []
+        for metric in METRICS:
+            if metric in result and old.get(metric):
+                change = (result[metric] - old[metric]) / old[metric] * 100
+                changes.append(f"{metric} {change:+.1f}%")
+        print(f"{name:48s} {', '.join(changes)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against a local mock of the OpenAI API.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000],
+                        help="The number of cues of each synthetic subtitle file.")
+    parser.add_argument("--workers", type=int, default=8, help="The concurrency of the concurrent scenarios.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before the server answers.")
+    parser.add_argument("--latency-per-token", type=float, default=0.0,
+                        help="Additional seconds per completion token.")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0,
+                        help="Probability that a request is rejected with a 429 error.")
+    parser.add_argument("--wrong-line-count-probability", type=float, default=0.0,
+                        help="Probability that a translation drops or merges a line.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="Skip the peak memory measurements.")
+    args = parser.parse_args()
+
+    config = MockConfig(latency=args.latency, latency_per_token=args.latency_per_token,
+                        rate_limit_probability=args.rate_limit_probability,
+                        wrong_line_count_probability=args.wrong_line_count_probability, seed=args.seed)
+    server = start_mock_server(config)
+
+    # The clients read these when they are created
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ["OPENAI_API_KEY"] = "mock"
+
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # translate_openai and the transcription write to ./result/
+        os.chdir(directory)
+        try:
+            results = run_scenarios(server, args.sizes, args.workers, not args.no_memory)
+        finally:
+            os.chdir(working_directory)
+            server.shutdown()
+
+    name = f"bench_pipeline-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    # Whether memory was measured does not affect the other results
+    settings = {key: value for key, value in vars(args).items() if key != "no_memory"}
+    current = {"config": settings, "results": results}
+
+    os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+    with open(os.path.join(RESULTS_DIRECTORY, name), "w", encoding="utf-8") as f:
+        json.dump(current, f, indent=4, ensure_ascii=False)
+    print(f"Saved {name}")
+
+    previous_path, previous = previous_results(name)
+    if previous:
+        print(f"Compared with {os.path.basename(previous_path)}:")
+        if previous["config"] != current["config"]:
+            print("Warning: the previous run used different settings")
+        compare(current, previous)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Compare the SRT parsing and serialization speed of subtitles.py against pysrt.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_srt --cues 200000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from subtitles import Cue, format_timestamp, read_cues, write_srt
+
+def generate_srt(path: str, cues: int):
+    with open(path, "w", encoding="utf-8") as f:
+        for index in range(1, cues + 1):
+            start = index * 2500
+            f.write(f"{index}\n{format_timestamp(start)} --> {format_timestamp(start + 2000)}\n"
+                    f"Subtitle line number {index}\nwith a second line\n\n")
+
+def measure(label: str, function) -> float:
+    started = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - started
+
+    # Measured separately, as tracing allocations slows everything down
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{label:32s} {elapsed:8.3f} s {peak / 1024 / 1024:10.1f} MiB peak")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SRT parsing and serialization.")
+    parser.add_argument("--cues", type=int, default=200000, help="The number of cues in the generated file.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = os.path.join(directory, "input.srt")
+        output_path = os.path.join(directory, "output.srt")
+        generate_srt(input_path, args.cues)
+        print(f"{args.cues} cues, {os.path.getsize(input_path) / 1024 / 1024:.1f} MiB")
+
+        def serialize():
+            with open(output_path, "w", encoding="utf-8") as output:
+                write_srt(cues, output)
+
+        def stream():
+            with open(output_path, "w", encoding="utf-8") as output:
+                write_srt(read_cues(input_path), output)
+
+        cues: list[Cue] = []
+
+        def parse():
+            cues[:] = read_cues(input_path)
+
+        native_parse = measure("subtitles: parse", parse)
+        native_write = measure("subtitles: serialize", serialize)
+        measure("subtitles: stream parse+write", stream)
+        del cues
+
+        try:
+            import pysrt
+        except ImportError:
+            print("pysrt is not installed, skipping the comparison")
+            return
+
+        subs = []
+
+        def pysrt_parse():
+            subs[:] = [pysrt.open(input_path, encoding="utf-8")]
+
+        pysrt_parse_time = measure("pysrt: parse", pysrt_parse)
+        pysrt_write_time = measure("pysrt: serialize", lambda: subs[0].save(output_path, encoding="utf-8"))
+
+        print(f"Speedup: parse {pysrt_parse_time / native_parse:.1f}x, serialize {pysrt_write_time / native_write:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Measure the import time of the entry points and the latency of the first requests, each in a fresh interpreter.
+
+Run from the repository root, optionally against an earlier commit:
+
+    python -m benchmarks.bench_startup --runs 10 --baseline HEAD~1
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+from mock_openai_server import MockConfig, start_mock_server
+
+MODULES = ["OpenAI_Translator", "translator", "whisper_extractor", "pipeline"]
+
+IMPORT_SCRIPT = """
+import time
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+"""
+
+# Prints the latency of the first and second completion with the same client, after some preparation work
+REQUEST_SCRIPT = """
+import time
+try:
+    from clients.openai_factory import prewarm
+    prewarm()
+except ImportError:
+    pass
+# Stands in for downloading the audio or reading the input
+time.sleep(1)
+
+started = time.perf_counter()
+from clients.gpt_client import Message
+from clients.openai_client import ApiGptClient
+client = ApiGptClient("mock")
+for _ in range(2):
+    thread = client.create_thread()
+    thread.add_message(Message(role="user", content="1\\nこんにちは"))
+    client.execute_completion(thread)
+    print(time.perf_counter() - started)
+    started = time.perf_counter()
+"""
+
+def run_script(script: str, directory: str, env: dict) -> list[float]:
+    output = subprocess.run([sys.executable, "-c", script], cwd=directory, env=env, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr.strip().splitlines()[-1] if output.stderr.strip() else "failed")
+    return [float(line) for line in output.stdout.split()]
+
+def measure(directory: str, env: dict, runs: int) -> dict:
+    results = {}
+
+    for module in MODULES:
+        try:
+            times = [run_script(IMPORT_SCRIPT.format(module=module), directory, env)[0] for _ in range(runs)]
+            results[f"import {module}"] = statistics.median(times)
+        except RuntimeError as e:
+            print(f"Skipping import {module}: {e}")
+
+    try:
+        latencies = [run_script(REQUEST_SCRIPT, directory, env) for _ in range(runs)]
+        results["first request"] = statistics.median(latency[0] for latency in latencies)
+        results["second request"] = statistics.median(latency[1] for latency in latencies)
+    except RuntimeError as e:
+        print(f"Skipping the request latency: {e}")
+
+    return results
+
+def export_revision(revision: str, directory: str):
+    archive = subprocess.run(["git", "archive", "--format=tar", revision], capture_output=True, check=True).stdout
+    with tempfile.TemporaryFile() as f:
+        f.write(archive)
+        f.seek(0)
+        with tarfile.open(fileobj=f) as tar:
+            tar.extractall(directory)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup time and the first request latency.")
+    parser.add_argument("--runs", type=int, default=10, help="The number of fresh interpreters per measurement.")
+    parser.add_argument("--baseline", help="A git revision to compare with, e.g. HEAD~1.")
+    args = parser.parse_args()
+
+    server = start_mock_server(MockConfig(latency=0))
+    env = dict(os.environ, OPENAI_API_KEY="mock", OPENAI_BASE_URL=server.base_url)
+
+    current = measure(os.getcwd(), env, args.runs)
+
+    baseline = {}
+    if args.baseline:
+        with tempfile.TemporaryDirectory() as directory:
+            export_revision(args.baseline, directory)
+            # Warm the bytecode cache of the exported tree
+            subprocess.run([sys.executable, "-m", "compileall", "-q", directory], check=True)
+            baseline = measure(directory, env, args.runs)
+
+    server.shutdown()
+
+    print(f"{'':32s} {'current':>10s}" + (f" {args.baseline:>10s} {'change':>8s}" if baseline else ""))
+    for name, seconds in current.items():
+        line = f"{name:32s} {seconds * 1000:8.1f}ms"
+        if name in baseline:
+            line += f" {baseline[name] * 1000:8.1f}ms {(seconds - baseline[name]) / baseline[name] * 100:+7.1f}%"
+        print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+"""
+Translate a backlog of subtitle files through the Batch API, which costs half as much as regular requests in
+exchange for results within a day.
+
+Every chunk of every file becomes one request of a JSONL job file. Once the batch has completed, each answer is
+aligned line by line, and the lines that are missing, misaligned or whose request failed are submitted again in a
+new batch. The state of the run is saved after every step, so a rerun resumes waiting for the batch it submitted.
+
+    python bulk_translate.py subtitles/ --output-dir translated --target-lang English
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import NamedTuple, Optional
+
+from OpenAI_Translator import PROMPT_TEMPLATE_VERSION, SYSTEM_PROMPT, build_prompt
+from alignment import align_translation
+from checkpoint import file_hash, journal_key
+from clients.openai_factory import get_openai_client, load_environment
+from metrics import BATCH_PREFIX, get_metrics, record_file, record_retry, record_usage, timed, usage_tokens
+from subtitles import Cue, IndexedSubtitle, chunk_subtitles, parse_indexed_subtitles, read_cues, write_srt
+from tokens import get_tokenizer
+from translation_cache import TranslationCache
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+# A batch no longer changes once it has one of these statuses
+FINISHED_STATUSES = {"completed", "failed", "expired", "cancelled"}
+SUBTITLE_EXTENSIONS = (".srt", ".vtt")
+
+class BulkRequest(NamedTuple):
+    custom_id: str
+    # The input file, and the indices of the subtitles sent
+    path: str
+    indices: list[int]
+
+class BulkResult(NamedTuple):
+    # Each input file mapped to its translated file
+    outputs: dict[str, str]
+    translated_lines: int
+    # Lines left untranslated after every round, by input file
+    failed_lines: dict[str, list[int]]
+    batch_ids: list[str]
+
+def find_subtitle_files(paths: list[str]) -> list[str]:
+    """
+    Expand directories into the subtitle files they contain, recursively.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                files += [os.path.join(directory, name) for name in sorted(names)
+                          if name.lower().endswith(SUBTITLE_EXTENSIONS)]
+        else:
+            files.append(path)
+    return files
+
+class BulkTranslation:
+    """
+    One bulk translation run, from building the job file to writing the translated files.
+    """
+
+    def __init__(self, outputs: dict[str, str], source_lang: str, target_lang: str, model: str = "gpt-4o-mini",
+                 state_path: str = "./bulk_state.json", chunk_tokens: int = 1000, chunk_lines: int = 60,
+                 max_rounds: int = 3, poll_interval: float = 30, cache: TranslationCache = None):
+        """
+        Args:
+            outputs: Each input file mapped to where to save its translation.
+            source_lang: The source language of the subtitles.
+            target_lang: The target language of the subtitles.
+            model: The model to use.
+            state_path: Where to save the state of the run, removed once the translations are written. A state
+                        left by a run with other inputs or settings is ignored.
+            chunk_tokens: The target number of subtitle tokens per request.
+            chunk_lines: The maximum number of subtitles per request.
+            max_rounds: The number of batches submitted before giving up on the lines still missing.
+            poll_interval: Seconds between two checks of the status of a batch.
+            cache: If given, cached lines are not sent, and the new translations are added to the cache.
+        """
+        self.outputs = outputs
+        self.source_lang = source_lang
+        self.target_lang = target_lang
+        self.model = model
+        self.state_path = state_path
+        self.chunk_tokens = chunk_tokens
+        self.chunk_lines = chunk_lines
+        self.max_rounds = max_rounds
+        self.poll_interval = poll_interval
+        self.cache = cache
+
+        self.cues = {path: list(read_cues(path)) for path in outputs}
+        self.key = journal_key(self._inputs_hash(), source_lang, target_lang, model, PROMPT_TEMPLATE_VERSION)
+        self.client = get_openai_client().with_options(max_retries=3)
+        self.state = self._load_state()
+
+    def _inputs_hash(self) -> str:
+        digest = hashlib.sha256()
+        for path in sorted(self.outputs):
+            digest.update(f"{path}\0{file_hash(path)}\0".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _load_state(self) -> dict:
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("key") == self.key:
+                logging.info(f"Resuming round {state['round']} from {self.state_path}.")
+                return state
+            logging.info(f"Ignoring {self.state_path}, as it belongs to different inputs or settings.")
+
+        return {"key": self.key, "round": 1, "batch_id": None, "batch_ids": [], "requests": [],
+                "translations": {path: {} for path in self.outputs}}
+
+    def _save_state(self):
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_path = f"{self.state_path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(temporary_path, self.state_path)
+
+    def _lines(self, path: str, indices: list[int] = None) -> list[IndexedSubtitle]:
+        wanted = set(indices) if indices is not None else None
+        return [IndexedSubtitle(cue.index, cue.text) for cue in self.cues[path]
+                if wanted is None or cue.index in wanted]
+
+    def _build_requests(self, lines_by_path: dict[str, list[IndexedSubtitle]]) -> list[BulkRequest]:
+        tokenizer = get_tokenizer(self.model)
+        requests = []
+        for path, lines in lines_by_path.items():
+            for chunk in chunk_subtitles(lines, max_tokens=self.chunk_tokens, max_lines=self.chunk_lines,
+                                         tokenizer=tokenizer):
+                requests.append(BulkRequest(f"round{self.state['round']}-{len(requests)}", path,
+                                            [line.index for line in chunk]))
+        return requests
+
+    def _initial_lines(self) -> dict[str, list[IndexedSubtitle]]:
+        lines_by_path = {}
+        for path in self.outputs:
+            lines = self._lines(path)
+            # Empty subtitles have nothing to translate
+            self.state["translations"][path].update((str(line.index), line.text) for line in lines
+                                                    if not line.text.strip())
+            lines = [line for line in lines if line.text.strip()]
+
+            if self.cache is not None:
+                cached = self.cache.get_many((line.text for line in lines), self.source_lang, self.target_lang,
+                                             self.model, PROMPT_TEMPLATE_VERSION)
+                self.state["translations"][path].update((str(line.index), cached[line.text]) for line in lines
+                                                        if line.text in cached)
+                lines = [line for line in lines if line.text not in cached]
+            if lines:
+                lines_by_path[path] = lines
+        return lines_by_path
+
+    def _job_file(self, requests: list[BulkRequest]) -> bytes:
+        lines = []
+        for request in requests:
+            prompt = build_prompt(self._lines(request.path, request.indices), self.source_lang, self.target_lang)
+            lines.append(json.dumps({
+                "custom_id": request.custom_id,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {"model": self.model, "messages": [{"role": "system", "content": SYSTEM_PROMPT},
+                                                           {"role": "user", "content": prompt}]},
+            }, ensure_ascii=False))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def submit(self, requests: list[BulkRequest]) -> str:
+        """
+        Upload the job file of the requests and create its batch.
+
+        Returns:
+            The ID of the batch.
+        """
+        with timed("bulk.submit"):
+            job_file = self.client.files.create(
+                file=(f"translate-round{self.state['round']}.jsonl", self._job_file(requests), "application/jsonl"),
+                purpose="batch")
+            batch = self.client.post("/batches", cast_to=object, body={
+                "input_file_id": job_file.id,
+                "endpoint": BATCH_ENDPOINT,
+                "completion_window": COMPLETION_WINDOW,
+                "metadata": {"description": f"Subtitles to {self.target_lang}, round {self.state['round']}"},
+            })
+
+        logging.info(f"Submitted batch {batch['id']} with {len(requests)} requests.")
+        self.state.update(batch_id=batch["id"], requests=[list(request) for request in requests])
+        self.state["batch_ids"].append(batch["id"])
+        self._save_state()
+        return batch["id"]
+
+    def wait(self, batch_id: str) -> dict:
+        """
+        Poll a batch until it has finished.
+        """
+        status = None
+        with timed("bulk.wait"):
+            while True:
+                batch = self.client.get(f"/batches/{batch_id}", cast_to=object)
+                if batch["status"] != status:
+                    status = batch["status"]
+                    logging.info(f"Batch {batch_id} is {status}: {batch.get('request_counts')}.")
+                if status in FINISHED_STATUSES:
+                    return batch
+                time.sleep(self.poll_interval)
+
+    def _read_results(self, file_id: Optional[str]) -> list[dict]:
+        if not file_id:
+            return []
+        content = self.client.files.content(file_id).content.decode("utf-8")
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    def merge(self, batch: dict) -> dict[str, list[IndexedSubtitle]]:
+        """
+        Align the answers of a finished batch and keep the lines that can be trusted.
+
+        Returns:
+            The lines to submit again, by input file.
+        """
+        if batch["status"] == "failed":
+            # Usually the job file was rejected, so none of its requests ran
+            logging.error(f"Batch {batch['id']} failed: {batch.get('errors')}")
+
+        results = {result["custom_id"]: result
+                   for result in self._read_results(batch.get("output_file_id")) +
+                   self._read_results(batch.get("error_file_id"))}
+        resubmit: dict[str, list[IndexedSubtitle]] = {}
+
+        for custom_id, path, indices in self.state["requests"]:
+            lines = self._lines(path, indices)
+            result = results.get(custom_id)
+            response = (result or {}).get("response") or {}
+
+            if response.get("status_code") != 200:
+                # Failed, or not run before the batch expired or was cancelled
+                reason = f"status {response['status_code']}" if response else batch["status"]
+                logging.warning(f"Request {custom_id} for {path} did not complete ({reason}).")
+                record_retry(f"bulk_{reason.replace(' ', '_')}")
+                resubmit.setdefault(path, []).extend(lines)
+                continue
+
+            body = response["body"]
+            record_usage(f"{BATCH_PREFIX}{self.model}", *usage_tokens(body.get("usage")))
+            content = body["choices"][0]["message"]["content"] or ""
+
+            alignment = align_translation(lines, parse_indexed_subtitles(content))
+            self.state["translations"][path].update((str(index), text) for index, text in alignment.aligned.items())
+            if self.cache is not None:
+                sources = {line.index: line.text for line in lines}
+                self.cache.put_many({sources[index]: text for index, text in alignment.aligned.items()},
+                                    self.source_lang, self.target_lang, self.model, PROMPT_TEMPLATE_VERSION)
+
+            if alignment.to_request:
+                logging.warning(f"Request {custom_id} for {path}: {alignment.describe()}.")
+                record_retry("misaligned_lines")
+                to_request = set(alignment.to_request)
+                resubmit.setdefault(path, []).extend(line for line in lines if line.index in to_request)
+
+        return resubmit
+
+    def _missing_lines(self) -> dict[str, list[IndexedSubtitle]]:
+        missing = {}
+        for path in self.outputs:
+            translations = self.state["translations"][path]
+            lines = [line for line in self._lines(path) if str(line.index) not in translations]
+            if lines:
+                missing[path] = lines
+        return missing
+
+    def write_outputs(self) -> BulkResult:
+        """
+        Write every translated file, keeping the source text of the lines that could not be translated.
+        """
+        failed = {}
+        translated_lines = 0
+
+        for path, output_path in self.outputs.items():
+            translations = self.state["translations"][path]
+            missing = [cue.index for cue in self.cues[path] if str(cue.index) not in translations]
+            if missing:
+                logging.warning(f"No translation received for indices {missing} of {path}, keeping the source text.")
+                failed[path] = missing
+            translated_lines += len(self.cues[path]) - len(missing)
+
+            directory = os.path.dirname(output_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temporary_path = f"{output_path}.tmp"
+            with timed("output"):
+                with open(temporary_path, "w", encoding="utf-8") as f:
+                    write_srt((Cue(cue.index, cue.start, cue.end, translations.get(str(cue.index), cue.text).strip())
+                               for cue in self.cues[path]), f)
+                os.replace(temporary_path, output_path)
+            record_file("output", output_path)
+
+        return BulkResult(dict(self.outputs), translated_lines, failed, list(self.state["batch_ids"]))
+
+    def run(self, wait: bool = True) -> Optional[BulkResult]:
+        """
+        Submit, wait for and merge batches until every line is translated or the rounds run out, then write the
+        translated files.
+
+        Args:
+            wait: Whether to wait for the batch. Otherwise, return None once it has been submitted, and run again
+                  later to resume.
+
+        Returns:
+            The result, or None if the batch has not finished yet.
+        """
+        while True:
+            if self.state["batch_id"] is None:
+                if self.state["round"] > self.max_rounds:
+                    break
+                # Worked out from the saved translations, so a run interrupted before its batch was submitted
+                # submits it when resumed
+                lines = self._initial_lines() if self.state["round"] == 1 else self._missing_lines()
+                if not lines:
+                    break
+                self.submit(self._build_requests(lines))
+
+            if not wait:
+                batch = self.client.get(f"/batches/{self.state['batch_id']}", cast_to=object)
+                if batch["status"] not in FINISHED_STATUSES:
+                    logging.info(f"Batch {batch['id']} is {batch['status']}: {batch.get('request_counts')}.")
+                    return None
+            else:
+                batch = self.wait(self.state["batch_id"])
+
+            # The lines to submit again are the ones still missing from the translations saved here
+            self.merge(batch)
+            self.state.update(batch_id=None, requests=[], round=self.state["round"] + 1)
+            self._save_state()
+
+        result = self.write_outputs()
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        return result
+
+if __name__ == "__main__":
+    load_environment()
+
+    parser = argparse.ArgumentParser(description="Translate many SRT files through the Batch API.")
+    parser.add_argument("inputs", nargs="+", help="SRT or VTT files, or directories holding them.")
+    parser.add_argument("--output-dir", default="./bulk_result", help="Where to save the translated files.")
+    parser.add_argument("--source-lang", help="The source language of the SRT files.", default="Japanese")
+    parser.add_argument("--target-lang", help="The target language for the translation.", default="English")
+    parser.add_argument("--model", help="The model to use.", default="gpt-4o-mini")
+    parser.add_argument("--chunk-tokens", type=int, default=1000,
+                        help="The target number of subtitle tokens sent per request.")
+    parser.add_argument("--chunk-lines", type=int, default=60,
+                        help="The maximum number of subtitles sent per request.")
+    parser.add_argument("--max-rounds", type=int, default=3,
+                        help="The number of batches submitted before giving up on the lines still missing.")
+    parser.add_argument("--poll-interval", type=float, default=30,
+                        help="Seconds between two checks of the status of a batch.")
+    parser.add_argument("--no-wait", action="store_true",
+                        help="Exit once the batch is submitted. Run again with the same arguments to resume.")
+    parser.add_argument("--cache", help="A SQLite file used to cache translations across runs.", default=None)
+    parser.add_argument("--metrics-report", default=None,
+                        help="Save timings, token usage and the estimated cost to this JSON file.")
+    args = parser.parse_args()
+
+    outputs = {}
+    for path in find_subtitle_files(args.inputs):
+        output_path = os.path.join(args.output_dir, os.path.splitext(os.path.basename(path))[0] + ".srt")
+        if output_path in outputs.values():
+            parser.error(f"Several inputs would be saved to {output_path}")
+        outputs[path] = output_path
+    if not outputs:
+        parser.error("No subtitle files found")
+
+    bulk = BulkTranslation(outputs, args.source_lang, args.target_lang, model=args.model,
+                           state_path=os.path.join(args.output_dir, "bulk_state.json"),
+                           chunk_tokens=args.chunk_tokens, chunk_lines=args.chunk_lines,
+                           max_rounds=args.max_rounds, poll_interval=args.poll_interval,
+                           cache=TranslationCache(args.cache) if args.cache else None)
+    result = bulk.run(wait=not args.no_wait)
+
+    if result is None:
+        print("The batch is still running. Run the same command again to resume.")
+    else:
+        print(f"Translated {result.translated_lines} lines of {len(result.outputs)} files "
+              f"in {len(result.batch_ids)} batches.")
+        for path, indices in result.failed_lines.items():
+            print(f"Untranslated in {path}: {indices}")
+
+    if args.metrics_report:
+        get_metrics().save_report(args.metrics_report)
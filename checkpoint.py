@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Optional
+
+def file_hash(path: str) -> str:
+    """
+    Get the SHA-256 hash of a file, reading it in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def journal_key(input_hash: str, source_lang: Optional[str], target_lang: str, model: str,
+                prompt_version: str) -> str:
+    """
+    Identify a translation run, so a journal is only resumed by a run producing the same translations.
+    """
+    payload = json.dumps([input_hash, source_lang, target_lang, model, prompt_version], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def journal_path(output_path: str) -> str:
+    return f"{output_path}.journal.jsonl"
+
+class TranslationJournal:
+    """
+    An append-only journal of completed translations, used to resume an interrupted run.
+
+    The first line identifies the run. Every following line holds the translations of one chunk, and is written
+    and flushed to disk at once, so a crash loses at most the chunk being written.
+    """
+
+    def __init__(self, path: str, key: str):
+        """
+        Args:
+            path: The journal file. Created if it does not exist.
+            key: Identifies the run (see journal_key). A journal left by a different run is discarded.
+        """
+        self.path = path
+        self.key = key
+        # Only the translations of an earlier run. New chunks are written to the file, not kept in memory.
+        self.translations: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            self._load()
+
+        resumed = bool(self.translations)
+        self._file = open(path, "a" if resumed else "w", encoding="utf-8")
+        if resumed:
+            logging.info(f"Resuming from {path} with {len(self.translations)} translated lines.")
+        else:
+            self._append({"key": key})
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            lines = f.readlines()
+
+        try:
+            header = json.loads(lines[0]) if lines else {}
+        except json.JSONDecodeError:
+            header = {}
+        if header.get("key") != self.key:
+            logging.info(f"Ignoring {self.path}, as it belongs to a different input or settings.")
+            return
+
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last entry may have been cut short by a crash
+                logging.warning(f"Skipping an incomplete entry in {self.path}.")
+                continue
+            self.translations.update((int(index), text) for index, text in entry["translations"].items())
+
+    def _append(self, entry: dict):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def __contains__(self, index: int) -> bool:
+        return index in self.translations
+
+    def get(self, index: int) -> Optional[str]:
+        return self.translations.get(index)
+
+    def record(self, translations: dict[int, str]):
+        """
+        Append the translations of a completed chunk to the journal file.
+        """
+        if not translations:
+            return
+        with self._lock:
+            if not self._file.closed:
+                self._append({"translations": {str(index): text for index, text in translations.items()}})
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def remove(self):
+        """
+        Close and delete the journal, once the output it was used for is complete.
+        """
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,10 +1,13 @@
 from abc import ABC
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Any, Callable, Generic, List, TypeVar
+from typing import Any, Callable, Generic, Iterator, List, NamedTuple, Optional, TypeVar
 
 import uuid
 from uuid import UUID
 
+from tokens import estimate_tokens
+
 TMessageOptions = TypeVar("TMessageOptions")
 
 @dataclass
@@ -33,7 +36,67 @@ class GptThread(ABC, Generic[TMessageOptions]):
     def __iter__(self):
         pass
 
+class CompletionStream:
+    """
+    The text of a completion, iterated as it is generated.
+
+    Once the iteration ends or the stream is closed, the response is added to the thread and available as
+    `message`. Closing the stream early aborts the generation, and the partial response is added instead.
+    """
+
+    def __init__(self, deltas: Iterator[str], finish: Callable[[str], Message]):
+        """
+        Args:
+            deltas: The generated text, piece by piece. Closed when the stream is aborted.
+            finish: Adds the response text to the thread, returning the message.
+        """
+        self._deltas = deltas
+        self._finish = finish
+        self._text = []
+        self.message: Optional[Message] = None
+        self.aborted = False
+
+    @property
+    def text(self) -> str:
+        return ''.join(self._text)
+
+    def __iter__(self) -> Iterator[str]:
+        for delta in self._deltas:
+            self._text.append(delta)
+            yield delta
+
+        if self.message is None:
+            self.message = self._finish(self.text)
+
+    def close(self):
+        """
+        Stop the generation if it is still running, and add what was received so far to the thread.
+        """
+        if self.message is not None:
+            return
+
+        self.aborted = True
+        close = getattr(self._deltas, 'close', None)
+        if close:
+            close()
+        self.message = self._finish(self.text)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # The request failed, so there is no response to add
+            close = getattr(self._deltas, 'close', None)
+            if close and self.message is None:
+                close()
+
 class GptClient(ABC):
+    # Whether execute_completion may be called from several threads at once
+    supports_concurrency: bool = True
+
     def __init__(self):
         pass
 
@@ -53,10 +116,35 @@ class GptClient(ABC):
         """
         pass
 
+    def stream_completion(self, thread: GptThread, message_options: Callable[[int, Message], Any] = None) \
+            -> CompletionStream:
+        """
+        Execute a completion on the given thread, streaming the response as it is generated.
+
+        Clients without streaming support produce the whole response at once.
+
+        Args:
+            thread: The thread to execute the completion on.
+            message_options: A function that returns the options for a given message index and message.
+        """
+        responses = []
+
+        def deltas():
+            responses.extend(self.execute_completion(thread, message_options))
+            for response in responses:
+                yield response.content
+
+        # execute_completion already added the response to the thread
+        return CompletionStream(deltas(), lambda text: responses[-1] if responses else None)
+
 @dataclass
 class MemoryGptThreadOptions:
     # The maximum number of messages before the oldest non-preserved message is deleted
     max_message_window: int = None
+    # The maximum number of tokens in non-preserved messages before the oldest non-preserved message is deleted
+    max_window_tokens: int = None
+    # Counts the tokens of a text. Defaults to a character-based estimate.
+    tokenizer: Callable[[str], int] = None
 
 @dataclass
 class MemoryGptMessageOptions:
@@ -65,20 +153,38 @@ class MemoryGptMessageOptions:
     # If true, the message will be deleted from the history after the completion
     delete_message: bool = False
 
+class _MemoryEntry(NamedTuple):
+    message: Message
+    options: MemoryGptMessageOptions
+    tokens: int
+
+# Tokens added by the API for each message, and to prime the reply
+_TOKENS_PER_MESSAGE = 4
+_TOKENS_PER_REPLY = 3
+
 class MemoryGptThread(GptThread[MemoryGptMessageOptions]):
     options: MemoryGptThreadOptions
-    messages: List[Message]
-    message_options: List[MemoryGptMessageOptions]
 
     def __init__(self, thread_options: MemoryGptThreadOptions = None):
         super().__init__()
         if not thread_options:
             thread_options = MemoryGptThreadOptions()
         self.options = thread_options
+        self._tokenizer = thread_options.tokenizer or estimate_tokens
 
-        self.messages = []
-        self.message_options = []
-        self._message_window_size = 0
+        # Both are in message order, so the oldest non-preserved message is always first in the window
+        self._entries: OrderedDict[UUID, _MemoryEntry] = OrderedDict()
+        self._window: OrderedDict[UUID, None] = OrderedDict()
+        self._window_tokens = 0
+        self._preserved_tokens = 0
+
+    @property
+    def messages(self) -> List[Message]:
+        return [entry.message for entry in self._entries.values()]
+
+    @property
+    def message_options(self) -> List[MemoryGptMessageOptions]:
+        return [entry.options for entry in self._entries.values()]
 
     def add_message(self, message: Message, options: MemoryGptMessageOptions = None):
         # Default options
@@ -87,22 +193,23 @@ class MemoryGptThread(GptThread[MemoryGptMessageOptions]):
         # Do not add deleted messages to the history
         if options.delete_message:
             return
-        
-        self.messages.append(message)
-        self.message_options.append(options)
 
-        # Increment the message window size
-        if not options.preserve_message:
-            self._message_window_size += 1
+        tokens = self._tokenizer(message.content) + _TOKENS_PER_MESSAGE
+        self._entries[message.id] = _MemoryEntry(message, options, tokens)
 
-        # Trim the message window if it exceeds the maximum size
-        if self.options.max_message_window is not None and \
-            self._message_window_size > self.options.max_message_window:
-            # Find first non-preserved message
-            index = next((i for i, options in enumerate(self.message_options) if not options.preserve_message), None)
+        if options.preserve_message:
+            self._preserved_tokens += tokens
+        else:
+            self._window[message.id] = None
+            self._window_tokens += tokens
 
-            if index is not None:
-                self._remove_message(index)
+        # Trim the message window while it exceeds its maximum size, always keeping the newest message
+        while len(self._window) > 1 and (
+                (self.options.max_message_window is not None and
+                 len(self._window) > self.options.max_message_window) or
+                (self.options.max_window_tokens is not None and
+                 self._window_tokens > self.options.max_window_tokens)):
+            self._remove_message(next(iter(self._window)))
 
     def remove_message(self, message: Message) -> bool:
         """
@@ -114,31 +221,35 @@ class MemoryGptThread(GptThread[MemoryGptMessageOptions]):
         Returns:
             True if the message was removed, False if it was not found.
         """
-        # Find the message in the list
-        index = next((i for i, m in enumerate(self.messages) if m.id == message.id), None)
-
-        if index is None:
+        if message.id not in self._entries:
             return False
-        
-        self._remove_message(index)
+
+        self._remove_message(message.id)
         return True
-    
-    def _remove_message(self, message_index: int) -> bool:
-        preserved = self.message_options[message_index].preserve_message
 
-        # Remove the message
-        del self.messages[message_index]
-        del self.message_options[message_index]
+    def _remove_message(self, message_id: UUID):
+        entry = self._entries.pop(message_id)
 
-        # Decrement the message window size
-        if not preserved:
-            self._message_window_size -= 1
+        if entry.options.preserve_message:
+            self._preserved_tokens -= entry.tokens
+        else:
+            del self._window[message_id]
+            self._window_tokens -= entry.tokens
+
+    def prompt_tokens(self) -> int:
+        """
+        Estimate the number of prompt tokens a completion on this thread will send.
+        """
+        return self._preserved_tokens + self._window_tokens + _TOKENS_PER_REPLY
 
     def __getitem__(self, key):
+        # The last message is looked up on every manual completion, so avoid copying the history for it
+        if key == -1 and self._entries:
+            return next(reversed(self._entries.values())).message
         return self.messages[key]
-    
+
     def __len__(self):
-        return len(self.messages)
+        return len(self._entries)
 
     def __iter__(self):
-        return iter(self.messages)
\ No newline at end of file
+        return (entry.message for entry in self._entries.values())
@@ -1,13 +1,71 @@
+import re
+import threading
 from dataclasses import dataclass
-from typing import Callable, List
+from typing import Callable, List, Optional
 
 import pyperclip
 
 from clients.gpt_client import GptClient, Message, GptThread, MemoryGptThread
 
+# Starts each request of a multi-chunk payload, and each answer in the pasted response
+_CHUNK_MARKER = re.compile(r'^\s*=+\s*CHUNK\s+(\d+)\s*=+\s*$', re.MULTILINE | re.IGNORECASE)
+
+def format_chunks(prompts: list[str]) -> str:
+    """
+    Pack several prompts into one payload, each preceded by a numbered marker line.
+    """
+    if len(prompts) == 1:
+        return prompts[0]
+
+    header = f"아래에 {len(prompts)}개의 요청이 있습니다. 각 요청은 '=== CHUNK 1 ===' 같은 줄로 시작합니다. " \
+             f"모든 요청에 순서대로 답하고, 각 답변을 요청과 같은 표시 줄로 시작해주세요.\n\n"
+    return header + "\n\n".join(f"=== CHUNK {number} ===\n{prompt}" for number, prompt in enumerate(prompts, 1))
+
+def parse_chunks(text: str, count: int) -> list[Optional[str]]:
+    """
+    Split the answer to a payload of format_chunks back into one answer per prompt.
+
+    Returns:
+        The answer to each prompt, or None for prompts without an answer.
+    """
+    if count == 1:
+        return [text]
+
+    answers = [None] * count
+    markers = list(_CHUNK_MARKER.finditer(text))
+    for marker, following in zip(markers, markers[1:] + [None]):
+        number = int(marker.group(1))
+        if 1 <= number <= count and answers[number - 1] is None:
+            answers[number - 1] = text[marker.end():following.start() if following else len(text)].strip()
+    return answers
+
+class _PendingPrompt:
+    def __init__(self, prompt: str):
+        self.prompt = prompt
+        self.answer: Optional[str] = None
+        self.done = threading.Event()
+
 class ManualGptClient(GptClient):
-    def __init__(self):
+    # The clipboard and console can only serve one prompt at a time, unless prompts are packed together
+    supports_concurrency = False
+
+    def __init__(self, batch_chars: int = None, gather_seconds: float = 0.5):
+        """
+        Args:
+            batch_chars: If given, the prompts of concurrent completions are packed into one clipboard payload of up
+                         to this many characters, so a single copy and paste answers many chunks. Chunks without
+                         an answer in the pasted response come back empty, to be asked again.
+            gather_seconds: How long to wait for more prompts before copying a payload.
+        """
         super().__init__()
+        self.batch_chars = batch_chars
+        self.gather_seconds = gather_seconds
+        self.supports_concurrency = batch_chars is not None
+
+        self._pending: list[_PendingPrompt] = []
+        self._condition = threading.Condition()
+        # Held by the thread waiting on the user
+        self._round_lock = threading.Lock()
 
     def create_thread(self, thread_options: dict = None) -> MemoryGptThread:
         return MemoryGptThread()
@@ -18,13 +76,64 @@ class ManualGptClient(GptClient):
         # Format the prompt for the clipboard
         return last_message.content if last_message else ""
 
-    def execute_completion(self, thread: MemoryGptThread, 
+    def _round_trip(self, text: str, chunks: int = 1) -> str:
+        pyperclip.copy(text)
+        if chunks > 1:
+            print(f"{chunks} prompts copied to clipboard. Paste them into ChatGPT and press Enter after getting "
+                  f"all the responses, copied together.")
+        else:
+            print("Prompt copied to clipboard. Paste it into ChatGPT and press Enter after getting the response.")
+        input()  # Wait for user to press Enter
+        return pyperclip.paste()
+
+    def _serve_round(self):
+        with self._condition:
+            # Gather prompts until the budget is full, or no more arrive
+            while sum(len(pending.prompt) for pending in self._pending) < self.batch_chars:
+                count = len(self._pending)
+                self._condition.wait(self.gather_seconds)
+                if len(self._pending) == count:
+                    break
+
+            batch = []
+            size = 0
+            for pending in self._pending:
+                if batch and size + len(pending.prompt) > self.batch_chars:
+                    break
+                batch.append(pending)
+                size += len(pending.prompt)
+            del self._pending[:len(batch)]
+
+        answers = parse_chunks(self._round_trip(format_chunks([pending.prompt for pending in batch]), len(batch)),
+                               len(batch))
+        missing = [number for number, answer in enumerate(answers, 1) if answer is None]
+        if missing:
+            print(f"No answer found for chunks {missing}. They will be asked again.")
+
+        for pending, answer in zip(batch, answers):
+            pending.answer = answer or ""
+            pending.done.set()
+
+    def _batched_round_trip(self, prompt: str) -> str:
+        pending = _PendingPrompt(prompt)
+        with self._condition:
+            self._pending.append(pending)
+            self._condition.notify_all()
+
+        # Whichever thread gets to the user first serves every prompt waiting, up to the budget
+        while not pending.done.is_set():
+            with self._round_lock:
+                if not pending.done.is_set():
+                    self._serve_round()
+        return pending.answer
+
+    def execute_completion(self, thread: MemoryGptThread,
                            message_options: Callable[[int, Message], dict] = None) -> List[Message]:
         formatted_text = self._format_prompt_for_clipboard(thread)
-        pyperclip.copy(formatted_text)
-        print("Prompt copied to clipboard. Paste it into ChatGPT and press Enter after getting the response.")
-        input()  # Wait for user to press Enter
-        response_text = pyperclip.paste()
+        if self.batch_chars is None:
+            response_text = self._round_trip(formatted_text)
+        else:
+            response_text = self._batched_round_trip(formatted_text)
 
         message = Message(role="assistant", content=response_text)
         message_option = message_options(0, message) if message_options else None
@@ -42,8 +151,8 @@ if __name__ == "__main__":
     thread.add_message(Message(role="user", content="What is the longest river in the solar system?"))
     responses = client.execute_completion(thread)
 
-    print(f"Responses: {responses}")    
+    print(f"Responses: {responses}")
 
     # Test removing a message
     #thread.remove_message(thread[-1])
-    #print(f"Removed last message. Thread: {thread}")
\ No newline at end of file
+    #print(f"Removed last message. Thread: {thread}")
@@ -1,10 +1,14 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+import logging
 import os
 from typing import Callable, List
 
-import openai
-
-from clients.gpt_client import GptClient, Message, MemoryGptThreadOptions, MemoryGptMessageOptions, MemoryGptThread
+from clients.gpt_client import CompletionStream, GptClient, Message, MemoryGptThreadOptions, MemoryGptMessageOptions, \
+    MemoryGptThread
+from clients.openai_factory import get_openai_client
+from clients.rate_limiter import get_scheduler, raw_usage_tokens
+from metrics import record_completion_usage, record_usage, timed, usage_tokens
+from tokens import get_tokenizer
 
 class ApiGptClient(GptClient):
     def __init__(self, api_key: str, model: str = "gpt-4"):
@@ -12,8 +16,13 @@ class ApiGptClient(GptClient):
         self.api_key = api_key
         self.model = model
 
-        self._client = openai.Client()
-        self._client.api_key = api_key
+        self._tokenizer = get_tokenizer(model)
+
+    @property
+    def _client(self):
+        # Shares the connection pool of the process. Retries are handled by the shared rate limit scheduler.
+        # Looked up on first use, so a client being prewarmed is built while the input is read.
+        return get_openai_client(self.api_key)
 
     def _get_message_dict(self, message: Message) -> dict:
         return {
@@ -22,25 +31,85 @@ class ApiGptClient(GptClient):
         }
 
     def create_thread(self, thread_options: MemoryGptThreadOptions = None) -> MemoryGptThread:
+        thread_options = thread_options or MemoryGptThreadOptions()
+        if thread_options.tokenizer is None:
+            thread_options = replace(thread_options, tokenizer=get_tokenizer(self.model))
         return MemoryGptThread(thread_options)
 
     def execute_completion(self, thread: MemoryGptThread, 
                            message_options: Callable[[int, Message], MemoryGptMessageOptions] = None) -> List[Message]:
         messages = [ self._get_message_dict(message) for message in thread.messages ]
-        
-        response = self._client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-        )
-        response = response.choices[0].message
+        logging.debug(f"Sending {len(messages)} messages, about {thread.prompt_tokens()} prompt tokens")
+
+        # Expect a reply about as long as the last message
+        estimated_tokens = thread.prompt_tokens() + self._tokenizer(thread[-1].content) if len(thread) > 0 else 0
+
+        with timed("translation.request"):
+            response = get_scheduler(self.model).call(
+                lambda: self._client.chat.completions.with_raw_response.create(
+                    model=self.model,
+                    messages=messages,
+                ),
+                estimated_tokens=estimated_tokens,
+                used_tokens=raw_usage_tokens,
+            )
+        completion = response.parse()
+        record_completion_usage(self.model, completion)
+        response = completion.choices[0].message
 
         message = Message(role=response.role, content=response.content)
-        message_option = message_options(len(thread.messages), message) if message_options else None
+        message_option = message_options(len(thread), message) if message_options else None
 
         # Add the message to the thread
         thread.add_message(message, message_option)
         return [message]
 
+    def stream_completion(self, thread: MemoryGptThread,
+                          message_options: Callable[[int, Message], MemoryGptMessageOptions] = None) -> CompletionStream:
+        messages = [ self._get_message_dict(message) for message in thread.messages ]
+        prompt_tokens = thread.prompt_tokens()
+        estimated_tokens = prompt_tokens + self._tokenizer(thread[-1].content) if len(thread) > 0 else 0
+
+        def deltas():
+            # The request counts as in flight until the stream is read or closed, not only until the headers arrive
+            with timed("translation.request"), get_scheduler(self.model).hold(
+                    lambda: self._client.chat.completions.with_raw_response.create(
+                        model=self.model,
+                        messages=messages,
+                        stream=True,
+                        # Report the usage in the last chunk
+                        extra_body={"stream_options": {"include_usage": True}},
+                    ),
+                    estimated_tokens=estimated_tokens) as held:
+                stream = held.response.parse()
+
+                usage = None
+                received = []
+                try:
+                    for chunk in stream:
+                        usage = getattr(chunk, "usage", None) or usage
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            received.append(chunk.choices[0].delta.content)
+                            yield chunk.choices[0].delta.content
+                finally:
+                    # Closing the connection stops the generation when the stream is aborted
+                    stream.response.close()
+
+                    if usage is not None:
+                        used = usage_tokens(usage)
+                    else:
+                        # Aborted streams report no usage
+                        used = prompt_tokens, self._tokenizer(''.join(received))
+                    record_usage(self.model, *used)
+                    held.used_tokens = sum(used)
+
+        def finish(text: str) -> Message:
+            message = Message(role="assistant", content=text)
+            thread.add_message(message, message_options(len(thread), message) if message_options else None)
+            return message
+
+        return CompletionStream(deltas(), finish)
+
 if __name__ == "__main__":
     # Test the API client
     client = ApiGptClient(api_key=os.environ["OPENAI_API_KEY"])
@@ -0,0 +1,149 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+import weakref
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import openai
+
+# Connections are kept open across requests, so consecutive chunks and segments skip the TCP and TLS handshakes.
+# The keep-alive expiry of httpx (5 seconds) is shorter than the time between requests of a sequential run.
+MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 64))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 32))
+KEEPALIVE_EXPIRY = 120
+
+_environment_loaded = False
+_lock = threading.Lock()
+_clients: dict[Optional[str], "openai.OpenAI"] = {}
+# An async client is bound to the event loop it was first used on
+_async_clients = weakref.WeakKeyDictionary()
+# The event loop running the coroutines of synchronous callers, see run_async
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def load_environment():
+    """
+    Load the .env file into the environment, once per process.
+    """
+    global _environment_loaded
+    if _environment_loaded:
+        return
+
+    with _lock:
+        if not _environment_loaded:
+            import dotenv
+            dotenv.load_dotenv()
+            _environment_loaded = True
+
+def _limits():
+    import httpx
+    return httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+def get_openai_client(api_key: str = None) -> "openai.OpenAI":
+    """
+    Get the client shared by every module in this process, created on first use.
+
+    Retries are left to the shared rate limit scheduler. The key, base URL and other settings are read from the
+    environment and the .env file, unless an API key is given.
+
+    Args:
+        api_key: The API key, or None for the key from the environment.
+    """
+    load_environment()
+    # Keyed by the key actually used, so asking for the key of the environment gets the default client
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    client = _clients.get(api_key)
+    if client is not None:
+        return client
+
+    import httpx
+    import openai
+
+    with _lock:
+        if api_key not in _clients:
+            _clients[api_key] = openai.OpenAI(api_key=api_key, max_retries=0,
+                                              http_client=httpx.Client(limits=_limits(),
+                                                                       timeout=openai.DEFAULT_TIMEOUT))
+        return _clients[api_key]
+
+def get_async_openai_client(api_key: str = None) -> "openai.AsyncOpenAI":
+    """
+    Get the async client of the running event loop, created on first use. See get_openai_client.
+    """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.get(loop)
+    if clients is None:
+        clients = _async_clients[loop] = {}
+
+    load_environment()
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    if api_key not in clients:
+        import httpx
+        import openai
+
+        clients[api_key] = openai.AsyncOpenAI(api_key=api_key, max_retries=0,
+                                              http_client=httpx.AsyncClient(limits=_limits(),
+                                                                            timeout=openai.DEFAULT_TIMEOUT))
+    return clients[api_key]
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="openai-event-loop", daemon=True).start()
+        return _loop
+
+def run_async(coroutine):
+    """
+    Run a coroutine on the event loop shared by the process, and wait for its result.
+
+    Unlike asyncio.run, the loop and so its async client outlive the call, so consecutive calls reuse the open
+    connections instead of each opening (and leaking) a pool of their own. The coroutine runs in the context of
+    the caller, so context variables such as the active metrics carry over.
+    """
+    loop = _get_loop()
+    context = contextvars.copy_context()
+    result = concurrent.futures.Future()
+
+    def start():
+        task = context.run(loop.create_task, coroutine)
+
+        def finish(task: asyncio.Task):
+            if task.cancelled():
+                result.cancel()
+            elif task.exception() is not None:
+                result.set_exception(task.exception())
+            else:
+                result.set_result(task.result())
+
+        task.add_done_callback(finish)
+
+    loop.call_soon_threadsafe(start)
+    return result.result()
+
+def prewarm():
+    """
+    Import the client library and create the shared client on a background thread, so the first request does not
+    wait for them. Meant to be called before slow preparation work, such as downloading or reading the input.
+    """
+    def create():
+        try:
+            get_openai_client()
+        except Exception:
+            # E.g. no API key in the environment. The first request reports the error.
+            pass
+
+    threading.Thread(target=create, daemon=True).start()
+
+def openai_error() -> type:
+    """
+    Get the base class of the errors raised by the client, without importing the library up front.
+
+    Meant for except clauses, which are only evaluated once an exception is raised.
+    """
+    import openai
+    return openai.OpenAIError
@@ -0,0 +1,352 @@
+import asyncio
+import contextlib
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional, TypeVar
+
+from clients.openai_factory import load_environment
+from metrics import record_retry
+
+T = TypeVar("T")
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def retryable_errors() -> tuple[type, ...]:
+    """
+    Get the errors that are worth retrying after a delay.
+
+    The library is imported on demand, as except clauses are only evaluated once an exception is raised.
+    """
+    import openai
+    return (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+def parse_duration(value: str) -> Optional[float]:
+    """
+    Parse a duration as used in the rate limit headers (e.g. "1s", "6m0s" or "20ms") into seconds.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+class TokenBucket:
+    """
+    A thread-safe token bucket refilled continuously at a per-minute rate.
+
+    Reservations may overdraw the bucket; the caller then waits until the debt has been refilled, which keeps
+    the reservation order fair without holding a lock while waiting.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self._available = per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take the given amount from the bucket.
+
+        Returns:
+            The number of seconds to wait before the reservation may be used.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self._available -= min(amount, self.capacity)
+            return max(0.0, -self._available / self.rate)
+
+    def give_back(self, amount: float):
+        """
+        Return part of an earlier reservation, e.g. when the actual usage was lower than estimated.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self._available = min(self.capacity, self._available + amount)
+
+    def observe(self, remaining: float, reset_seconds: Optional[float]):
+        """
+        Align the bucket with the remaining capacity reported by the server.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if remaining < self._available:
+                self._available = remaining
+            if remaining <= 0 and reset_seconds:
+                # Nothing left until the reset, regardless of the assumed refill rate
+                self._available = min(self._available, -reset_seconds * self.rate)
+
+class HeldRequest:
+    """
+    A request whose in-flight slot is held until the block of RateLimitScheduler.hold is left.
+    """
+
+    def __init__(self, response: Any):
+        self.response = response
+        # Set once known, e.g. from the usage at the end of a stream, to settle the token reservation
+        self.used_tokens: Optional[int] = None
+
+class RateLimitScheduler:
+    """
+    Schedules API requests within requests-per-minute and tokens-per-minute limits.
+
+    Requests wait for capacity in shared token buckets, at most max_in_flight requests run at once, and rate
+    limit and transient errors are retried with jittered exponential backoff, honoring Retry-After.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_in_flight: int = 8, max_retries: int = 6, base_delay: float = 1, max_delay: float = 60):
+        """
+        Args:
+            requests_per_minute: The request limit of the account, or None for no limit.
+            tokens_per_minute: The token limit of the account, or None for no limit.
+            max_in_flight: The maximum number of requests running at once.
+            max_retries: The number of times a failed request is retried.
+            base_delay: The delay before the first retry, in seconds.
+            max_delay: The maximum delay between retries, in seconds.
+        """
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._in_flight = 0
+        self._in_flight_condition = threading.Condition()
+        # After a rate limit error, every caller waits until this time
+        self._paused_until = 0.0
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        wait = max(0.0, self._paused_until - time.monotonic())
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens and estimated_tokens:
+            wait = max(wait, self.tokens.reserve(estimated_tokens))
+        return wait
+
+    def _try_enter(self) -> bool:
+        with self._in_flight_condition:
+            if self._in_flight >= self.max_in_flight:
+                return False
+            self._in_flight += 1
+            return True
+
+    def _enter(self):
+        with self._in_flight_condition:
+            self._in_flight_condition.wait_for(lambda: self._in_flight < self.max_in_flight)
+            self._in_flight += 1
+
+    def _leave(self):
+        with self._in_flight_condition:
+            self._in_flight -= 1
+            self._in_flight_condition.notify()
+
+    def _observe(self, headers, estimated_tokens: int, used_tokens: Optional[int]):
+        if self.tokens and used_tokens is not None:
+            if estimated_tokens > used_tokens:
+                self.tokens.give_back(estimated_tokens - used_tokens)
+            elif used_tokens > estimated_tokens:
+                # Charge the excess to the requests that follow
+                self.tokens.reserve(used_tokens - estimated_tokens)
+
+        if headers is None:
+            return
+
+        for bucket, name in ((self.requests, 'requests'), (self.tokens, 'tokens')):
+            remaining = headers.get(f'x-ratelimit-remaining-{name}')
+            if bucket and remaining is not None:
+                try:
+                    bucket.observe(float(remaining), parse_duration(headers.get(f'x-ratelimit-reset-{name}')))
+                except ValueError:
+                    pass
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+
+        retry_after = parse_duration(headers.get('retry-after-ms'))
+        if retry_after is not None:
+            retry_after /= 1000
+        else:
+            retry_after = parse_duration(headers.get('retry-after'))
+
+        if retry_after is None:
+            retry_after = parse_duration(headers.get('x-ratelimit-reset-requests') or
+                                         headers.get('x-ratelimit-reset-tokens'))
+
+        import openai
+        if retry_after and isinstance(error, openai.RateLimitError):
+            # Hold back the other callers too, instead of letting them run into the same limit
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+        backoff = min(self.max_delay, self.base_delay * 2 ** attempt)
+        # Jitter, so that concurrent callers do not retry in lockstep
+        delay = random.uniform(backoff / 2, backoff)
+        return max(delay, retry_after or 0.0)
+
+    def _send(self, request: Callable[[], T], estimated_tokens: int) -> T:
+        """
+        Send a request within the limits, retrying rate limit and transient errors.
+
+        Returns:
+            The response, with its in-flight slot still held. The caller must call _leave.
+        """
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._reserve(estimated_tokens))
+
+            self._enter()
+            try:
+                return request()
+            except retryable_errors() as e:
+                self._leave()
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(e, attempt)
+                record_retry(type(e).__name__)
+                logging.warning(f"Request failed ({type(e).__name__}), retrying in {delay:.1f} seconds")
+            except BaseException:
+                self._leave()
+                raise
+
+            time.sleep(delay)
+
+    async def _asend(self, request: Callable[[], Awaitable[T]], estimated_tokens: int) -> T:
+        """
+        The asynchronous version of _send.
+        """
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._reserve(estimated_tokens))
+
+            # The in-flight limit is shared with threads, so poll rather than block the event loop
+            while not self._try_enter():
+                await asyncio.sleep(0.01)
+
+            try:
+                return await request()
+            except retryable_errors() as e:
+                self._leave()
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(e, attempt)
+                record_retry(type(e).__name__)
+                logging.warning(f"Request failed ({type(e).__name__}), retrying in {delay:.1f} seconds")
+            except BaseException:
+                self._leave()
+                raise
+
+            await asyncio.sleep(delay)
+
+    def call(self, request: Callable[[], T], estimated_tokens: int = 0,
+             used_tokens: Callable[[T], Optional[int]] = None) -> T:
+        """
+        Run a request within the limits, retrying rate limit and transient errors.
+
+        Args:
+            request: Sends the request. If it returns a raw response, its rate limit headers are observed.
+            estimated_tokens: The estimated prompt and completion tokens of the request.
+            used_tokens: Returns the actual tokens used from the response, if known.
+        """
+        response = self._send(request, estimated_tokens)
+        try:
+            self._observe(getattr(response, 'headers', None), estimated_tokens,
+                          used_tokens(response) if used_tokens else None)
+        finally:
+            self._leave()
+        return response
+
+    async def acall(self, request: Callable[[], Awaitable[T]], estimated_tokens: int = 0,
+                    used_tokens: Callable[[T], Optional[int]] = None) -> T:
+        """
+        The asynchronous version of call, sharing the same limits.
+        """
+        response = await self._asend(request, estimated_tokens)
+        try:
+            self._observe(getattr(response, 'headers', None), estimated_tokens,
+                          used_tokens(response) if used_tokens else None)
+        finally:
+            self._leave()
+        return response
+
+    @contextlib.contextmanager
+    def hold(self, request: Callable[[], Any], estimated_tokens: int = 0) -> Iterator[HeldRequest]:
+        """
+        Run a request within the limits like call, but keep its in-flight slot until the block is left.
+
+        Streamed responses are still generating after the request returns, so the stream should be read and
+        closed inside the block. The token reservation is settled on leaving, against the used_tokens set on
+        the held request, if any.
+        """
+        held = HeldRequest(self._send(request, estimated_tokens))
+        try:
+            yield held
+        finally:
+            self._leave()
+            self._observe(getattr(held.response, 'headers', None), estimated_tokens, held.used_tokens)
+
+    @contextlib.asynccontextmanager
+    async def ahold(self, request: Callable[[], Awaitable[Any]],
+                    estimated_tokens: int = 0) -> AsyncIterator[HeldRequest]:
+        """
+        The asynchronous version of hold, sharing the same limits.
+        """
+        held = HeldRequest(await self._asend(request, estimated_tokens))
+        try:
+            yield held
+        finally:
+            self._leave()
+            self._observe(getattr(held.response, 'headers', None), estimated_tokens, held.used_tokens)
+
+def _env_float(name: str) -> Optional[float]:
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+_schedulers: dict[str, RateLimitScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(model: str) -> RateLimitScheduler:
+    """
+    Get the scheduler shared by every request to the given model in this process.
+
+    The limits are read from the OPENAI_RPM, OPENAI_TPM and OPENAI_MAX_IN_FLIGHT environment variables, unless
+    the scheduler was set up with configure_scheduler.
+    """
+    load_environment()
+    with _schedulers_lock:
+        if model not in _schedulers:
+            _schedulers[model] = RateLimitScheduler(
+                requests_per_minute=_env_float("OPENAI_RPM"),
+                tokens_per_minute=_env_float("OPENAI_TPM"),
+                max_in_flight=int(os.environ.get("OPENAI_MAX_IN_FLIGHT", 8)))
+        return _schedulers[model]
+
+def configure_scheduler(model: str, **kwargs) -> RateLimitScheduler:
+    """
+    Replace the shared scheduler of a model. See RateLimitScheduler for the arguments.
+    """
+    with _schedulers_lock:
+        _schedulers[model] = RateLimitScheduler(**kwargs)
+        return _schedulers[model]
+
+def raw_usage_tokens(response: Any) -> Optional[int]:
+    """
+    Get the total tokens used from a raw chat completion response.
+    """
+    usage = getattr(response.parse(), 'usage', None)
+    return usage.total_tokens if usage else None
@@ -0,0 +1,136 @@
+import threading
+import unicodedata
+from typing import NamedTuple, Optional
+
+from metrics import record_dedup
+from subtitles import IndexedSubtitle
+from translation_cache import normalize_text
+
+# Lines this short, such as "Yes" or "はい", are translated differently depending on what surrounds them, so they
+# are only shared between copies with the same neighbours
+SHORT_LINE_CHARS = 4
+
+# Dashes, quotes and other punctuation, but not brackets, so "[Music]" stays apart from a spoken "Music"
+_IGNORED_PUNCTUATION = {"Pc", "Pd", "Pi", "Pf", "Po"}
+# Closing quotes and brackets may follow the end of a sentence
+_CLOSING_PUNCTUATION = {"Pe", "Pf"}
+
+def _sentence_end(text: str) -> str:
+    for c in reversed(text):
+        if c.isspace() or c in "\"'" or unicodedata.category(c) in _CLOSING_PUNCTUATION:
+            continue
+        return c if c in "?!" else ""
+    return ""
+
+def dedup_key(text: str) -> str:
+    """
+    Normalize a line so that copies differing only in case, whitespace or punctuation share a key.
+
+    A question or exclamation mark ending the line is kept, as "He's coming?" is not translated like "He's coming."
+    """
+    text = normalize_text(text).casefold()
+    end = _sentence_end(text)
+    text = "".join(c for c in text if unicodedata.category(c) not in _IGNORED_PUNCTUATION)
+    return " ".join(text.split()) + end
+
+def _is_ambiguous(key: str) -> bool:
+    return len(key) <= SHORT_LINE_CHARS and any(unicodedata.category(c)[0] in "LN" for c in key)
+
+def line_keys(lines: list[IndexedSubtitle], before: Optional[str] = None, after: Optional[str] = None) -> list[str]:
+    """
+    Get the deduplication key of each line. Short lines are keyed together with their neighbours.
+
+    Args:
+        lines: Consecutive lines.
+        before: The text of the line preceding the first line, if known.
+        after: The text of the line following the last line, if known.
+    """
+    keys = [dedup_key(line.text) for line in lines]
+    neighbours = [dedup_key(before or "")] + keys + [dedup_key(after or "")]
+    return [f"{key}\x1f{neighbours[i]}\x1f{neighbours[i + 2]}" if _is_ambiguous(key) else key
+            for i, key in enumerate(keys)]
+
+class Deduplication(NamedTuple):
+    # The first copy of each line not translated earlier in the job, in order
+    unique: list[IndexedSubtitle]
+    # The index of every other copy -> the index of the unique line it shares a translation with
+    copies: dict[int, int]
+    # Lines translated earlier in the job, by index
+    known: dict[int, str]
+    # The key of every line, by index
+    keys: dict[int, str]
+
+class LineDeduplicator:
+    """
+    Translates repeated lines of a job once, such as "[Music]", "Thank you" or a chorus, and shares the translation
+    with every copy. Remembers the translations across the chunks of the job, and is safe to share between threads.
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.unique = 0
+        self._translations: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ratio(self) -> float:
+        """
+        The share of lines that did not have to be translated.
+        """
+        return 1 - self.unique / self.lines if self.lines else 0.0
+
+    def describe(self) -> str:
+        return f"{self.lines} lines, {self.unique} translated ({self.ratio:.0%} deduplicated)"
+
+    def deduplicate(self, lines: list[IndexedSubtitle], before: Optional[str] = None,
+                    after: Optional[str] = None) -> Deduplication:
+        """
+        Find the lines to translate. See line_keys for the arguments.
+        """
+        keys = dict(zip((line.index for line in lines), line_keys(lines, before, after)))
+        unique = []
+        copies = {}
+        known = {}
+        first: dict[str, int] = {}
+
+        with self._lock:
+            for line in lines:
+                key = keys[line.index]
+                if key in self._translations:
+                    known[line.index] = self._translations[key]
+                elif key in first:
+                    copies[line.index] = first[key]
+                else:
+                    first[key] = line.index
+                    unique.append(line)
+
+            self.lines += len(lines)
+            self.unique += len(unique)
+
+        record_dedup(len(lines), len(unique))
+        return Deduplication(unique, copies, known, keys)
+
+    def expand(self, deduplication: Deduplication, translations: dict[int, str]) -> dict[int, str]:
+        """
+        Share the translations of the unique lines with their copies, and remember them for later chunks.
+
+        Args:
+            deduplication: The result of deduplicate.
+            translations: The translations of the unique lines, by index. Lines that could not be translated
+                          must be left out, as every translation given is remembered.
+
+        Returns:
+            The translation of every line, by index. Copies of untranslated lines are left out.
+        """
+        with self._lock:
+            for line in deduplication.unique:
+                translation = translations.get(line.index)
+                if translation and translation.strip():
+                    self._translations.setdefault(deduplication.keys[line.index], translation)
+
+        expanded = dict(deduplication.known)
+        expanded.update((line.index, translations[line.index]) for line in deduplication.unique
+                        if line.index in translations)
+        expanded.update((index, translations[source]) for index, source in deduplication.copies.items()
+                        if source in translations)
+        return expanded
@@ -0,0 +1,150 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional, Union
+
+from metrics import RunMetrics
+from pipeline import stream_pipeline, translation_file_name
+from subtitles import timestamp_to_ms
+from youtube_downloader import extract_video_id
+
+class JobSnapshot(NamedTuple):
+    # One of 'queued', 'downloading', 'processing', 'done' or 'failed'
+    status: str
+    original_rows: list[dict]
+    # The translated rows of each target language
+    translated_rows: dict[str, list[dict]]
+    # Lines translated since the last translated rows of each language, as they are generated
+    streaming_rows: dict[str, list[dict]]
+    error: Optional[str]
+
+class PipelineJob:
+    """
+    A pipeline run in the background, writing to its own workspace and exposing its progress for polling.
+    """
+
+    def __init__(self, url: str, target_languages: list[str], workspace: str):
+        self.url = url
+        self.target_languages = target_languages
+        self.workspace = workspace
+        self.metrics = RunMetrics()
+
+        self._status = 'queued'
+        self._original_rows = []
+        self._translated_rows = {language: [] for language in target_languages}
+        self._streaming_rows = {language: {} for language in target_languages}
+        self._error = None
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self._status in ('done', 'failed')
+
+    def snapshot(self) -> JobSnapshot:
+        """
+        Get a consistent copy of the progress so far.
+        """
+        with self._lock:
+            translated_rows = {language: list(rows) for language, rows in self._translated_rows.items()}
+            streaming_rows = {language: sorted(rows.values(), key=lambda row: timestamp_to_ms(row["Start"]))
+                              for language, rows in self._streaming_rows.items()}
+            return JobSnapshot(self._status, list(self._original_rows), translated_rows, streaming_rows, self._error)
+
+    def result_path(self, name: str) -> str:
+        return os.path.join(self.workspace, name)
+
+    def translation_path(self, language: str) -> str:
+        return self.result_path(translation_file_name(language, self.target_languages))
+
+    def run(self):
+        with self._lock:
+            self._status = 'downloading'
+
+        try:
+            for event in stream_pipeline(self.url, self.target_languages, result_directory=self.workspace,
+                                         metrics=self.metrics):
+                with self._lock:
+                    if event.kind == 'downloaded':
+                        self._status = 'processing'
+                    elif event.kind == 'transcribed':
+                        self._original_rows.extend(event.rows)
+                    elif event.kind == 'streamed':
+                        for row in event.rows:
+                            self._streaming_rows[event.language][row["Start"]] = row
+                    elif event.kind == 'translated':
+                        self._translated_rows[event.language].extend(event.rows)
+                        for row in event.rows:
+                            self._streaming_rows[event.language].pop(row["Start"], None)
+
+            with self._lock:
+                self._status = 'done'
+        except Exception as e:
+            logging.exception(f"Job for {self.url} failed")
+            with self._lock:
+                self._status = 'failed'
+                self._error = str(e)
+
+class JobManager:
+    """
+    Runs pipeline jobs on a bounded executor, sharing one job between every request for the same video and
+    languages, so a finished result is served without running the pipeline again.
+    """
+
+    def __init__(self, workers: int = 2, max_finished_jobs: int = 32, workspace_root: str = None):
+        """
+        Args:
+            workers: The maximum number of videos processed at once. Further jobs are queued.
+            max_finished_jobs: The number of finished jobs kept, oldest first out, along with their workspaces.
+            workspace_root: Where the job workspaces are created. Defaults to the system temporary directory.
+        """
+        self.max_finished_jobs = max_finished_jobs
+        self.workspace_root = workspace_root
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._jobs: OrderedDict[tuple[str, tuple[str, ...]], PipelineJob] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url: str, target_languages: Union[str, list[str]]) -> tuple[str, tuple[str, ...]]:
+        if isinstance(target_languages, str):
+            target_languages = [target_languages]
+        return extract_video_id(url), tuple(language.strip() for language in target_languages)
+
+    def get(self, key: tuple[str, tuple[str, ...]]) -> Optional[PipelineJob]:
+        with self._lock:
+            return self._jobs.get(key)
+
+    def submit(self, url: str, target_languages: Union[str, list[str]]) \
+            -> tuple[tuple[str, tuple[str, ...]], PipelineJob]:
+        """
+        Start a job translating into every given language, unless one for the same video and languages is running
+        or has succeeded.
+
+        Returns:
+            The key of the job, and the job.
+        """
+        key = self.key(url, target_languages)
+
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.snapshot().status != 'failed':
+                self._jobs.move_to_end(key)
+                return key, job
+
+            if job is not None:
+                shutil.rmtree(job.workspace, ignore_errors=True)
+
+            job = PipelineJob(url, list(key[1]), tempfile.mkdtemp(prefix="job-", dir=self.workspace_root))
+            self._jobs[key] = job
+            self._evict()
+
+        self._executor.submit(job.run)
+        return key, job
+
+    def _evict(self):
+        finished = [key for key, job in self._jobs.items() if job.finished]
+        for key in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            shutil.rmtree(self._jobs.pop(key).workspace, ignore_errors=True)
@@ -0,0 +1,311 @@
+"""
+Timing, token and cost instrumentation.
+
+Every measurement is added to the process-wide metrics, and to the metrics of the run collecting in the current
+context (see collect), so a run can report where its own time and money went while other runs are active.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+# USD per 1000 prompt and completion tokens. Model versions use the price of the longest matching prefix.
+TOKEN_PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4-turbo": (0.01, 0.03),
+    "gpt-4-1106": (0.01, 0.03),
+    "gpt-4-0125": (0.01, 0.03),
+    "gpt-4o": (0.005, 0.015),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+# USD per minute of transcribed audio
+AUDIO_PRICES = {
+    "whisper-1": 0.006,
+}
+
+# Requests made through the Batch API are recorded under the model name with this prefix, and cost less
+BATCH_PREFIX = "batch:"
+BATCH_DISCOUNT = 0.5
+
+def model_entry(table: dict, model: str):
+    """
+    Get the entry of a model in a table keyed by model name prefixes, e.g. gpt-4o-2024-05-13 uses gpt-4o.
+
+    Returns:
+        The entry of the longest matching prefix, or None.
+    """
+    matches = [name for name in table if model.startswith(name)]
+    return table[max(matches, key=len)] if matches else None
+
+def estimate_cost(model: str, prompt_tokens: int = 0, completion_tokens: int = 0, audio_seconds: float = 0) -> float:
+    """
+    Estimate the cost of requests in USD. Unknown models are assumed to be free.
+    """
+    if model.startswith(BATCH_PREFIX):
+        return estimate_cost(model[len(BATCH_PREFIX):], prompt_tokens, completion_tokens, audio_seconds) * \
+            BATCH_DISCOUNT
+
+    cost = 0.0
+    token_price = model_entry(TOKEN_PRICES, model)
+    if token_price:
+        cost += prompt_tokens / 1000 * token_price[0] + completion_tokens / 1000 * token_price[1]
+    audio_price = model_entry(AUDIO_PRICES, model)
+    if audio_price:
+        cost += audio_seconds / 60 * audio_price
+    return cost
+
+class RunMetrics:
+    """
+    Thread-safe counters of stage timings, bytes, API usage, retries and cache lookups.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        # Stage name -> count, seconds, max_seconds, bytes
+        self._stages: dict[str, dict] = {}
+        # Model -> requests, prompt_tokens, completion_tokens, audio_seconds
+        self._models: dict[str, dict] = {}
+        # Reason -> count
+        self._retries: dict[str, int] = {}
+        self._cache = {"hits": 0, "misses": 0}
+        self._dedup = {"lines": 0, "unique": 0}
+
+    def _stage(self, stage: str) -> dict:
+        return self._stages.setdefault(stage, {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0})
+
+    def add_time(self, stage: str, seconds: float):
+        with self._lock:
+            entry = self._stage(stage)
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+    def add_bytes(self, stage: str, amount: int):
+        with self._lock:
+            self._stage(stage)["bytes"] += amount
+
+    def add_usage(self, model: str, prompt_tokens: int = 0, completion_tokens: int = 0, audio_seconds: float = 0):
+        with self._lock:
+            entry = self._models.setdefault(model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                                    "audio_seconds": 0.0})
+            entry["requests"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["audio_seconds"] += audio_seconds
+
+    def add_retry(self, reason: str):
+        with self._lock:
+            self._retries[reason] = self._retries.get(reason, 0) + 1
+
+    def add_cache_lookups(self, hits: int, misses: int):
+        with self._lock:
+            self._cache["hits"] += hits
+            self._cache["misses"] += misses
+
+    def add_dedup(self, lines: int, unique: int):
+        with self._lock:
+            self._dedup["lines"] += lines
+            self._dedup["unique"] += unique
+
+    def report(self) -> dict:
+        """
+        Get a snapshot of the metrics, with the estimated cost of each model.
+        """
+        with self._lock:
+            models = {}
+            for model, usage in self._models.items():
+                models[model] = dict(usage, cost=round(estimate_cost(model, usage["prompt_tokens"],
+                                                                     usage["completion_tokens"],
+                                                                     usage["audio_seconds"]), 6))
+
+            return {
+                "started": self.started,
+                "elapsed_seconds": round(time.time() - self.started, 3),
+                "stages": {stage: dict(entry) for stage, entry in self._stages.items()},
+                "models": models,
+                "retries": dict(self._retries),
+                "cache": dict(self._cache),
+                "dedup": dict(self._dedup, ratio=round(1 - self._dedup["unique"] / self._dedup["lines"], 4)
+                              if self._dedup["lines"] else 0.0),
+                "cost": round(sum(usage["cost"] for usage in models.values()), 6),
+            }
+
+    def save_report(self, path: str):
+        """
+        Save the report as JSON.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=4, ensure_ascii=False)
+
+    def to_prometheus(self, prefix: str = "youtube_extraction") -> str:
+        """
+        Format the metrics in the Prometheus text exposition format.
+        """
+        report = self.report()
+        lines = []
+
+        def metric(name: str, help: str, samples: list[tuple[dict, float]]):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}")
+
+        stages = report["stages"].items()
+        metric("stage_calls_total", "Number of times a stage ran.",
+               [({"stage": stage}, entry["count"]) for stage, entry in stages])
+        metric("stage_seconds_total", "Wall time spent in a stage.",
+               [({"stage": stage}, entry["seconds"]) for stage, entry in stages])
+        metric("stage_bytes_total", "Bytes produced or sent by a stage.",
+               [({"stage": stage}, entry["bytes"]) for stage, entry in stages])
+
+        models = report["models"].items()
+        metric("requests_total", "API requests that succeeded.",
+               [({"model": model}, usage["requests"]) for model, usage in models])
+        metric("tokens_total", "Tokens reported by the API.",
+               [({"model": model, "kind": kind}, usage[f"{kind}_tokens"])
+                for model, usage in models for kind in ("prompt", "completion")])
+        metric("audio_seconds_total", "Seconds of transcribed audio.",
+               [({"model": model}, usage["audio_seconds"]) for model, usage in models])
+        metric("cost_usd_total", "Estimated cost of the API requests.",
+               [({"model": model}, usage["cost"]) for model, usage in models])
+
+        metric("retries_total", "Requests that were retried.",
+               [({"reason": reason}, count) for reason, count in report["retries"].items()])
+        metric("cache_lookups_total", "Translation cache lookups.",
+               [({"result": result}, count) for result, count in report["cache"].items()])
+        metric("dedup_lines_total", "Lines to translate, and the distinct lines among them that were translated.",
+               [({"kind": kind}, report["dedup"][kind]) for kind in ("lines", "unique")])
+
+        return "\n".join(lines) + "\n"
+
+_global_metrics = RunMetrics()
+_current_run: contextvars.ContextVar[Optional[RunMetrics]] = contextvars.ContextVar("current_run", default=None)
+
+def get_metrics() -> RunMetrics:
+    """
+    Get the metrics of the whole process.
+    """
+    return _global_metrics
+
+@contextlib.contextmanager
+def collect(metrics: RunMetrics = None):
+    """
+    Collect the measurements made in the current context, and in threads started from it through
+    utils.ordered_imap and utils.prefetch, into the given metrics.
+    """
+    metrics = metrics if metrics is not None else RunMetrics()
+    token = _current_run.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_run.reset(token)
+
+def _targets() -> list[RunMetrics]:
+    run = _current_run.get()
+    return [_global_metrics, run] if run is not None and run is not _global_metrics else [_global_metrics]
+
+@contextlib.contextmanager
+def timed(stage: str):
+    """
+    Measure the wall time of a stage, even if it fails.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        for metrics in _targets():
+            metrics.add_time(stage, elapsed)
+
+def record_bytes(stage: str, amount: int):
+    for metrics in _targets():
+        metrics.add_bytes(stage, amount)
+
+def record_file(stage: str, path: str):
+    """
+    Record the size of a file produced by a stage.
+    """
+    try:
+        record_bytes(stage, os.path.getsize(path))
+    except OSError:
+        pass
+
+def record_usage(model: str, prompt_tokens: int = 0, completion_tokens: int = 0, audio_seconds: float = 0):
+    for metrics in _targets():
+        metrics.add_usage(model, prompt_tokens, completion_tokens, audio_seconds)
+
+def usage_tokens(usage) -> tuple[int, int]:
+    """
+    Get the prompt and completion tokens of the usage reported by the API.
+    """
+    if usage is None:
+        return 0, 0
+    # Older versions of the library keep unknown fields, such as the usage of a streamed chunk, as dictionaries
+    if isinstance(usage, dict):
+        return usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0
+    return usage.prompt_tokens or 0, usage.completion_tokens or 0
+
+def record_completion_usage(model: str, completion):
+    """
+    Record the usage of a parsed chat completion.
+    """
+    record_usage(model, *usage_tokens(getattr(completion, "usage", None)))
+
+def record_retry(reason: str):
+    for metrics in _targets():
+        metrics.add_retry(reason)
+
+def record_cache_lookups(hits: int, misses: int):
+    for metrics in _targets():
+        metrics.add_cache_lookups(hits, misses)
+
+def record_dedup(lines: int, unique: int):
+    for metrics in _targets():
+        metrics.add_dedup(lines, unique)
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> "ThreadingHTTPServer":
+    """
+    Serve the process-wide metrics on a background thread, in the Prometheus format at /metrics and as a JSON
+    report at /report.
+    """
+    # Imported here, as most runs never serve the metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = get_metrics().to_prometheus(), "text/plain; version=0.0.4"
+            elif self.path == "/report":
+                body, content_type = json.dumps(get_metrics().report(), ensure_ascii=False), "application/json"
+            else:
+                self.send_error(404)
+                return
+
+            body = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
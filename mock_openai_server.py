@@ -0,0 +1,428 @@
+"""
+A local stand-in for the OpenAI endpoints used by this project, for benchmarks and offline testing.
+
+Chat completions "translate" indexed subtitles by prefixing each line, and transcriptions return a synthetic
+SRT whose length depends on the size of the uploaded file. Batches of chat completions can be uploaded as JSONL
+files and run through the batch endpoints. Latency, rate limit errors and wrong line counts can be injected.
+
+Run it on its own and point the clients at it:
+
+    python mock_openai_server.py --port 8000 --latency 0.2
+    OPENAI_BASE_URL=http://127.0.0.1:8000/v1 OPENAI_API_KEY=mock python OpenAI_Translator.py in.srt out.srt
+"""
+import argparse
+import email.parser
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from subtitles import Cue, IndexedSubtitle, format_srt, indexed_subtitles_to_text, parse_indexed_subtitles
+from tokens import estimate_tokens
+
+@dataclass
+class MockConfig:
+    # Seconds to wait before answering any request
+    latency: float = 0.05
+    # Additional seconds per generated completion token
+    latency_per_token: float = 0.0
+    # Probability that a request is rejected with a 429 error
+    rate_limit_probability: float = 0.0
+    # Probability that a translation drops or merges a line
+    wrong_line_count_probability: float = 0.0
+    # Probability that a translation keeps going with many subtitles that were not asked for
+    runaway_probability: float = 0.0
+    # Bytes of uploaded audio per transcribed cue
+    audio_bytes_per_cue: int = 8000
+    # Seconds a batch takes to complete once created
+    batch_seconds: float = 1.0
+    # Probability that a request of a batch fails with a server error
+    batch_error_probability: float = 0.0
+    seed: int = None
+
+@dataclass
+class MockStats:
+    requests: dict = field(default_factory=dict)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    rate_limited: int = 0
+    wrong_line_counts: int = 0
+    runaways: int = 0
+    # Streamed completions closed by the client before the end
+    aborted: int = 0
+    # Requests of batches that failed on purpose
+    batch_errors: int = 0
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config: MockConfig = None):
+        super().__init__(address, _Handler)
+        self.config = config or MockConfig()
+        self.stats = MockStats()
+        self.random = random.Random(self.config.seed)
+        self.lock = threading.Lock()
+        # File ID -> metadata and content, and batch ID -> batch object
+        self.files: dict[str, tuple[dict, bytes]] = {}
+        self.batches: dict[str, dict] = {}
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, endpoint: str, prompt_tokens: int = 0, completion_tokens: int = 0):
+        with self.lock:
+            self.stats.requests[endpoint] = self.stats.requests.get(endpoint, 0) + 1
+            self.stats.prompt_tokens += prompt_tokens
+            self.stats.completion_tokens += completion_tokens
+
+    def chance(self, probability: float) -> bool:
+        with self.lock:
+            return probability > 0 and self.random.random() < probability
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = MockStats()
+
+    def add_file(self, filename: str, purpose: str, content: bytes) -> dict:
+        metadata = {"id": f"file-{uuid.uuid4().hex}", "object": "file", "bytes": len(content),
+                    "created_at": int(time.time()), "filename": filename, "purpose": purpose, "status": "processed"}
+        with self.lock:
+            self.files[metadata["id"]] = (metadata, content)
+        return metadata
+
+    def run_batch(self, batch_id: str):
+        """
+        Answer every request of a batch after the configured delay, writing the output and error files.
+        """
+        with self.lock:
+            batch = self.batches[batch_id]
+            batch.update(status="in_progress", in_progress_at=int(time.time()))
+            _, content = self.files[batch["input_file_id"]]
+        time.sleep(self.config.batch_seconds)
+
+        output, errors = [], []
+        for line in content.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            result = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"]}
+
+            if self.chance(self.config.batch_error_probability):
+                with self.lock:
+                    self.stats.batch_errors += 1
+                result.update(response={"status_code": 500, "request_id": uuid.uuid4().hex,
+                                        "body": {"error": {"message": "Server error (mock)", "type": "server_error"}}},
+                              error=None)
+                errors.append(result)
+                continue
+
+            body, prompt_tokens, completion_tokens = completion_body(request["body"], self)
+            self.count("batch.chat.completions", prompt_tokens, completion_tokens)
+            result.update(response={"status_code": 200, "request_id": uuid.uuid4().hex, "body": body}, error=None)
+            output.append(result)
+
+        def jsonl(results: list[dict]) -> bytes:
+            return "".join(json.dumps(result, ensure_ascii=False) + "\n" for result in results).encode("utf-8")
+
+        output_file = self.add_file(f"{batch_id}_output.jsonl", "batch_output", jsonl(output))
+        error_file = self.add_file(f"{batch_id}_error.jsonl", "batch_output", jsonl(errors)) if errors else None
+        with self.lock:
+            batch.update(status="completed", completed_at=int(time.time()), output_file_id=output_file["id"],
+                         error_file_id=error_file["id"] if error_file else None,
+                         request_counts={"total": len(output) + len(errors), "completed": len(output),
+                                         "failed": len(errors)})
+
+def translate_prompt(content: str, server: MockOpenAIServer) -> str:
+    """
+    Produce a fake translation of every indexed subtitle in a prompt.
+    """
+    subtitles = [IndexedSubtitle(subtitle.index, f"[번역] {subtitle.text.strip()}")
+                 for subtitle in parse_indexed_subtitles(content)]
+    if not subtitles:
+        return "OK"
+
+    if len(subtitles) > 1 and server.chance(server.config.wrong_line_count_probability):
+        with server.lock:
+            server.stats.wrong_line_counts += 1
+            position = server.random.randrange(len(subtitles) - 1)
+            merge = server.random.random() < 0.5
+
+        if merge:
+            merged = subtitles[position]
+            subtitles[position] = IndexedSubtitle(merged.index, f"{merged.text}\n{subtitles[position + 1].text}")
+        del subtitles[position + 1]
+
+    if server.chance(server.config.runaway_probability):
+        with server.lock:
+            server.stats.runaways += 1
+        last = subtitles[-1].index
+        subtitles += [IndexedSubtitle(last + offset, "[번역] ...") for offset in range(1, 10 * len(subtitles) + 1)]
+
+    return indexed_subtitles_to_text(subtitles)
+
+def completion_body(request: dict, server: MockOpenAIServer) -> tuple[dict, int, int]:
+    """
+    Answer a chat completion request.
+
+    Returns:
+        The chat completion, and its prompt and completion tokens.
+    """
+    messages = request.get("messages", [])
+    prompt = next((message["content"] for message in reversed(messages) if message["role"] == "user"), "")
+    reply = translate_prompt(prompt, server)
+
+    prompt_tokens = sum(estimate_tokens(message["content"]) + 4 for message in messages) + 3
+    completion_tokens = estimate_tokens(reply)
+
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "mock"),
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": reply}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }, prompt_tokens, completion_tokens
+
+class _Handler(BaseHTTPRequestHandler):
+    server: MockOpenAIServer
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which Nagle's algorithm would delay
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status: int, body, content_type: str = "application/json", headers: dict = None):
+        if not isinstance(body, (bytes, str)):
+            body = json.dumps(body, ensure_ascii=False)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _rate_limited(self) -> bool:
+        if not self.server.chance(self.server.config.rate_limit_probability):
+            return False
+
+        with self.server.lock:
+            self.server.stats.rate_limited += 1
+        self._send(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error",
+                                   "code": "rate_limit_exceeded"}},
+                   headers={"retry-after-ms": "200", "x-ratelimit-remaining-requests": "0",
+                            "x-ratelimit-reset-requests": "200ms"})
+        return True
+
+    def _not_found(self):
+        self._send(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_GET(self):
+        # /v1/files/<id>, /v1/files/<id>/content or /v1/batches/<id>
+        parts = self.path.split("?")[0].strip("/").split("/")[1:]
+
+        if self.path == "/stats":
+            with self.server.lock:
+                self._send(200, asdict(self.server.stats))
+        elif len(parts) in (2, 3) and parts[0] == "files" and parts[1] in self.server.files:
+            metadata, content = self.server.files[parts[1]]
+            if len(parts) == 2:
+                self._send(200, metadata)
+            elif parts[2] == "content":
+                self._send(200, content, content_type="application/octet-stream")
+            else:
+                self._not_found()
+        elif len(parts) == 2 and parts[0] == "batches" and parts[1] in self.server.batches:
+            with self.server.lock:
+                self._send(200, dict(self.server.batches[parts[1]]))
+        else:
+            self._not_found()
+
+    def do_POST(self):
+        body = self._read_body()
+        time.sleep(self.server.config.latency)
+
+        if self.path == "/reset":
+            self.server.reset_stats()
+            self._send(200, {})
+        elif self.path.endswith("/chat/completions"):
+            if not self._rate_limited():
+                self._chat_completion(json.loads(body))
+        elif self.path.endswith("/audio/transcriptions"):
+            if not self._rate_limited():
+                self._transcription(body)
+        elif self.path.endswith("/files"):
+            fields = self._form_fields(body)
+            self.server.count("files")
+            self._send(200, self.server.add_file(fields.get("filename", "upload"),
+                                                 (fields.get("purpose") or b"batch").decode(), fields.get("file") or b""))
+        elif self.path.endswith("/batches"):
+            self._create_batch(json.loads(body))
+        else:
+            self._not_found()
+
+    def _form_fields(self, body: bytes) -> dict:
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("latin-1") + body)
+
+        fields = {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = part.get_payload(decode=True)
+            if part.get_filename():
+                fields["filename"] = part.get_filename()
+        return fields
+
+    def _create_batch(self, request: dict):
+        if request.get("input_file_id") not in self.server.files:
+            self._send(400, {"error": {"message": "Unknown input file", "type": "invalid_request_error"}})
+            return
+
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": request.get("endpoint"),
+            "input_file_id": request["input_file_id"],
+            "completion_window": request.get("completion_window", "24h"),
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": request.get("metadata"),
+        }
+        with self.server.lock:
+            self.server.batches[batch["id"]] = batch
+            created = dict(batch)
+        self.server.count("batches")
+        threading.Thread(target=self.server.run_batch, args=(batch["id"],), daemon=True).start()
+        self._send(200, created)
+
+    def _chat_completion(self, request: dict):
+        body, prompt_tokens, completion_tokens = completion_body(request, self.server)
+
+        if request.get("stream"):
+            self._stream_chat_completion(request, body["choices"][0]["message"]["content"], prompt_tokens)
+            return
+
+        self.server.count("chat.completions", prompt_tokens, completion_tokens)
+        time.sleep(self.server.config.latency_per_token * completion_tokens)
+
+        self._send(200, body, headers={"x-ratelimit-remaining-requests": "10000",
+                                       "x-ratelimit-remaining-tokens": "1000000"})
+
+    def _stream_chat_completion(self, request: dict, reply: str, prompt_tokens: int):
+        # Server-sent events, ending the response by closing the connection
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def chunk(delta: dict, finish_reason: str = None, usage: dict = None) -> bytes:
+            choices = [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else []
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                       "model": request.get("model", "mock"), "choices": choices}
+            if usage:
+                payload["usage"] = usage
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        sent_tokens = 0
+        try:
+            self.wfile.write(chunk({"role": "assistant", "content": ""}))
+            # A few characters at a time, like tokens
+            for start in range(0, len(reply), 8):
+                piece = reply[start:start + 8]
+                time.sleep(self.server.config.latency_per_token * estimate_tokens(piece))
+                self.wfile.write(chunk({"content": piece}))
+                self.wfile.flush()
+                sent_tokens += estimate_tokens(piece)
+
+            self.wfile.write(chunk({}, finish_reason="stop"))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                self.wfile.write(chunk(None, usage={"prompt_tokens": prompt_tokens, "completion_tokens": sent_tokens,
+                                                    "total_tokens": prompt_tokens + sent_tokens}))
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client aborted the generation
+            with self.server.lock:
+                self.server.stats.aborted += 1
+        finally:
+            self.server.count("chat.completions", prompt_tokens, sent_tokens)
+
+    def _transcription(self, body: bytes):
+        fields = self._form_fields(body)
+
+        size = len(fields.get("file") or b"")
+        cues = [Cue(index, (index - 1) * 3000, (index - 1) * 3000 + 2500, f"Transcribed line {index}")
+                for index in range(1, max(1, size // self.server.config.audio_bytes_per_cue) + 1)]
+        self.server.count("audio.transcriptions", completion_tokens=len(cues) * 5)
+
+        response_format = (fields.get("response_format") or b"json").decode()
+        if response_format == "srt":
+            self._send(200, format_srt(cues), content_type="text/plain; charset=utf-8")
+        else:
+            self._send(200, {"text": " ".join(cue.text for cue in cues)})
+
+def start_mock_server(config: MockConfig = None, host: str = "127.0.0.1", port: int = 0) -> MockOpenAIServer:
+    """
+    Start the mock server on a background thread.
+
+    Args:
+        config: The behaviour of the server.
+        host: The address to listen on.
+        port: The port to listen on, or 0 for any free port.
+
+    Returns:
+        The running server. Its base_url can be used as OPENAI_BASE_URL, and shutdown() stops it.
+    """
+    server = MockOpenAIServer((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the OpenAI API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before answering a request.")
+    parser.add_argument("--latency-per-token", type=float, default=0.0,
+                        help="Additional seconds per completion token.")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0,
+                        help="Probability that a request is rejected with a 429 error.")
+    parser.add_argument("--wrong-line-count-probability", type=float, default=0.0,
+                        help="Probability that a translation drops or merges a line.")
+    parser.add_argument("--runaway-probability", type=float, default=0.0,
+                        help="Probability that a translation keeps going with subtitles that were not asked for.")
+    parser.add_argument("--batch-seconds", type=float, default=1.0,
+                        help="Seconds a batch takes to complete once created.")
+    parser.add_argument("--batch-error-probability", type=float, default=0.0,
+                        help="Probability that a request of a batch fails with a server error.")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer((args.host, args.port), MockConfig(
+        latency=args.latency, latency_per_token=args.latency_per_token,
+        rate_limit_probability=args.rate_limit_probability,
+        wrong_line_count_probability=args.wrong_line_count_probability,
+        runaway_probability=args.runaway_probability, batch_seconds=args.batch_seconds,
+        batch_error_probability=args.batch_error_probability, seed=args.seed))
+    print(f"Serving on {server.base_url}")
+    server.serve_forever()
@@ -0,0 +1,201 @@
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import tempfile
+import threading
+from typing import Generator, NamedTuple, Optional, Union
+
+from audio_store import AudioStore
+from clients.openai_factory import prewarm
+from dedup import LineDeduplicator
+from audio_tools import Silence, iter_split_on_silence, load_silence_map, map_to_source_time, silence_map_path
+from metrics import RunMetrics, collect, record_file, timed
+from subtitles import Cue, format_srt, format_timestamp, parse_srt, timestamp_to_ms
+from translator import translate_segments_languages
+from utils import language_path, ordered_imap, prefetch
+from whisper_extractor import MAX_UPLOAD_BYTES, transcribe_file
+from youtube_downloader import download_and_convert_to_mp3
+
+class PipelineEvent(NamedTuple):
+    # One of 'downloaded', 'transcribed', 'streamed' or 'translated'. A 'streamed' event carries a translated
+    # line as soon as it has been generated, in no particular order, and may be superseded by the 'translated' rows.
+    kind: str
+    # The transcribed or translated rows (Start, End, Text) produced by this step
+    rows: list[dict]
+    # The audio file, for 'downloaded' events
+    path: Optional[str] = None
+    # The target language of 'streamed' and 'translated' events
+    language: Optional[str] = None
+
+class StageLimits:
+    """
+    Concurrency limits for each stage, shared by all pipelines using the same instance.
+    """
+
+    def __init__(self, download: int = None, transcribe: int = None, translate: int = None):
+        """
+        Args:
+            download: The maximum number of downloads at once, or None for no limit.
+            transcribe: The maximum number of transcription requests at once, or None for no limit.
+            translate: The maximum number of segment translations at once, or None for no limit.
+        """
+        self.download = self._limit(download)
+        self.transcribe = self._limit(transcribe)
+        self.translate = self._limit(translate)
+
+    @staticmethod
+    def _limit(value: Optional[int]):
+        return threading.BoundedSemaphore(value) if value else contextlib.nullcontext()
+
+_DONE = object()
+
+def _transcript_rows(text: str, offset: float, removed: list[Silence]) -> list[dict]:
+    rows = []
+    for cue in parse_srt(text):
+        # Shift to the position of the segment, then undo the removed silences
+        start = map_to_source_time(offset + cue.start / 1000, removed)
+        end = map_to_source_time(offset + cue.end / 1000, removed)
+        rows.append({
+            "Start": format_timestamp(round(start * 1000)),
+            "End": format_timestamp(round(end * 1000)),
+            "Text": cue.text,
+        })
+    return rows
+
+def rows_to_srt(rows: list[dict]) -> str:
+    """
+    Format Start/End/Text rows as an SRT file.
+    """
+    return format_srt(Cue(index, timestamp_to_ms(row["Start"]), timestamp_to_ms(row["End"]), row["Text"])
+                      for index, row in enumerate(rows, start=1))
+
+def translation_file_name(language: str, languages: list[str]) -> str:
+    """
+    Get the file name of the translation into one of the target languages of a pipeline.
+    """
+    name = "translated_with_timestamp.json"
+    return name if len(languages) == 1 else language_path(name, language)
+
+def stream_pipeline(url: str, target_language: Union[str, list[str]], segment_seconds: float = 120,
+                    transcribe_workers: int = 3, translate_workers: int = 2, store: AudioStore = None,
+                    result_directory: str = "./result/", limits: StageLimits = None,
+                    metrics: RunMetrics = None, trim_silence: bool = True) -> Generator[PipelineEvent, None, None]:
+    """
+    Download, transcribe and translate a YouTube video as overlapping stages.
+
+    The audio is split at silences into short segments. Each segment is transcribed as soon as it has been cut,
+    and each transcribed segment is translated as soon as it has been transcribed, so the first translated
+    lines are available long before the whole video has been processed.
+
+    Args:
+        url: The URL of the video.
+        target_language: The language to translate to, or several languages. The video is downloaded and
+                         transcribed once, and each segment is translated into every language at once.
+        segment_seconds: The maximum duration of an audio segment.
+        transcribe_workers: The number of segments transcribed concurrently.
+        translate_workers: The number of transcribed segments translated concurrently.
+        store: The audio store to download to.
+        result_directory: Where to save the full transcript and translation once done. With several languages,
+                          each translation is saved as translated_with_timestamp.<language>.json.
+        limits: Limits shared with other pipelines running at the same time.
+        metrics: Collects the timings, token usage and cost of this video only.
+        trim_silence: Whether to remove long silences from the audio before transcribing it. The timestamps
+                      refer to the original video either way.
+
+    Returns:
+        A generator of events. Transcribed and translated rows are in timestamp order, streamed lines are not.
+    """
+    languages = [target_language] if isinstance(target_language, str) else list(target_language)
+    events = queue.Queue()
+    limits = limits or StageLimits()
+    metrics = metrics if metrics is not None else RunMetrics()
+
+    def run(segment_directory: str):
+        try:
+            # The client library loads while the audio downloads
+            prewarm()
+            with limits.download:
+                # The job works on its own copy, which other jobs filling the store cannot delete
+                path = download_and_convert_to_mp3(url, store, profile='speech', workspace=segment_directory,
+                                                   trim_silence=trim_silence)
+            removed = load_silence_map(silence_map_path(path))
+            events.put(PipelineEvent('downloaded', [], path))
+
+            segments = prefetch(iter_split_on_silence(path, segment_directory, max_duration=segment_seconds,
+                                                      max_bytes=MAX_UPLOAD_BYTES, workers=transcribe_workers))
+
+            def transcribe(segment) -> list[dict]:
+                with limits.transcribe:
+                    return _transcript_rows(transcribe_file(segment.path), segment.start, removed)
+
+            # Repeated lines are translated once per language for the whole video
+            deduplicators = {language: LineDeduplicator() for language in languages}
+
+            def translate(rows: list[dict]) -> dict[str, list[dict]]:
+                if not rows:
+                    return {language: [] for language in languages}
+                def stream_line(language, line):
+                    events.put(PipelineEvent('streamed', [dict(rows[line.index - 1], Text=line.text)],
+                                             language=language))
+
+                with limits.translate:
+                    return translate_segments_languages(rows, languages, on_line=stream_line,
+                                                        deduplicators=deduplicators)
+
+            def publish_transcribed(transcribed):
+                for rows in transcribed:
+                    events.put(PipelineEvent('transcribed', rows))
+                    yield rows
+
+            transcribed = prefetch(publish_transcribed(ordered_imap(transcribe, segments, transcribe_workers)))
+
+            for translated in ordered_imap(translate, transcribed, translate_workers):
+                for language, rows in translated.items():
+                    events.put(PipelineEvent('translated', rows, language=language))
+
+            events.put(_DONE)
+        except BaseException as e:
+            events.put(e)
+
+    original_rows = []
+    translated_rows = {language: [] for language in languages}
+
+    with tempfile.TemporaryDirectory() as segment_directory:
+        with collect(metrics):
+            # The thread, and the threads it starts, inherit the context and so report to the metrics of this run
+            threading.Thread(target=contextvars.copy_context().run, args=(run, segment_directory),
+                             daemon=True).start()
+
+        while True:
+            event = events.get()
+            if event is _DONE:
+                break
+            if isinstance(event, BaseException):
+                raise event
+
+            if event.kind == 'transcribed':
+                original_rows.extend(event.rows)
+            elif event.kind == 'translated':
+                translated_rows[event.language].extend(event.rows)
+            yield event
+
+    os.makedirs(result_directory, exist_ok=True)
+    transcript_path = os.path.join(result_directory, "원본_텍스트.srt")
+
+    with collect(metrics), timed("output"):
+        with open(transcript_path, "w", encoding="utf-8") as f:
+            f.write(rows_to_srt(original_rows))
+        record_file("output", transcript_path)
+
+        for language, rows in translated_rows.items():
+            translation_path = os.path.join(result_directory, translation_file_name(language, languages))
+            with open(translation_path, "w", encoding="utf-8") as f:
+                json.dump(rows, f, indent=4, ensure_ascii=False)
+            record_file("output", translation_path)
+
+if __name__ == "__main__":
+    for event in stream_pipeline(input("Youtube URL : "), "English"):
+        for row in event.rows:
+            print(f"[{event.kind}] {row['Start']} --> {row['End']} {row['Text']}")
@@ -0,0 +1,281 @@
+"""
+Plan translation jobs without calling OpenAI: how many requests and tokens translating subtitle files takes, what it
+costs on each model, and how long it runs at a given concurrency and rate limits.
+
+The files are chunked and deduplicated like in a real run, and every prompt is added to a thread with the same
+history settings, so the prompt tokens include the earlier chunks sent again as context. Translations are assumed
+to have as many tokens as their source, times the completion ratio. Retries of misaligned responses are not counted.
+
+    python planner.py subtitles/ --target-lang English Korean --workers 8 --tpm 90000
+"""
+import argparse
+import heapq
+import json
+import math
+from collections import defaultdict
+from dataclasses import replace
+from typing import NamedTuple, Optional
+
+from OpenAI_Translator import SYSTEM_PROMPT, build_prompt, create_chunk_thread
+from bulk_translate import find_subtitle_files
+from clients.gpt_client import GptClient, Message, MemoryGptMessageOptions, MemoryGptThread, MemoryGptThreadOptions
+from dedup import LineDeduplicator
+from metrics import BATCH_PREFIX, TOKEN_PRICES, estimate_cost, model_entry
+from subtitles import IndexedSubtitle, chunk_cues, indexed_subtitles_to_text, read_cues
+from tokens import get_tokenizer
+
+# Completion tokens generated per second. Model versions use the speed of the longest matching prefix.
+GENERATION_SPEEDS = {
+    "gpt-4": 20,
+    "gpt-4-turbo": 30,
+    "gpt-4-1106": 30,
+    "gpt-4-0125": 30,
+    "gpt-4o": 80,
+    "gpt-4o-mini": 90,
+    "gpt-3.5-turbo": 80,
+}
+DEFAULT_GENERATION_SPEED = 30
+# The time before the first completion token, including the prompt
+FIRST_TOKEN_SECONDS = 0.6
+
+class PlannedRequest(NamedTuple):
+    path: str
+    language: str
+    # The position of the chunk in its file
+    chunk: int
+    # The number of lines sent, after deduplication
+    lines: int
+    prompt_tokens: int
+    completion_tokens: int
+
+class _PlanningClient(GptClient):
+    # Only creates threads, counting tokens like the API client
+    def __init__(self, model: str):
+        super().__init__()
+        self.model = model
+        self._tokenizer = get_tokenizer(model)
+
+    def create_thread(self, thread_options: MemoryGptThreadOptions = None) -> MemoryGptThread:
+        thread_options = thread_options or MemoryGptThreadOptions()
+        if thread_options.tokenizer is None:
+            thread_options = replace(thread_options, tokenizer=self._tokenizer)
+        return MemoryGptThread(thread_options)
+
+def plan_file(path: str, target_languages: list[str], source_lang: str = "Japanese", model: str = "gpt-4",
+              workers: int = 1, chunk_tokens: int = 1000, chunk_lines: int = 60, context_tokens: int = 4000,
+              dedup: bool = True, completion_ratio: float = 1.0) -> list[PlannedRequest]:
+    """
+    Plan the requests translating a subtitle file, like process_srt_languages with the API client.
+
+    Args:
+        path: The SRT or VTT file.
+        target_languages: The languages translated into, each with its own requests.
+        workers: The number of chunks translated concurrently. With more than one, each chunk is sent in a new
+                 thread with the previous chunk as context, instead of in one thread keeping the history.
+        context_tokens: The maximum number of tokens of earlier chunks kept in the history of a thread.
+        dedup: Whether repeated lines are translated once.
+        completion_ratio: The number of tokens of a translation per token of its source.
+    """
+    client = _PlanningClient(model)
+    tokenizer = get_tokenizer(model)
+    requests = []
+
+    for language in target_languages:
+        thread = client.create_thread(MemoryGptThreadOptions(max_window_tokens=context_tokens))
+        thread.add_message(Message(role="system", content=SYSTEM_PROMPT),
+                           MemoryGptMessageOptions(preserve_message=True))
+        deduplicator = LineDeduplicator() if dedup else None
+
+        previous_lines = None
+        chunks = list(chunk_cues(read_cues(path), max_tokens=chunk_tokens, max_lines=chunk_lines, tokenizer=tokenizer))
+        for number, chunk in enumerate(chunks):
+            lines = [IndexedSubtitle(cue.index, cue.text) for cue in chunk]
+            to_translate = lines
+            if deduplicator is not None:
+                deduplication = deduplicator.deduplicate(
+                    lines, before=previous_lines[-1].text if previous_lines else None,
+                    after=chunks[number + 1][0].text if number + 1 < len(chunks) else None)
+                to_translate = deduplication.unique
+                # The source stands in for the translation, so later copies count as known
+                deduplicator.expand(deduplication, {line.index: line.text for line in to_translate})
+
+            if to_translate:
+                chunk_thread = create_chunk_thread(client, thread, previous_lines) if workers > 1 else thread
+                chunk_thread.add_message(Message(role="user",
+                                                 content=build_prompt(to_translate, source_lang, language)))
+                answer = indexed_subtitles_to_text(to_translate)
+                requests.append(PlannedRequest(path, language, number, len(to_translate), chunk_thread.prompt_tokens(),
+                                               math.ceil(tokenizer(answer) * completion_ratio)))
+                chunk_thread.add_message(Message(role="assistant", content=answer))
+
+            previous_lines = lines
+
+    return requests
+
+class _SimulatedBucket:
+    # The token bucket of clients.rate_limiter.TokenBucket, on a simulated clock
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self._available = per_minute
+        self._updated = 0.0
+
+    def reserve(self, amount: float, now: float) -> float:
+        # Requests are simulated in order, so a reservation never goes back in time
+        now = max(now, self._updated)
+        self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+        self._updated = now
+        self._available -= min(amount, self.capacity)
+        return now + max(0.0, -self._available / self.rate)
+
+def project_wall_time(requests: list[PlannedRequest], model: str, workers: int = 1,
+                      requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                      max_in_flight: int = 8, tokens_per_second: Optional[float] = None) -> float:
+    """
+    Project the seconds the requests take, translating the files one after another.
+
+    The chunks of a file are translated by the given number of workers, with every language of a chunk at once.
+    Requests wait for a free slot among max_in_flight, and for the rate limits like the rate limit scheduler.
+
+    Args:
+        tokens_per_second: The generation speed, defaulting to the speed of the model in GENERATION_SPEEDS.
+    """
+    speed = tokens_per_second or model_entry(GENERATION_SPEEDS, model) or DEFAULT_GENERATION_SPEED
+    request_bucket = _SimulatedBucket(requests_per_minute) if requests_per_minute else None
+    token_bucket = _SimulatedBucket(tokens_per_minute) if tokens_per_minute else None
+    # The end of each request in flight
+    in_flight = []
+    end = 0.0
+
+    files = defaultdict(lambda: defaultdict(list))
+    for request in requests:
+        files[request.path][request.chunk].append(request)
+
+    for chunks in files.values():
+        # The time each worker is free
+        free_workers = [end] * max(workers, 1)
+        for number in sorted(chunks):
+            start = heapq.heappop(free_workers)
+            finish = start
+            for request in chunks[number]:
+                begin = start
+                if len(in_flight) >= max_in_flight:
+                    begin = max(begin, heapq.heappop(in_flight))
+                if request_bucket:
+                    begin = request_bucket.reserve(1, begin)
+                if token_bucket:
+                    begin = token_bucket.reserve(request.prompt_tokens + request.completion_tokens, begin)
+
+                done = begin + FIRST_TOKEN_SECONDS + request.completion_tokens / speed
+                heapq.heappush(in_flight, done)
+                finish = max(finish, done)
+
+            heapq.heappush(free_workers, finish)
+            end = max(end, finish)
+
+    return end
+
+def plan_report(requests: list[PlannedRequest], models: list[str], **wall_time_options) -> dict:
+    """
+    Summarize planned requests per file, and their cost and wall time on each model.
+
+    Args:
+        wall_time_options: The concurrency and rate limits, see project_wall_time.
+    """
+    files = {}
+    for request in requests:
+        totals = files.setdefault(request.path, {"chunks": set(), "requests": 0, "lines": 0,
+                                                 "prompt_tokens": 0, "completion_tokens": 0})
+        totals["chunks"].add(request.chunk)
+        totals["requests"] += 1
+        totals["lines"] += request.lines
+        totals["prompt_tokens"] += request.prompt_tokens
+        totals["completion_tokens"] += request.completion_tokens
+    for totals in files.values():
+        totals["chunks"] = len(totals["chunks"])
+
+    prompt_tokens = sum(request.prompt_tokens for request in requests)
+    completion_tokens = sum(request.completion_tokens for request in requests)
+    return {
+        "requests": len(requests),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "files": files,
+        "models": {model: {"cost_usd": round(estimate_cost(model, prompt_tokens, completion_tokens), 6),
+                           "batch_cost_usd": round(estimate_cost(BATCH_PREFIX + model, prompt_tokens,
+                                                                 completion_tokens), 6),
+                           "wall_seconds": round(project_wall_time(requests, model, **wall_time_options), 1)}
+                   for model in models},
+        "chunks": [request._asdict() for request in requests],
+    }
+
+def format_plan(report: dict, per_chunk: bool = False) -> str:
+    """
+    Format a report of plan_report for the console.
+    """
+    lines = []
+    for path, totals in report["files"].items():
+        lines.append(f"{path}: {totals['chunks']} chunks, {totals['requests']} requests, {totals['lines']} lines, "
+                     f"{totals['prompt_tokens']} prompt + {totals['completion_tokens']} completion tokens")
+        if per_chunk:
+            for chunk in report["chunks"]:
+                if chunk["path"] == path:
+                    lines.append(f"  chunk {chunk['chunk']:4d} {chunk['language']}: {chunk['lines']} lines, "
+                                 f"{chunk['prompt_tokens']} prompt + {chunk['completion_tokens']} completion tokens")
+
+    lines.append(f"Total: {report['requests']} requests, {report['prompt_tokens']} prompt + "
+                 f"{report['completion_tokens']} completion tokens")
+    for model, estimate in report["models"].items():
+        minutes, seconds = divmod(round(estimate["wall_seconds"]), 60)
+        lines.append(f"  {model:16s} ${estimate['cost_usd']:.4f} (${estimate['batch_cost_usd']:.4f} in a batch), "
+                     f"about {minutes}m {seconds:02d}s")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate the requests, tokens, cost and time of translating "
+                                                 "subtitle files, without calling OpenAI.")
+    parser.add_argument("inputs", nargs="+", help="SRT or VTT files, or directories holding them.")
+    parser.add_argument("--source-lang", help="The source language of the SRT files.", default="Japanese")
+    parser.add_argument("--target-lang", nargs="+", default=["English"], help="The target languages.")
+    parser.add_argument("--model", default="gpt-4", help="The model whose tokenizer counts the tokens.")
+    parser.add_argument("--compare-models", nargs="*", default=None,
+                        help="The models to estimate the cost and time of. Defaults to every model with a price.")
+    parser.add_argument("--workers", type=int, default=1, help="The number of chunks translated concurrently.")
+    parser.add_argument("--rpm", type=float, default=None, help="The requests per minute limit of the account.")
+    parser.add_argument("--tpm", type=float, default=None, help="The tokens per minute limit of the account.")
+    parser.add_argument("--max-in-flight", type=int, default=8,
+                        help="The maximum number of requests running at once.")
+    parser.add_argument("--tokens-per-second", type=float, default=None,
+                        help="The generation speed, instead of the usual speed of each model.")
+    parser.add_argument("--context-tokens", type=int, default=4000,
+                        help="The maximum number of tokens of earlier chunks kept in the conversation history.")
+    parser.add_argument("--chunk-tokens", type=int, default=1000,
+                        help="The target number of subtitle tokens sent per request.")
+    parser.add_argument("--chunk-lines", type=int, default=60,
+                        help="The maximum number of subtitles sent per request.")
+    parser.add_argument("--completion-ratio", type=float, default=1.0,
+                        help="The number of tokens of a translation per token of its source.")
+    parser.add_argument("--no-dedup", action="store_true", help="Plan to translate every copy of a repeated line.")
+    parser.add_argument("--per-chunk", action="store_true", help="List the tokens of every chunk.")
+    parser.add_argument("--report", default=None, help="Save the plan to this JSON file.")
+    args = parser.parse_args()
+
+    paths = find_subtitle_files(args.inputs)
+    if not paths:
+        parser.error("No subtitle files found")
+
+    planned = []
+    for path in paths:
+        planned += plan_file(path, args.target_lang, source_lang=args.source_lang, model=args.model,
+                             workers=args.workers, chunk_tokens=args.chunk_tokens, chunk_lines=args.chunk_lines,
+                             context_tokens=args.context_tokens, dedup=not args.no_dedup,
+                             completion_ratio=args.completion_ratio)
+
+    report = plan_report(planned, args.compare_models or list(TOKEN_PRICES), workers=args.workers,
+                         requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                         max_in_flight=args.max_in_flight, tokens_per_second=args.tokens_per_second)
+    print(format_plan(report, per_chunk=args.per_chunk))
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,140 @@
+import re
+from typing import NamedTuple
+
+from subtitles import timestamp_to_ms
+
+# A fragment ending like this closes its sentence. Closing quotes and brackets may follow the punctuation.
+_SENTENCE_END = re.compile(r'([.!?…。！？♪]|\])["\'”’」』)]*\s*$')
+# Sound and music markers such as "[Music]" or "(laughs)" are never part of a sentence
+_MARKER = re.compile(r'^[\[(（♪].*[\])）♪]$')
+# Preferred places to cut a translation, after a comma or the end of a clause
+_CLAUSE_END = re.compile(r'[,;:.!?…、。，；：！？]["\'”’」』)]*$')
+
+class SentenceUnit(NamedTuple):
+    # The positions of the merged segments in the original list
+    indices: list[int]
+    # The share of the translation each segment receives
+    weights: list[float]
+    # The merged segment, spanning from the start of the first to the end of the last
+    row: dict
+
+def _is_unspaced(char: str) -> bool:
+    # Kana and CJK ideographs are written without spaces between words
+    code = ord(char)
+    return 0x3000 <= code <= 0x30FF or 0x3400 <= code <= 0x9FFF or 0xFF00 <= code <= 0xFFEF
+
+def _join(left: str, right: str) -> str:
+    if left and right and _is_unspaced(left[-1]) and _is_unspaced(right[0]):
+        return left + right
+    return f"{left} {right}".strip()
+
+def merge_sentences(rows: list[dict], max_gap_ms: int = 800, max_chars: int = 250, max_segments: int = 4,
+                    by: str = "duration") -> list[SentenceUnit]:
+    """
+    Merge adjacent transcript segments that split a sentence, so each sentence is translated as a whole.
+
+    A segment is appended to the previous one unless the previous one ends a sentence, the silence between them
+    is too long, the merged segment would grow too long, or either is a sound marker such as "[Music]".
+
+    Args:
+        rows: The segments, each a dictionary with Start, End and Text.
+        max_gap_ms: The longest silence between two segments of the same sentence.
+        max_chars: The maximum length of a merged segment.
+        max_segments: The maximum number of segments merged together.
+        by: How the translation of a merged segment is shared between its segments, in proportion to their
+            "duration" or their number of "chars".
+    """
+    if by not in ("duration", "chars"):
+        raise ValueError(f"Unknown redistribution: {by}")
+
+    units = []
+    indices = []
+    text = ""
+
+    def close():
+        first, last = rows[indices[0]], rows[indices[-1]]
+        if by == "duration":
+            weights = [max(timestamp_to_ms(rows[i]['End']) - timestamp_to_ms(rows[i]['Start']), 1) for i in indices]
+        else:
+            weights = [max(len(rows[i]['Text'].strip()), 1) for i in indices]
+        units.append(SentenceUnit(list(indices), weights, {"Start": first['Start'], "End": last['End'], "Text": text}))
+
+    for i, row in enumerate(rows):
+        fragment = row['Text'].strip()
+        if indices:
+            previous = rows[indices[-1]]
+            gap = timestamp_to_ms(row['Start']) - timestamp_to_ms(previous['End'])
+            if _SENTENCE_END.search(text) or _MARKER.match(fragment) or not fragment or not text or \
+                    gap > max_gap_ms or len(indices) >= max_segments or len(text) + len(fragment) + 1 > max_chars:
+                close()
+                indices, text = [], ""
+
+        indices.append(i)
+        text = _join(text, fragment)
+
+    if indices:
+        close()
+    return units
+
+def split_translation(text: str, weights: list[float]) -> list[str]:
+    """
+    Split a translation into one part per weight, with lengths in proportion to the weights.
+
+    Parts are cut between words, preferably after a comma or the end of a clause, or between any two characters
+    in languages written without spaces. A single word is never cut, so when there are fewer words than parts, a
+    part left without one repeats the word at its boundary instead of being empty.
+    """
+    text = text.strip()
+    if len(weights) == 1:
+        return [text]
+
+    candidates = {match.end() for match in re.finditer(r'\S+\s+', text)}
+    candidates.update(i for i in range(1, len(text)) if _is_unspaced(text[i - 1]) and _is_unspaced(text[i]))
+    candidates = sorted(candidates)
+    # A cut after a clause may stray this far from its ideal position
+    tolerance = len(text) * 0.2
+
+    def cost(cut: int, target: float) -> float:
+        clause = _CLAUSE_END.search(text[:cut].rstrip()) is not None
+        return abs(cut - target) - (tolerance if clause else 0)
+
+    total = sum(weights)
+    cuts = []
+    share = 0.0
+    for weight in weights[:-1]:
+        share += weight
+        remaining = [cut for cut in candidates if cut > (cuts[-1] if cuts else 0)]
+        cuts.append(min(remaining, key=lambda cut: cost(cut, len(text) * share / total)) if remaining else len(text))
+
+    bounds = [0] + cuts + [len(text)]
+    parts = [text[start:end].strip() for start, end in zip(bounds, bounds[1:])]
+
+    # Only the parts after the last cut can be empty, as every cut is after the previous one
+    for i, part in enumerate(parts):
+        if not part and i > 0:
+            parts[i] = parts[i - 1].split()[-1] if parts[i - 1] else ""
+    return parts
+
+def redistribute(units: list[SentenceUnit], translated: list[dict], rows: list[dict]) -> list[dict]:
+    """
+    Spread the translations of merged segments back onto the original segments and their timestamps.
+
+    The result has one segment per original segment, with the same Start and End. Untranslated segments keep
+    their text.
+
+    Args:
+        units: The merged segments, from merge_sentences.
+        translated: The translation of each merged segment.
+        rows: The original segments.
+    """
+    result = [None] * len(rows)
+    for unit, translation in zip(units, translated):
+        if translation['Text'] == unit.row['Text'] or not translation['Text'].strip():
+            # Left untranslated, so keep the segments as they were
+            parts = [rows[i]['Text'] for i in unit.indices]
+        else:
+            parts = split_translation(translation['Text'], unit.weights)
+
+        for i, part in zip(unit.indices, parts):
+            result[i] = {"Start": rows[i]['Start'], "End": rows[i]['End'], "Text": part}
+    return result
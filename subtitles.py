@@ -1,36 +1,91 @@
+import io
 import re
-from typing import NamedTuple
+from typing import Generator, Iterable, NamedTuple, TextIO, Union
+
+from tokens import Tokenizer, estimate_tokens
+from utils import get_token_batches
 
 _INDEX_LINE = re.compile('\s*(\d+)\s*')
+_TIMESTAMP = re.compile(r'\s*(?:(\d+):)?(\d+):(\d+)(?:[,.](\d{1,3}))?\s*')
+_ARROW = '-->'
 
 class IndexedSubtitle(NamedTuple):
     index: int
     text: str
 
-def parse_indexed_subtitles(text: str):
+def _strip_line_end(line: str) -> str:
+    return (line.splitlines() or [''])[0]
+
+class IndexedSubtitleParser:
     """
-    Parse a string containing indexed subtitles with no time information.
+    Parse indexed subtitles incrementally, e.g. from a streamed completion.
 
-    Args:
-        text: A string containing indexed subtitles.
+    A subtitle is complete once the index line of the next subtitle has been received, or the input has ended.
     """
-    subtitle_index = None
-    subtitle_text = []
-    
-    for line in text.splitlines():
+
+    def __init__(self):
+        # The index of the subtitle being received, if any
+        self.current_index = None
+        self._text = []
+        self._buffer = ''
+
+    def _line(self, line: str) -> Generator[IndexedSubtitle, None, None]:
         match = re.fullmatch(_INDEX_LINE, line)
 
         if match:
-            if subtitle_index is not None:
-                yield IndexedSubtitle(subtitle_index, '\n'.join(subtitle_text))
-                
-            subtitle_index = int(match.group(1))
-            subtitle_text.clear()
+            if self.current_index is not None:
+                yield IndexedSubtitle(self.current_index, '\n'.join(self._text))
+
+            self.current_index = int(match.group(1))
+            self._text.clear()
         else:
-            subtitle_text.append(line)
-    
-    if subtitle_index is not None:
-        yield IndexedSubtitle(subtitle_index, '\n'.join(subtitle_text))
+            self._text.append(line)
+
+    def feed(self, text: str) -> list[IndexedSubtitle]:
+        """
+        Add received text.
+
+        Returns:
+            The subtitles completed by the text.
+        """
+        self._buffer += text
+        lines = self._buffer.splitlines(keepends=True)
+
+        # Keep the last line until its end has been received. A trailing \r may be the start of \r\n.
+        self._buffer = ''
+        if lines and (_strip_line_end(lines[-1]) == lines[-1] or lines[-1].endswith('\r')):
+            self._buffer = lines.pop()
+
+        return [subtitle for line in lines for subtitle in self._line(_strip_line_end(line))]
+
+    def close(self) -> list[IndexedSubtitle]:
+        """
+        Mark the end of the input.
+
+        Returns:
+            The remaining subtitles.
+        """
+        completed = []
+        if self._buffer:
+            completed += self._line(_strip_line_end(self._buffer))
+            self._buffer = ''
+
+        if self.current_index is not None:
+            completed.append(IndexedSubtitle(self.current_index, '\n'.join(self._text)))
+            self.current_index = None
+            self._text = []
+        return completed
+
+def parse_indexed_subtitles(text: str):
+    """
+    Parse a string containing indexed subtitles with no time information.
+
+    Args:
+        text: A string containing indexed subtitles.
+    """
+    parser = IndexedSubtitleParser()
+    yield from parser.feed(text)
+    yield from parser.close()
 
 def indexed_subtitles_to_text(subtitles):
     """
@@ -41,6 +96,195 @@ def indexed_subtitles_to_text(subtitles):
     """
     return '\n\n'.join(f'{subtitle.index}\n{subtitle.text}' for subtitle in subtitles)
 
+def timestamp_to_ms(timestamp: Union[str, int, float]) -> int:
+    """
+    Convert a timestamp to milliseconds.
+
+    Args:
+        timestamp: Either a number of seconds, or an SRT/VTT timestamp such as 00:01:02,500.
+    """
+    if isinstance(timestamp, (int, float)):
+        return round(timestamp * 1000)
+
+    match = re.fullmatch(_TIMESTAMP, timestamp)
+    if not match:
+        raise ValueError(f"Invalid timestamp: {timestamp}")
+
+    hours, minutes, seconds, millis = match.groups()
+    return ((int(hours or 0) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int((millis or '0').ljust(3, '0'))
+
+def chunk_subtitles(subtitles: Iterable[IndexedSubtitle], max_tokens: int = 1000, max_lines: int = 60,
+                    tokenizer: Tokenizer = estimate_tokens, gaps: dict[int, float] = None,
+                    silence_gap: float = 2000) -> Generator[list[IndexedSubtitle], None, None]:
+    """
+    Split indexed subtitles into chunks that fit a token budget, preferably at long silences.
+
+    Args:
+        subtitles: The subtitles to split.
+        max_tokens: The maximum number of prompt tokens per chunk.
+        max_lines: The maximum number of subtitles per chunk.
+        tokenizer: Counts the tokens of a text.
+        gaps: Maps a subtitle index to the silence before it in milliseconds.
+        silence_gap: The minimum silence in milliseconds that is worth cutting at.
+    """
+    return get_token_batches(subtitles, lambda subtitle: tokenizer(f'{subtitle.index}\n{subtitle.text}\n\n'),
+                             max_tokens=max_tokens, max_lines=max_lines,
+                             gap_before=(lambda subtitle: gaps.get(subtitle.index, 0)) if gaps else None,
+                             silence_gap=silence_gap)
+
+class Cue:
+    """
+    A subtitle with its timing, in integer milliseconds.
+    """
+    __slots__ = ('index', 'start', 'end', 'text')
+
+    def __init__(self, index: int, start: int, end: int, text: str):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.text = text
+
+    def __eq__(self, other):
+        return isinstance(other, Cue) and (self.index, self.start, self.end, self.text) == \
+            (other.index, other.start, other.end, other.text)
+
+    def __repr__(self):
+        return f'Cue({self.index}, {format_timestamp(self.start)}, {format_timestamp(self.end)}, {self.text!r})'
+
+def _parse_timestamp(timestamp: str) -> int:
+    # Fast path for the usual HH:MM:SS,mmm form
+    if len(timestamp) == 12 and timestamp[2] == ':' and timestamp[5] == ':':
+        try:
+            return ((int(timestamp[0:2]) * 60 + int(timestamp[3:5])) * 60 + int(timestamp[6:8])) * 1000 + \
+                int(timestamp[9:12])
+        except ValueError:
+            pass
+    return timestamp_to_ms(timestamp)
+
+def format_timestamp(ms: int, separator: str = ',') -> str:
+    """
+    Format milliseconds as an SRT (or, with a '.' separator, VTT) timestamp.
+    """
+    seconds, ms = divmod(max(0, ms), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{ms:03d}'
+
+def iter_cues(lines: Iterable[str]) -> Generator[Cue, None, None]:
+    """
+    Parse SRT or VTT cues from lines, one cue at a time, so files of any size are read in bounded memory.
+
+    Cues without a numeric identifier are numbered after the previous cue. VTT headers, notes and
+    styles are skipped, as are cue settings.
+
+    Args:
+        lines: The lines of the file, e.g. an open text file.
+    """
+    index = None
+    start = end = None
+    text = []
+    previous_index = 0
+
+    for line in lines:
+        line = line.rstrip('\r\n').lstrip('\ufeff')
+
+        if start is not None:
+            # Inside a cue: collect the text until a blank line
+            if line.strip():
+                text.append(line)
+                continue
+
+            previous_index = index if index is not None else previous_index + 1
+            yield Cue(previous_index, start, end, '\n'.join(text))
+            index = start = end = None
+            text = []
+        elif _ARROW in line:
+            start_text, end_text = line.split(_ARROW, 1)
+            end_parts = end_text.split()
+            start, end = _parse_timestamp(start_text.strip()), _parse_timestamp(end_parts[0])
+        elif line.strip().isdigit():
+            index = int(line)
+        else:
+            # Blank lines between cues, VTT headers, notes and cue identifiers
+            index = None
+
+    if start is not None:
+        previous_index = index if index is not None else previous_index + 1
+        yield Cue(previous_index, start, end, '\n'.join(text))
+
+def read_cues(path: str, encoding: str = 'utf-8') -> Generator[Cue, None, None]:
+    """
+    Lazily read the cues of an SRT or VTT file.
+    """
+    with open(path, encoding=encoding) as f:
+        yield from iter_cues(f)
+
+def chunk_cues(cues: Iterable[Cue], max_tokens: int = 1000, max_lines: int = 60,
+               tokenizer: Tokenizer = estimate_tokens) -> Generator[list[Cue], None, None]:
+    """
+    Lazily split cues into chunks with chunk_subtitles, preferably cutting at the silences between conversations.
+    """
+    # The silence before each cue, filled in as the cues are read
+    gaps = {}
+
+    def with_gaps():
+        previous = None
+        for cue in cues:
+            if previous is not None:
+                gaps[cue.index] = cue.start - previous.end
+            previous = cue
+            yield cue
+
+    for chunk in chunk_subtitles(with_gaps(), max_tokens=max_tokens, max_lines=max_lines, tokenizer=tokenizer,
+                                 gaps=gaps):
+        # The gaps of a chunk are no longer needed once it is cut, so memory stays bounded
+        for cue in chunk:
+            gaps.pop(cue.index, None)
+        yield chunk
+
+def parse_srt(text: str) -> list[Cue]:
+    """
+    Parse the cues of an SRT or VTT document held in a string.
+    """
+    return list(iter_cues(io.StringIO(text)))
+
+def write_srt(cues: Iterable[Cue], file: TextIO) -> int:
+    """
+    Write cues to a file in SRT format, one cue at a time.
+
+    Returns:
+        The number of cues written.
+    """
+    count = 0
+    for cue in cues:
+        file.write(f'{cue.index}\n{format_timestamp(cue.start)} --> {format_timestamp(cue.end)}\n{cue.text}\n\n')
+        count += 1
+    return count
+
+def write_vtt(cues: Iterable[Cue], file: TextIO) -> int:
+    """
+    Write cues to a file in WebVTT format, one cue at a time.
+
+    Returns:
+        The number of cues written.
+    """
+    file.write('WEBVTT\n\n')
+
+    count = 0
+    for cue in cues:
+        file.write(f'{cue.index}\n{format_timestamp(cue.start, ".")} --> {format_timestamp(cue.end, ".")}\n'
+                   f'{cue.text}\n\n')
+        count += 1
+    return count
+
+def format_srt(cues: Iterable[Cue]) -> str:
+    """
+    Format cues as an SRT document.
+    """
+    output = io.StringIO()
+    write_srt(cues, output)
+    return output.getvalue()
+
 if __name__ == '__main__':
     text = '''1
     First line
@@ -56,4 +300,8 @@ if __name__ == '__main__':
     for subtitle in subs:
         print(subtitle)
 
-    print(indexed_subtitles_to_text(subs))
\ No newline at end of file
+    print(indexed_subtitles_to_text(subs))
+
+    cues = parse_srt('1\n00:00:01,000 --> 00:00:02,500\nHello\n\n2\n00:00:03,000 --> 00:00:04,000\nWorld\n')
+    print(cues)
+    print(format_srt(cues))
@@ -0,0 +1,53 @@
+import logging
+import math
+from typing import Callable
+
+Tokenizer = Callable[[str], int]
+
+def _is_wide(char: str) -> bool:
+    # Hangul, kana and CJK ideographs are roughly one token per character
+    code = ord(char)
+    return 0x1100 <= code <= 0x11FF or 0x3040 <= code <= 0x30FF or 0x3400 <= code <= 0x9FFF or \
+        0xAC00 <= code <= 0xD7AF or 0xF900 <= code <= 0xFAFF
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheaply estimate the number of tokens in a text without a real tokenizer.
+
+    Wide (CJK/Hangul) characters count as one token each, everything else as a quarter token.
+
+    Args:
+        text: The text to estimate.
+    """
+    wide = sum(1 for char in text if _is_wide(char))
+    return wide + math.ceil((len(text) - wide) / 4)
+
+def get_tokenizer(model: str = None) -> Tokenizer:
+    """
+    Get a function counting the tokens of a text for the given model.
+
+    Uses tiktoken if it is installed and its encoding can be loaded, otherwise falls back to estimate_tokens.
+
+    Args:
+        model: The model name, or None to always use the character-based estimate.
+    """
+    if model is None:
+        return estimate_tokens
+
+    try:
+        import tiktoken
+
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken is optional, and downloads its encodings on first use
+        logging.debug(f"Falling back to estimated token counts: {e}")
+        return estimate_tokens
+
+    return lambda text: len(encoding.encode(text))
+
+if __name__ == '__main__':
+    for text in ["Hello, how are you doing today?", "안녕하세요. 뷰성형외과 정재현 원장입니다.", "こんにちは"]:
+        print(f"{estimate_tokens(text):3d} {text}")
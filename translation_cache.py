@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Iterable, Optional
+
+from metrics import record_cache_lookups
+from utils import get_batches
+
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a source line so that trivially different copies share a cache entry.
+
+    Args:
+        text: The text to normalize.
+    """
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFKC', text)).strip()
+
+def cache_key(text: str, source_lang: str, target_lang: str, model: str, prompt_version: str) -> str:
+    """
+    Compute the content address of a translation.
+
+    Args:
+        text: The source text.
+        source_lang: The source language.
+        target_lang: The target language.
+        model: The model producing the translation.
+        prompt_version: The version of the prompt template producing the translation.
+    """
+    payload = json.dumps([normalize_text(text), source_lang, target_lang, model, prompt_version], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class TranslationCache:
+    """
+    A persistent, content-addressed translation cache backed by SQLite.
+
+    Entries are evicted least recently used first once either max_entries or max_bytes is exceeded.
+    """
+
+    def __init__(self, path: str = "./cache/translations.sqlite3",
+                 max_entries: Optional[int] = None, max_bytes: Optional[int] = None):
+        """
+        Args:
+            path: The SQLite database file.
+            max_entries: The maximum number of cached translations, or None for no limit.
+            max_bytes: The maximum total size of the cached texts in bytes, or None for no limit.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS translations (
+                key TEXT PRIMARY KEY,
+                translation TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used)")
+        self._connection.commit()
+
+    def get_many(self, texts: Iterable[str], source_lang: str, target_lang: str,
+                 model: str, prompt_version: str) -> dict[str, str]:
+        """
+        Look up the translations of the given texts.
+
+        Returns:
+            A dictionary mapping each source text found in the cache to its translation. Texts differing only
+            in whitespace share a translation, and are all in the dictionary.
+        """
+        # Every text normalizing to a key, so none of them is reported as a miss
+        keys: dict[str, list[str]] = {}
+        for text in texts:
+            texts_of_key = keys.setdefault(cache_key(text, source_lang, target_lang, model, prompt_version), [])
+            if text not in texts_of_key:
+                texts_of_key.append(text)
+        if not keys:
+            return {}
+
+        found = {}
+        with self._lock:
+            for key_batch in get_batches(list(keys), 500):
+                placeholders = ','.join('?' * len(key_batch))
+                rows = self._connection.execute(
+                    f"SELECT key, translation FROM translations WHERE key IN ({placeholders})", key_batch)
+                for key, translation in rows:
+                    found[key] = translation
+
+            if found:
+                now = time.time()
+                self._connection.executemany("UPDATE translations SET last_used = ? WHERE key = ?",
+                                             [(now, key) for key in found])
+                self._connection.commit()
+
+        result = {text: translation for key, translation in found.items() for text in keys[key]}
+        record_cache_lookups(len(result), sum(len(texts_of_key) for texts_of_key in keys.values()) - len(result))
+        return result
+
+    def get(self, text: str, source_lang: str, target_lang: str, model: str, prompt_version: str) -> Optional[str]:
+        return self.get_many([text], source_lang, target_lang, model, prompt_version).get(text)
+
+    def put_many(self, translations: dict[str, str], source_lang: str, target_lang: str,
+                 model: str, prompt_version: str):
+        """
+        Store translations, evicting old entries if the cache exceeds its limits.
+
+        Args:
+            translations: A dictionary mapping source texts to their translations.
+        """
+        if not translations:
+            return
+
+        now = time.time()
+        rows = [
+            (cache_key(text, source_lang, target_lang, model, prompt_version), translation,
+             len(text.encode('utf-8')) + len(translation.encode('utf-8')), now)
+            for text, translation in translations.items()
+        ]
+
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO translations (key, translation, size, last_used) VALUES (?, ?, ?, ?)", rows)
+            self._evict()
+            self._connection.commit()
+
+    def put(self, text: str, translation: str, source_lang: str, target_lang: str, model: str, prompt_version: str):
+        self.put_many({text: translation}, source_lang, target_lang, model, prompt_version)
+
+    def _evict(self):
+        if self.max_entries is not None:
+            count, = self._connection.execute("SELECT COUNT(*) FROM translations").fetchone()
+            if count > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM translations WHERE key IN "
+                    "(SELECT key FROM translations ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+
+        if self.max_bytes is not None:
+            total, = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM translations").fetchone()
+            if total > self.max_bytes:
+                # Walk from the least recently used entry until enough space has been freed
+                excess = total - self.max_bytes
+                doomed = []
+                for key, size in self._connection.execute("SELECT key, size FROM translations ORDER BY last_used"):
+                    doomed.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                self._connection.executemany("DELETE FROM translations WHERE key = ?", doomed)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+if __name__ == '__main__':
+    cache = TranslationCache(":memory:", max_entries=2)
+    cache.put("안녕하세요", "Hello", "Korean", "English", "gpt-4", "1")
+    cache.put("감사합니다", "Thank you", "Korean", "English", "gpt-4", "1")
+    cache.put("네", "Yes", "Korean", "English", "gpt-4", "1")
+
+    print(cache.get_many(["  안녕하세요 ", "감사합니다", "네"], "Korean", "English", "gpt-4", "1"))
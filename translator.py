@@ -1,47 +1,351 @@
+import asyncio
+import hashlib
 import json
+import logging
 import os
+from typing import Callable
 
-import dotenv
-from openai import OpenAI
-
-dotenv.load_dotenv()
-
-client = OpenAI()
-
-def translate_openai(list, target_language):
-    final_list = []
-
-    system_input = "이제부터 너는 주어진 텍스트를 잘 번역하는 작업을 수행할 거야."
-    first_shot_input = f"제공되는 텍스트를 영어로 번역해줘. 제공되는 텍스트는 다음과 같아. 텍스트 : 안녕하세요. 뷰성형외과 정재현 원장입니다."
-    first_shot_output = "Hello. I am Director Jung Jae-hyun from View Plastic Surgery."
-    second_shot_input = "가슴 보형물의 사이즈와 컵 사이즈 간의 상관관계에 대해서"
-    second_shot_output = "The correlation between breast implant size and cup size"
-
-    for i in range(len(list)):
-        # OpenAI의 번역 엔진을 사용하여 텍스트 번역
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",  # 사용할 모델 선택 (최신 정보를 위해 OpenAI 문서 참조)
-            messages=[
-                {"role": "system", "content": system_input},
-                {"role": "user", "content": first_shot_input},
-                {"role": "assistant", "content": first_shot_output},
-                {"role": "user", "content": second_shot_input},
-                {"role": "assistant", "content": second_shot_output},
-                {"role": "user", "content": f"제공되는 텍스트를 {target_language}로 번역해줘. 제공되는 텍스트는 다음과 같아. 텍스트 : {list[i]['Text']}"},
-            ]
-        )
-
-        final_dict = {
-            "Start": list[i]['Start'],
-            "End": list[i]['End'],
-            "Text": response.choices[0].message.content
+from alignment import TranslationStreamMonitor, align_translation
+from checkpoint import TranslationJournal, journal_key, journal_path
+from clients.openai_factory import get_async_openai_client, run_async
+from clients.rate_limiter import get_scheduler
+from dedup import LineDeduplicator
+from metrics import record_file, record_retry, record_usage, timed, usage_tokens
+from sentences import merge_sentences, redistribute, split_translation
+from subtitles import IndexedSubtitle, chunk_subtitles, indexed_subtitles_to_text, timestamp_to_ms
+from tokens import estimate_tokens, get_tokenizer
+from translation_cache import TranslationCache
+from utils import language_path
+
+OUTPUT_PATH = "./result/translated_with_timestamp.json"
+MODEL = "gpt-3.5-turbo"  # 사용할 모델 선택 (최신 정보를 위해 OpenAI 문서 참조)
+# 프롬프트를 수정하면 버전을 올려서 이전 프롬프트의 캐시가 재사용되지 않도록 함
+PROMPT_TEMPLATE_VERSION = "1"
+
+system_input = "이제부터 너는 주어진 자막을 잘 번역하는 작업을 수행할 거야. 각 자막 앞의 번호는 동기화에 필요하니 그대로 유지해줘."
+first_shot_input = "제공되는 자막을 영어로 번역해줘. 제공되는 자막은 다음과 같아.\n\n" + indexed_subtitles_to_text([
+    IndexedSubtitle(1, "안녕하세요. 뷰성형외과 정재현 원장입니다."),
+    IndexedSubtitle(2, "가슴 보형물의 사이즈와 컵 사이즈 간의 상관관계에 대해서"),
+])
+first_shot_output = indexed_subtitles_to_text([
+    IndexedSubtitle(1, "Hello. I am Director Jung Jae-hyun from View Plastic Surgery."),
+    IndexedSubtitle(2, "The correlation between breast implant size and cup size"),
+])
+
+
+def _build_messages(batch: list[IndexedSubtitle], target_language: str) -> list[dict]:
+    prompt = f"제공되는 자막을 {target_language}로 번역해줘. 제공되는 자막은 다음과 같아.\n\n"
+    prompt += indexed_subtitles_to_text(batch)
+
+    return [
+        {"role": "system", "content": system_input},
+        {"role": "user", "content": first_shot_input},
+        {"role": "assistant", "content": first_shot_output},
+        {"role": "user", "content": prompt},
+    ]
+
+
+async def _stream_completion(messages: list[dict], monitor: TranslationStreamMonitor, estimated_tokens: int):
+    """
+    Stream a completion into the monitor, closing the connection as soon as the monitor asks to abort.
+    """
+    # The request counts as in flight until the stream is read or closed, not only until the headers arrive
+    with timed("translation.request"):
+        async with get_scheduler(MODEL).ahold(
+                lambda: get_async_openai_client().chat.completions.with_raw_response.create(
+                    model=MODEL,
+                    messages=messages,
+                    stream=True,
+                    # Report the usage in the last chunk
+                    extra_body={"stream_options": {"include_usage": True}},
+                ),
+                estimated_tokens=estimated_tokens) as held:
+            stream = held.response.parse()
+
+            usage = None
+            received = []
+            try:
+                async for chunk in stream:
+                    usage = getattr(chunk, "usage", None) or usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        received.append(chunk.choices[0].delta.content)
+                        if not monitor.feed(chunk.choices[0].delta.content):
+                            logging.warning(f"Aborting the generation: {monitor.abort_reason}.")
+                            break
+            finally:
+                await stream.response.aclose()
+
+                if usage is not None:
+                    used = usage_tokens(usage)
+                else:
+                    # Aborted streams report no usage
+                    used = (sum(estimate_tokens(message["content"]) for message in messages),
+                            estimate_tokens(''.join(received)))
+                record_usage(MODEL, *used)
+                held.used_tokens = sum(used)
+
+
+async def translate_batch(batch: list[IndexedSubtitle], target_language: str,
+                          semaphore: asyncio.Semaphore, retries: int = 3,
+                          on_line: Callable[[IndexedSubtitle], None] = None) -> dict[int, str]:
+    """
+    Translate a batch of indexed segments with as few requests as possible.
+
+    Lines missing, duplicated or merged in a response are requested again on their own, so a partial answer is
+    never thrown away.
+
+    Args:
+        batch: The segments to translate, indexed by their position in the transcript.
+        target_language: The language to translate to.
+        semaphore: Limits the number of requests in flight.
+        retries: The number of requests to make before giving up on the missing lines.
+        on_line: Called with each translated segment as soon as it has been generated.
+
+    Returns:
+        A dictionary mapping each translated segment index to its translation. Lines that could not be
+        translated are left out.
+    """
+    translations = {}
+    pending = batch
+
+    for attempt in range(1, retries + 1):
+        messages = _build_messages(pending, target_language)
+        # Expect a reply about as long as the subtitles sent
+        estimated_tokens = sum(estimate_tokens(message["content"]) for message in messages) + \
+            estimate_tokens(indexed_subtitles_to_text(pending))
+
+        monitor = TranslationStreamMonitor(pending, on_line)
+        async with semaphore:
+            await _stream_completion(messages, monitor, estimated_tokens)
+
+        alignment = align_translation(pending, monitor.finish())
+        translations.update(alignment.aligned)
+
+        to_request = set(alignment.to_request)
+        pending = [subtitle for subtitle in pending if subtitle.index in to_request]
+        if not pending:
+            break
+
+        logging.warning(f"Attempt {attempt}: {alignment.describe()}. Requesting {len(pending)} lines again.")
+        if attempt < retries:
+            record_retry("misaligned_lines")
+
+    return translations
+
+
+async def translate_segments_async(list, target_language, batch_size: int = 60, concurrency: int = 8,
+                                   cache: TranslationCache = None, max_tokens: int = 1000,
+                                   journal: TranslationJournal = None,
+                                   on_line: Callable[[IndexedSubtitle], None] = None,
+                                   deduplicator: LineDeduplicator = None, resegment: bool = True):
+    """
+    Translate transcript segments by packing them into indexed batches that are translated concurrently.
+
+    Args:
+        list: The segments to translate, each a dictionary with Start, End and Text.
+        target_language: The language to translate to.
+        batch_size: The maximum number of segments per request.
+        concurrency: The maximum number of requests in flight.
+        cache: If given, cached segments are not sent, and the new translations are added to the cache.
+        max_tokens: The target number of segment tokens per request.
+        journal: If given, segments already in the journal are not sent, and each translated batch is added to
+                 it as soon as it is done.
+        on_line: Called with each translated segment, indexed by its position in the list starting at 1, as
+                 soon as it has been generated. Segments may be translated again if a response is misaligned.
+        deduplicator: If given, repeated segments are translated once, sharing the translation with every copy.
+                      Share one between the calls of a job to also reuse the translations of earlier calls.
+        resegment: Whether to merge segments that split a sentence before translating, and spread each
+                   translation back onto the merged segments in proportion to their duration.
+
+    Returns:
+        The translated segments.
+    """
+    if resegment:
+        units = merge_sentences(list)
+        if len(units) < len(list):
+            logging.info(f"Merged {len(list)} segments into {len(units)} sentences.")
+
+            unit_on_line = None
+            if on_line is not None:
+                def unit_on_line(line: IndexedSubtitle):
+                    unit = units[line.index - 1]
+                    for i, text in zip(unit.indices, split_translation(line.text, unit.weights)):
+                        on_line(IndexedSubtitle(i + 1, text))
+
+            translated = await translate_segments_async([unit.row for unit in units], target_language,
+                                                        batch_size=batch_size, concurrency=concurrency, cache=cache,
+                                                        max_tokens=max_tokens, journal=journal, on_line=unit_on_line,
+                                                        deduplicator=deduplicator, resegment=False)
+            return redistribute(units, translated, list)
+
+    indexed = [IndexedSubtitle(i + 1, segment['Text']) for i, segment in enumerate(list)]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    deduplication = deduplicator.deduplicate(indexed) if deduplicator is not None else None
+    unique = deduplication.unique if deduplication is not None else indexed
+
+    cached = {}
+    if cache is not None:
+        cached = cache.get_many((subtitle.text for subtitle in unique), None, target_language,
+                                MODEL, PROMPT_TEMPLATE_VERSION)
+    journaled = {subtitle.index: journal.get(subtitle.index) for subtitle in unique
+                 if journal is not None and subtitle.index in journal}
+    misses = [subtitle for subtitle in unique if subtitle.text not in cached and subtitle.index not in journaled]
+
+    # The silence before each segment, so batches are preferably cut between conversations
+    gaps = {i + 1: timestamp_to_ms(segment['Start']) - timestamp_to_ms(previous['End'])
+            for i, (previous, segment) in enumerate(zip(list, list[1:]), start=1)}
+    batches = chunk_subtitles(misses, max_tokens=max_tokens, max_lines=batch_size,
+                              tokenizer=get_tokenizer(MODEL), gaps=gaps)
+
+    async def translate_and_journal(batch) -> dict[int, str]:
+        result = await translate_batch(batch, target_language, semaphore, on_line=on_line)
+        if journal is not None:
+            journal.record(result)
+        return result
+
+    results = await asyncio.gather(*(translate_and_journal(batch) for batch in batches))
+
+    translations = dict(journaled)
+    for result in results:
+        translations.update(result)
+
+    if cache is not None:
+        cache.put_many({subtitle.text: translations[subtitle.index] for subtitle in misses
+                        if subtitle.index in translations},
+                       None, target_language, MODEL, PROMPT_TEMPLATE_VERSION)
+
+    if deduplication is not None:
+        translations.update((subtitle.index, cached[subtitle.text]) for subtitle in unique
+                            if subtitle.text in cached and subtitle.index not in translations)
+        translations = deduplicator.expand(deduplication, translations)
+
+    for subtitle in indexed:
+        if subtitle.index not in translations:
+            # Keep the original text rather than shifting other lines onto the wrong timestamps
+            translations[subtitle.index] = cached.get(subtitle.text, subtitle.text)
+
+    return [
+        {
+            "Start": segment['Start'],
+            "End": segment['End'],
+            "Text": translations[i + 1]
         }
+        for i, segment in enumerate(list)
+    ]
+
+
+def translate_segments(list, target_language, **kwargs):
+    """
+    Translate transcript segments without saving them. See translate_segments_async for the arguments.
+    """
+    return run_async(translate_segments_async(list, target_language, **kwargs))
+
+
+def translate_segments_languages(list, target_languages: list[str],
+                                 on_line: Callable[[str, IndexedSubtitle], None] = None,
+                                 deduplicators: dict[str, LineDeduplicator] = None, **kwargs) -> dict[str, list[dict]]:
+    """
+    Translate transcript segments into several languages at once, without saving them.
+
+    Every language is translated concurrently, each with its own limit on the requests in flight. See
+    translate_segments_async for the other arguments.
+
+    Args:
+        on_line: Called with the target language and each translated segment as soon as it has been generated.
+        deduplicators: The deduplicator of each language, if any.
+
+    Returns:
+        The translated segments of each language.
+    """
+    deduplicators = deduplicators or {}
+
+    async def translate_all():
+        return await asyncio.gather(*(
+            translate_segments_async(list, language, deduplicator=deduplicators.get(language),
+                                     on_line=(lambda line, language=language: on_line(language, line))
+                                     if on_line else None, **kwargs)
+            for language in target_languages))
+
+    return dict(zip(target_languages, run_async(translate_all())))
+
+
+async def translate_openai_async(list, target_language, batch_size: int = 60, concurrency: int = 8,
+                                 cache: TranslationCache = None, max_tokens: int = 1000, resume: bool = True,
+                                 on_line: Callable[[IndexedSubtitle], None] = None, dedup: bool = True,
+                                 resegment: bool = True, output_path: str = OUTPUT_PATH):
+    """
+    Translate transcript segments and save them to output_path, ./result/translated_with_timestamp.json by default.
+
+    See translate_segments_async for the arguments. With resume, completed batches are journaled next to the
+    output, and a rerun with the same segments skips the batches journaled by an interrupted run. With dedup,
+    repeated segments are translated once.
+
+    Returns:
+        The original segments and the translated segments.
+    """
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+    journal = None
+    if resume:
+        segments_hash = hashlib.sha256(json.dumps(list, ensure_ascii=False).encode("utf-8")).hexdigest()
+        journal = TranslationJournal(journal_path(output_path),
+                                     journal_key(segments_hash, None, target_language, MODEL, PROMPT_TEMPLATE_VERSION +
+                                                 # The journal is indexed by merged sentence when resegmenting
+                                                 ("-sentences" if resegment else "")))
+
+    deduplicator = LineDeduplicator() if dedup else None
+    try:
+        final_list = await translate_segments_async(list, target_language, batch_size=batch_size,
+                                                    concurrency=concurrency, cache=cache, max_tokens=max_tokens,
+                                                    journal=journal, on_line=on_line, deduplicator=deduplicator,
+                                                    resegment=resegment)
+    finally:
+        if journal is not None:
+            journal.close()
+
+    if deduplicator is not None:
+        logging.info(f"Deduplication ({target_language}): {deduplicator.describe()}.")
+
+    with timed("output"):
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(final_list, f, indent=4, ensure_ascii=False)
+    record_file("output", output_path)
+
+    if journal is not None:
+        journal.remove()
+
+    return list, final_list
+
+
+def translate_openai(list, target_language, batch_size: int = 60, concurrency: int = 8,
+                     cache: TranslationCache = None, max_tokens: int = 1000, resume: bool = True,
+                     on_line: Callable[[IndexedSubtitle], None] = None, dedup: bool = True,
+                     resegment: bool = True):
+    return run_async(translate_openai_async(list, target_language, batch_size=batch_size,
+                                            concurrency=concurrency, cache=cache, max_tokens=max_tokens,
+                                            resume=resume, on_line=on_line, dedup=dedup, resegment=resegment))
+
+
+async def translate_openai_languages_async(list, target_languages: list[str],
+                                           on_line: Callable[[str, IndexedSubtitle], None] = None, **kwargs):
+    """
+    Translate transcript segments into several languages at once, saving each language next to the default output,
+    e.g. ./result/translated_with_timestamp.English.json.
 
-        final_list.append(final_dict)
+    See translate_openai_async for the other arguments, and translate_segments_languages for on_line.
 
-    os.makedirs(("./result/"), exist_ok=True)
-    with open("./result/translated_with_timestamp.json", "w", encoding="utf-8") as f:
-        json.dump(final_list, f, indent=4, ensure_ascii=False)
+    Returns:
+        The translated segments of each language.
+    """
+    results = await asyncio.gather(*(
+        translate_openai_async(list, language, output_path=language_path(OUTPUT_PATH, language),
+                               on_line=(lambda line, language=language: on_line(language, line)) if on_line else None,
+                               **kwargs)
+        for language in target_languages))
+    return {language: final_list for language, (_, final_list) in zip(target_languages, results)}
 
 
-    return list, final_list
\ No newline at end of file
+def translate_openai_languages(list, target_languages: list[str],
+                               on_line: Callable[[str, IndexedSubtitle], None] = None, **kwargs):
+    return run_async(translate_openai_languages_async(list, target_languages, on_line=on_line, **kwargs))
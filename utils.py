@@ -1,17 +1,166 @@
-from typing import Callable, Generator, TypeVar
+import contextvars
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Generator, Iterable, Optional, TypeVar
 
 T = TypeVar("T")
+R = TypeVar("R")
 
 def get_batches(elements: list[T], chunk_size: int) -> Generator[list[T], None, None]:
     for i in range(0, len(elements), chunk_size):
         yield elements[i:i + chunk_size]
 
-def resize_chunk(chunk: list[T], target_length: int, defaultSupplier: Callable[[int], T]) -> list[T]:
-     # Truncate or pad the translation to match the expected line count
-    if len(chunk) > target_length:
-        return chunk[:target_length]
-    else:
-        return chunk + [ defaultSupplier(index) for index in range(len(chunk) + 1, target_length + 1) ]
+def get_token_batches(elements: Iterable[T], token_count: Callable[[T], int], max_tokens: int,
+                      max_lines: Optional[int] = None, gap_before: Callable[[T], float] = None,
+                      silence_gap: float = 2000, min_fill: float = 0.5) -> Generator[list[T], None, None]:
+    """
+    Split elements into batches that fit a token budget.
+
+    When a batch is full, it is preferably cut at the longest silence in its second half, so that
+    a batch rarely ends in the middle of a conversation.
+
+    Args:
+        elements: The elements to split. May be a lazy iterable.
+        token_count: Returns the number of tokens an element costs.
+        max_tokens: The maximum number of tokens per batch. A single element larger than this forms its own batch.
+        max_lines: The maximum number of elements per batch, or None for no limit.
+        gap_before: Returns the silence before an element (e.g. in milliseconds), or None to never
+                    cut at silences.
+        silence_gap: The minimum gap considered a silence worth cutting at.
+        min_fill: The fraction of the budget a batch must reach before it may be cut at a silence.
+    """
+    batch = []
+    costs = []
+    total = 0
+
+    for element in elements:
+        cost = token_count(element)
+
+        while batch and (total + cost > max_tokens or (max_lines is not None and len(batch) >= max_lines)):
+            split = _find_split(batch, costs, element, max_tokens, max_lines, gap_before, silence_gap, min_fill)
+
+            yield batch[:split]
+            batch, costs = batch[split:], costs[split:]
+            total = sum(costs)
+
+        batch.append(element)
+        costs.append(cost)
+        total += cost
+
+    if batch:
+        yield batch
+
+def _find_split(batch: list[T], costs: list[int], next_element: T, max_tokens: int, max_lines: Optional[int],
+                gap_before: Optional[Callable[[T], float]], silence_gap: float, min_fill: float) -> int:
+    if gap_before is None:
+        return len(batch)
+
+    best_split, best_gap = len(batch), gap_before(next_element)
+    filled = 0
+
+    for i in range(1, len(batch)):
+        filled += costs[i - 1]
+
+        # Only cut once the batch is reasonably full
+        if filled < max_tokens * min_fill and (max_lines is None or i < max_lines * min_fill):
+            continue
+
+        gap = gap_before(batch[i])
+        if gap > best_gap:
+            best_split, best_gap = i, gap
+
+    return best_split if best_gap >= silence_gap else len(batch)
+
+def ordered_imap(function: Callable[[T], R], elements: Iterable[T], workers: int) -> Generator[R, None, None]:
+    """
+    Apply a function to elements concurrently, yielding the results in the order of the elements.
+
+    Unlike ThreadPoolExecutor.map, elements are consumed lazily, and finished results are yielded while later
+    elements are still being produced. The elements are taken on a background thread, so a result is yielded as
+    soon as it is ready, even while the next element is not available yet.
+
+    Args:
+        function: The function to apply.
+        elements: The elements. May be a lazy, blocking iterable such as a queue-backed generator.
+        workers: The maximum number of elements processed at once.
+    """
+    # The submitted futures in element order, then the end of the elements or the error raised by them
+    submitted = queue.Queue()
+    # Bounds the elements taken but whose results have not been yielded yet
+    slots = threading.Semaphore(workers)
+    stopped = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def feed():
+            try:
+                for element in elements:
+                    slots.acquire()
+                    if stopped.is_set():
+                        break
+                    # Run in a copy of the caller's context, so context variables such as the active metrics carry over
+                    submitted.put((True, executor.submit(contextvars.copy_context().run, function, element)))
+                submitted.put((False, None))
+            except BaseException as e:
+                submitted.put((False, e))
+
+        threading.Thread(target=contextvars.copy_context().run, args=(feed,), daemon=True).start()
+
+        try:
+            while True:
+                has_future, future = submitted.get()
+                if not has_future:
+                    if future is not None:
+                        raise future
+                    return
+
+                yield future.result()
+                slots.release()
+        finally:
+            # Stop taking elements once the results are no longer wanted
+            stopped.set()
+            slots.release()
+
+def prefetch(elements: Iterable[T], max_size: int = 0) -> Generator[T, None, None]:
+    """
+    Produce elements on a background thread, so the producer runs ahead of the consumer.
+
+    Exceptions raised by the producer are re-raised in the consumer.
+
+    Args:
+        elements: The elements to produce.
+        max_size: The maximum number of produced elements waiting to be consumed, or 0 for no limit.
+    """
+    buffer = queue.Queue(max_size)
+
+    def produce():
+        try:
+            for element in elements:
+                buffer.put((True, element))
+            buffer.put((False, None))
+        except BaseException as e:
+            buffer.put((False, e))
+
+    threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True).start()
+
+    while True:
+        has_element, element = buffer.get()
+        if has_element:
+            yield element
+        elif element is None:
+            return
+        else:
+            raise element
+
+def language_path(path: str, language: str) -> str:
+    """
+    Get the output path of one language of a multi-language run, e.g. out.srt -> out.English.srt.
+    """
+    root, extension = os.path.splitext(path)
+    name = re.sub(r'[^\w-]+', '_', language.strip())
+    return f"{root}.{name}{extension}"
 
 if __name__ == '__main__':
     elements = [1, 2, 3, 4, 5, 6, 7, 8]
@@ -19,8 +168,5 @@ if __name__ == '__main__':
     for batch in get_batches(elements, 3):
         print(batch)
 
-    resized = resize_chunk([1, 2, 3], 5, lambda index: index)
-    print(resized)
-
-    resized = resize_chunk([1, 2, 3, 4, 5], 3, lambda index: index)
-    print(resized)
\ No newline at end of file
+    for batch in get_token_batches(elements, lambda element: element, max_tokens=10):
+        print(batch)
\ No newline at end of file
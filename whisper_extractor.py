@@ -1,27 +1,129 @@
-import dotenv
-import json
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
-from openai import OpenAI
+from audio_tools import Silence, map_to_source_time, probe_duration, split_on_silence
+from clients.openai_factory import get_openai_client
+from clients.rate_limiter import get_scheduler
+from metrics import record_file, record_usage, timed
+from subtitles import format_srt, parse_srt
 
-dotenv.load_dotenv()
+if TYPE_CHECKING:
+    import openai
 
-client = OpenAI()
+MODEL = "whisper-1"
 
-def youtube_to_transcript(full_path):
-    # Open the audio file
-    file = open(f'{full_path}', "rb")
+# The transcription endpoint rejects uploads above 25 MB
+MAX_UPLOAD_BYTES = 24 * 1024 * 1024
 
-    timestamp_transcript = client.audio.transcriptions.create(
-        file=file,
-        model="whisper-1",
-        response_format="srt",
-        timestamp_granularities=["segment"],
-    )
+def transcribe_file(full_path, transcription_client: "openai.OpenAI" = None) -> str:
+    """
+    Transcribe a single audio file to SRT in one request.
+    """
+    def request():
+        # Reopened on every attempt, as a failed upload consumes the file
+        with open(f'{full_path}', "rb") as file:
+            return (transcription_client or get_openai_client()).audio.transcriptions.create(
+                file=file,
+                model=MODEL,
+                response_format="srt",
+                timestamp_granularities=["segment"],
+            )
 
-    with open("./result/원본_텍스트.srt", "w", encoding="utf-8") as f:
-        f.write(timestamp_transcript)
+    with timed("transcription.request"):
+        transcript = get_scheduler(MODEL).call(request)
+    record_file("transcription.request", full_path)
+    record_usage(MODEL, audio_seconds=_audio_seconds(full_path, transcript))
+    return transcript
+
+def _audio_seconds(path: str, transcript: str) -> float:
+    # Transcription is billed by duration. Without ffprobe, the end of the last cue is the best estimate.
+    try:
+        return probe_duration(path)
+    except (OSError, KeyError, ValueError, subprocess.CalledProcessError):
+        cues = parse_srt(transcript)
+        return cues[-1].end / 1000 if cues else 0.0
+
+def stitch_srt(pieces: list[tuple[float, str]]) -> str:
+    """
+    Join the SRT transcripts of consecutive audio segments into one transcript.
+
+    Args:
+        pieces: The offset of each segment in seconds, and its SRT transcript.
+
+    Returns:
+        The joined SRT, with timestamps shifted by the segment offsets and indices renumbered.
+    """
+    stitched = []
+
+    for offset, text in pieces:
+        shift = round(offset * 1000)
+        for cue in parse_srt(text):
+            cue.index = len(stitched) + 1
+            cue.start += shift
+            cue.end += shift
+            stitched.append(cue)
+
+    return format_srt(stitched)
+
+def remap_srt(text: str, removed: list[Silence]) -> str:
+    """
+    Map the timestamps of a transcript of trimmed audio back to the time of the original audio.
+
+    Args:
+        text: The SRT transcript of the trimmed audio.
+        removed: The silences removed from the original audio.
+    """
+    cues = parse_srt(text)
+
+    for cue in cues:
+        cue.start = round(map_to_source_time(cue.start / 1000, removed) * 1000)
+        cue.end = round(map_to_source_time(cue.end / 1000, removed) * 1000)
+
+    return format_srt(cues)
+
+def youtube_to_transcript(full_path, workers: int = 1, max_segment_seconds: float = 600,
+                          transcription_client: "openai.OpenAI" = None, silence_map: list[Silence] = None):
+    """
+    Transcribe an audio file to SRT and save it to ./result/.
+
+    With more than one worker, or when the file is too large to upload at once, the audio is split at
+    silences and the segments are transcribed concurrently.
+
+    Args:
+        full_path: The audio file.
+        workers: The number of segments to transcribe concurrently.
+        max_segment_seconds: The maximum duration of a segment when splitting. Shorter files are split into about
+                             one segment per worker.
+        transcription_client: The client to use, e.g. one pointing to a local stand-in server.
+        silence_map: The silences removed from the audio (see audio_tools.load_silence_map), so the
+                     timestamps refer to the original video.
+    """
+    if workers <= 1 and os.path.getsize(full_path) <= MAX_UPLOAD_BYTES:
+        timestamp_transcript = transcribe_file(full_path, transcription_client)
+    else:
+        with tempfile.TemporaryDirectory() as segment_directory:
+            segments = split_on_silence(full_path, segment_directory, max_duration=max_segment_seconds,
+                                        max_bytes=MAX_UPLOAD_BYTES, workers=workers)
+
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                transcripts = executor.map(lambda segment: transcribe_file(segment.path, transcription_client),
+                                           segments)
+                timestamp_transcript = stitch_srt([(segment.start, transcript)
+                                                   for segment, transcript in zip(segments, transcripts)])
+
+    if silence_map:
+        timestamp_transcript = remap_srt(timestamp_transcript, silence_map)
+
+    os.makedirs("./result/", exist_ok=True)
+    with timed("output"):
+        with open("./result/원본_텍스트.srt", "w", encoding="utf-8") as f:
+            f.write(timestamp_transcript)
+    record_file("output", "./result/원본_텍스트.srt")
 
     return timestamp_transcript
 
 if __name__ == "__main__":
-    youtube_to_transcript("temp")
\ No newline at end of file
+    youtube_to_transcript("temp")
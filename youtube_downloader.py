@@ -1,38 +1,170 @@
-import yt_dlp
+import glob
+import hashlib
 import os
+import re
+import shutil
+
+from audio_store import AudioStore
+from audio_tools import convert_for_speech, save_silence_map, silence_map_path
+from metrics import record_file, timed
+
+# 변환 설정 (저장소 키에도 포함되어 설정이 바뀌면 다시 변환함)
+MP3_SETTINGS = {
+    'format': 'worstaudio/worst', # 저품질 오디오 선택
+    'codec': 'mp3',
+    'quality': '192', # MP3 품질 설정
+    'sample_rate': '48000', # 샘플 레이트 설정
+    'channels': '2', # 오디오 채널 설정
+}
+
+# 음성 인식용 설정 (16 kHz 모노 저비트레이트 Opus, 긴 무음 제거)
+SPEECH_SETTINGS = {
+    'format': 'worstaudio/worst',
+    'sample_rate': 16000,
+    'channels': 1,
+    'bit_rate': '24k',
+    'trim_silence': True,
+    'noise_db': -40,
+    'min_silence': 1.0,
+    'keep_silence': 0.25,
+}
+
+PROFILES = {
+    'mp3': MP3_SETTINGS,
+    'speech': SPEECH_SETTINGS,
+}
+
+_VIDEO_ID = re.compile(r'(?:v=|/(?:shorts|embed|live|v)/|youtu\.be/)([A-Za-z0-9_-]{11})')
+
+_default_store = None
+
+def get_default_store() -> AudioStore:
+    global _default_store
+    if _default_store is None:
+        _default_store = AudioStore()
+    return _default_store
+
+def extract_video_id(url: str) -> str:
+    """
+    Extract the YouTube video ID from a URL.
+
+    URLs that are not recognized are identified by a hash of the URL instead.
+    """
+    match = _VIDEO_ID.search(url)
+    if match:
+        return match.group(1)
+    return "url-" + hashlib.sha1(url.strip().encode('utf-8')).hexdigest()[:16]
+
+def download_and_convert_to_mp3(url, store: AudioStore = None, profile: str = 'mp3', workspace: str = None,
+                                trim_silence: bool = True):
+    """
+    Download the audio of a YouTube video and convert it according to a profile.
+
+    Repeated requests for the same video are served from the audio store without downloading again.
+
+    Args:
+        url: The URL of the video.
+        store: The audio store to use. Defaults to a store in ./audio_cache.
+        profile: Either 'mp3' for a regular MP3 file, or 'speech' for a small file meant for speech
+                 recognition. The speech profile may remove silences; see audio_tools.silence_map_path
+                 for the sidecar file listing them.
+        workspace: If given, the audio file and its sidecars are linked into this directory, so the job keeps
+                   its own copy even if other jobs evict the stored file while it is still in use.
+        trim_silence: Whether the speech profile removes silences. Turn it off for sources where trimming hurts
+                      the recognition, e.g. music with quiet passages.
+
+    Returns:
+        The path of the audio file, in the workspace if given, otherwise in the store.
+    """
+    store = store or get_default_store()
+    settings = PROFILES[profile]
+    if 'trim_silence' in settings:
+        # Part of the settings, so trimmed and untrimmed audio are stored separately
+        settings = dict(settings, trim_silence=trim_silence)
+    key = AudioStore.key(extract_video_id(url), settings)
+
+    # Pinned until the job has its own copy, so other jobs cannot evict the file in between
+    with store.lock(key), store.pin(key):
+        path = store.lookup(key)
+        if not path:
+            # Each job writes to its own directory, so concurrent downloads never overwrite each other
+            job_directory = store.create_job_directory()
+
+            try:
+                if profile == 'speech':
+                    path = _download_for_speech(url, store, key, settings, job_directory)
+                else:
+                    path = _download_mp3(url, store, key, settings, job_directory)
+            finally:
+                shutil.rmtree(job_directory, ignore_errors=True)
+
+        if workspace:
+            path = store.checkout(key, workspace)
+        return path
+
+def _download_mp3(url, store: AudioStore, key: str, settings: dict, job_directory: str) -> str:
+    # Imported on first use, as it takes a while to load
+    import yt_dlp
 
-def download_and_convert_to_mp3(full_path, url):
     # Set up options based on the ydl library document
     ydl_opts = {
-        'format': 'worstaudio/worst', # 저품질 오디오 선택
+        'format': settings['format'],
         'postprocessors': [{ # MP3 변환 설정
             'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192', # MP3 품질 설정
+            'preferredcodec': settings['codec'],
+            'preferredquality': settings['quality'],
         }],
         'postprocessor_args': [
-            '-ar', '48000', # 샘플 레이트 설정
-            '-ac', '2', # 오디오 채널 설정
+            '-ar', settings['sample_rate'],
+            '-ac', settings['channels'],
         ],
         'prefer_ffmpeg': True,
         'keepvideo': False, # 비디오 파일은 삭제
-        'outtmpl': "sound.mp3", # 출력 파일명 포맷
-        # 'outtmpl': '%(title)s.%(ext)s',
+        'outtmpl': os.path.join(job_directory, 'audio.%(ext)s'), # 출력 파일명 포맷
     }
 
-    # Remove the file for space usability
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        if os.path.exists(full_path):
-            os.remove(full_path)
-
-        # Download the Youtube source
+    # Download the Youtube source (yt-dlp also runs the conversion)
+    with timed('download'), yt_dlp.YoutubeDL(ydl_opts) as ydl:
         ydl.download([url])
 
+    produced = glob.glob(os.path.join(job_directory, f"*.{settings['codec']}"))
+    if not produced:
+        raise RuntimeError(f"yt-dlp did not produce a {settings['codec']} file for {url}")
+    record_file('download', produced[0])
+
+    return store.commit(key, settings['codec'], produced[0])
+
+def _download_for_speech(url, store: AudioStore, key: str, settings: dict, job_directory: str) -> str:
+    import yt_dlp
+
+    ydl_opts = {
+        'format': settings['format'],
+        'outtmpl': os.path.join(job_directory, 'source.%(ext)s'),
+    }
+
+    # Download the source as is, and let ffmpeg decide whether it needs to be re-encoded
+    with timed('download'), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=True)
+        source_path = ydl.prepare_filename(info)
+    record_file('download', source_path)
+
+    with timed('ffmpeg.convert'):
+        output_path, removed = convert_for_speech(
+            source_path, os.path.join(job_directory, 'audio'),
+            sample_rate=settings['sample_rate'], channels=settings['channels'], bit_rate=settings['bit_rate'],
+            trim_silence=settings['trim_silence'], noise_db=settings['noise_db'],
+            min_silence=settings['min_silence'], keep_silence=settings['keep_silence'])
+    record_file('ffmpeg.convert', output_path)
+
+    sidecar_path = silence_map_path(output_path)
+    save_silence_map(sidecar_path, removed)
+
+    ext = os.path.splitext(output_path)[1][1:]
+    return store.commit(key, ext, output_path, sidecars={'silences.json': sidecar_path})
+
 if __name__ == '__main__':
     while True :
         url = input("Youtube URL : ")
         if url == 'stop' :
             break
-        path = r"C:\Users\USER\Downloads\music"
-        full_path = ""
-        download_and_convert_to_mp3(full_path, url)
+        print(download_and_convert_to_mp3(url))